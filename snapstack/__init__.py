@@ -1,4 +1,7 @@
 from snapstack.plan import Plan  # noqa
 from snapstack.step import Step  # noqa
 from snapstack.base import Setup, Cleanup  # noqa
-from snapstack.errors import TestFailure, InfraFailure  # noqa
+from snapstack.errors import (  # noqa
+    TestFailure, InfraFailure, CleanupFailure, PreflightFailure)
+from snapstack.batch import Batch  # noqa
+from snapstack.matrix import Matrix  # noqa
@@ -1,5 +1,7 @@
 from collections import OrderedDict
 
+from snapstack import config
+from snapstack.ready import Port
 from snapstack.step import Step
 
 
@@ -13,9 +15,13 @@ class Base:
 
     def steps(self):
         '''
-        Return a list of Step objects, in order.
+        Return a list of Step objects, in order. Steps that haven't been
+        given a name are named after their key.
 
         '''
+        for name, step in self._steps.items():
+            if step.name is None:
+                step.name = name
         return [s for _, s in self._steps.items()]
 
     def add_steps(self, *steps):
@@ -30,11 +36,25 @@ class Base:
     def remove_steps(self, *steps):
         '''
         Each arg should be a string naming a step. We'll remove the named
-        step from our map of steps.
+        step from our map of steps. Steps that required it require what it
+        required instead, so that they still wait on everything that it
+        did.
 
         '''
         for name in steps:
-            del self._steps[name]
+            names = list(self._steps)
+            removed = self._steps.pop(name)
+            requires = removed.requires
+            if requires is None:
+                # It waited on the step before it.
+                index = names.index(name)
+                requires = names[max(index - 1, 0):index]
+            for step in self._steps.values():
+                if step.requires is None or name not in step.requires:
+                    continue
+                step.requires = list(OrderedDict.fromkeys(
+                    required for r in step.requires
+                    for required in (requires if r == name else [r])))
 
 
 class Setup(Base):
@@ -43,22 +63,27 @@ class Setup(Base):
         self._steps['snapstack_setup'] = Step(
             script_loc='{snapstack}',
             scripts=['packages.sh', 'rabbitmq.sh'],
-            files=['admin-openrc']
+            files=['admin-openrc'],
+            requires=[],
+            invalidates=['apt', 'snaps']
         )
         self._steps['keystone'] = Step(
             snap='keystone',
-            script_loc='{openstack}/snap-{snap}/master/tests/',
+            script_loc=config.tests_loc(),
             scripts=['keystone.sh'],
-            files=[
+            templates=[
                 ('etc/snap-keystone/keystone/keystone.conf.d/'
                  'database.conf')
-            ]
+            ],
+            config_dir=config.STAGED_CONFIG_DIR,
+            ready=[Port(5000)],
+            requires=['snapstack_setup']
         )
         self._steps['nova'] = Step(
             snap='nova',
-            script_loc='{openstack}/snap-{snap}/master/tests/',
+            script_loc=config.tests_loc(),
             scripts=['nova.sh'],
-            files=[
+            templates=[
                 'etc/snap-nova/nova/nova.conf.d/nova-placement.conf',
                 'etc/snap-nova/nova/nova.conf.d/scheduler.conf',
                 'etc/snap-nova/nova/nova.conf.d/database.conf',
@@ -66,32 +91,41 @@ class Setup(Base):
                 'etc/snap-nova/nova/nova.conf.d/rabbitmq.conf',
                 'etc/snap-nova/nova/nova.conf.d/neutron.conf',
                 'etc/snap-nova/nova/nova.conf.d/glance.conf',
-            ]
+            ],
+            config_dir=config.STAGED_CONFIG_DIR,
+            ready=[Port(8774)],
+            requires=['keystone']
         )
         self._steps['neutron'] = Step(
             snap='neutron',
-            script_loc='{openstack}/snap-{snap}/master/tests/',
+            script_loc=config.tests_loc(),
             scripts=['neutron.sh'],
-            files=[
+            templates=[
                 'etc/snap-neutron/neutron/neutron.conf.d/database.conf',
                 'etc/snap-neutron/neutron/neutron.conf.d/nova.conf',
                 'etc/snap-neutron/neutron/neutron.conf.d/keystone.conf',
-            ]
+            ],
+            config_dir=config.STAGED_CONFIG_DIR,
+            ready=[Port(9696)],
+            requires=['keystone']
         )
         self._steps['glance'] = Step(
             snap='glance',
-            script_loc='{openstack}/snap-{snap}/master/tests/',
+            script_loc=config.tests_loc(),
             scripts=['glance.sh'],
-            files=[
+            templates=[
                 'etc/snap-glance/glance/glance.conf.d/database.conf',
                 'etc/snap-glance/glance/glance.conf.d/keystone.conf'
-            ]
+            ],
+            config_dir=config.STAGED_CONFIG_DIR,
+            ready=[Port(9292)],
+            requires=['keystone']
         )
         self._steps['nova_hypervisor'] = Step(
             snap='nova-hypervisor',
-            script_loc='{openstack}/snap-{snap}/master/tests/',
+            script_loc=config.tests_loc(),
             scripts=['nova-hypervisor.sh'],
-            files=[
+            templates=[
                 'etc/snap-nova-hypervisor/nova/nova.conf.d/glance.conf',
                 ('etc/snap-nova-hypervisor/nova/nova.conf.d/'
                  'nova-placement.conf'),
@@ -103,38 +137,51 @@ class Setup(Base):
                 ('etc/snap-nova-hypervisor/neutron/plugins/ml2/'
                  'openvswitch_agent.ini'),
                 'etc/snap-nova-hypervisor/neutron/metadata_agent.ini',
-            ]
+            ],
+            config_dir=config.STAGED_CONFIG_DIR,
+            requires=['nova', 'neutron', 'glance']
         )
         self._steps['neutron_ext_net'] = Step(
             script_loc='{snapstack}',
-            scripts=['neutron-ext-net.sh']
+            scripts=['neutron-ext-net.sh'],
+            requires=['neutron', 'nova_hypervisor']
         )
 
 
 class Cleanup(Base):
     def __init__(self):
         super(Cleanup, self).__init__()
-        self._steps['snapstack_cleanup'] = Step(
-            script_loc='{snapstack}',
-            scripts=['cleanup.py']
-        )
         self._steps['keystone'] = Step(
-            script_loc='{openstack}/snap-keystone/master/tests/',
+            script_loc=config.tests_loc('keystone'),
             scripts=['keystone_cleanup.sh'],
+            requires=[]
         )
         self._steps['nova'] = Step(
-            script_loc='{openstack}/snap-nova/master/tests/',
+            script_loc=config.tests_loc('nova'),
             scripts=['nova_cleanup.sh'],
+            requires=[]
         )
         self._steps['neutron'] = Step(
-            script_loc='{openstack}/snap-neutron/master/tests/',
+            script_loc=config.tests_loc('neutron'),
             scripts=['neutron_cleanup.sh'],
+            requires=[]
         )
         self._steps['glance'] = Step(
-            script_loc='{openstack}/snap-glance/master/tests/',
+            script_loc=config.tests_loc('glance'),
             scripts=['glance_cleanup.sh'],
+            requires=[]
         )
         self._steps['nova_hypervisor'] = Step(
-            script_loc='{openstack}/snap-nova-hypervisor/master/tests/',
+            script_loc=config.tests_loc('nova-hypervisor'),
             scripts=['nova-hypervisor_cleanup.sh'],
+            requires=[]
+        )
+        # The snaps' cleanup may still need rabbitmq and the packages that
+        # snapstack_setup installed, so take those down last, as setup
+        # brought them up first.
+        self._steps['snapstack_cleanup'] = Step(
+            script_loc='{snapstack}',
+            scripts=['cleanup.py'],
+            requires=['keystone', 'nova', 'neutron', 'glance',
+                      'nova_hypervisor']
         )
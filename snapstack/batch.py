@@ -0,0 +1,155 @@
+'''
+Run many Plans, deploying each distinct base that they build on only
+once, rather than once per Plan.
+
+'''
+
+import logging
+from collections import OrderedDict
+
+from snapstack.errors import PreflightFailure
+
+
+class Batch:
+    '''
+    Runs a list of Plans, grouped by their base setup and cleanup.
+
+    For each group, the first Plan deploys the base. Then each Plan in the
+    group, in turn, deploys its tests against that base, and cleans up
+    after them, leaving in place any snaps that the next Plan would only
+    install again. Finally, the first Plan tears the base down. Plans in
+    a group run one after another, as their tests share the base.
+
+    '''
+    def __init__(self, plans, keep_base=None):
+        '''
+        @param list plans: The Plans to run.
+        @param bool keep_base: If True, leave each base deployed once its
+          Plans have run. Defaults to True for a group whose first Plan
+          has a warm base, as for Plan.destroy.
+
+        '''
+        self.log = logging.getLogger()
+        self.plans = list(plans)
+        self.keep_base = keep_base
+
+    def groups(self, plans=None):
+        '''
+        Return an OrderedDict mapping the fingerprint of each distinct base
+        to the list of Plans that share it.
+
+        @param list plans: The Plans to group. Defaults to all of ours.
+
+        '''
+        groups = OrderedDict()
+        for plan in self.plans if plans is None else plans:
+            groups.setdefault(plan.base_fingerprint(), []).append(plan)
+        return groups
+
+    def run(self):
+        '''
+        Run every Plan, carrying on past failures.
+
+        Returns an OrderedDict mapping each Plan to the list of exceptions
+        that it raised; an empty list means that it passed. A base that
+        fails to deploy counts against every Plan that shares it. One that
+        fails to clean up counts against the Plan that deployed it.
+
+        Each Plan is preflighted first, unless it was told not to be, and
+        Plans that fail their preflight are not run at all.
+
+        '''
+        results = OrderedDict((plan, []) for plan in self.plans)
+        groups = self.groups([
+            plan for plan in self.plans if self._preflight(plan, results)])
+        self.log.info('Running {} plans against {} bases.'.format(
+            sum(len(plans) for plans in groups.values()), len(groups)))
+
+        for plans in groups.values():
+            self._run_group(plans, results)
+
+        self.log.info('Batch results:\n' + self.summary(results))
+        return results
+
+    def _preflight(self, plan, results):
+        '''
+        Preflight plan, if it wants us to. Return True if it passed.
+
+        '''
+        if not plan._preflight:
+            return True
+        try:
+            with plan.tracer.span('preflight', 'plan'):
+                plan.preflight()
+        except PreflightFailure as e:
+            self.log.error('{} failed preflight: {}'.format(plan.label, e))
+            results[plan].append(e)
+            return False
+        return True
+
+    def _run_group(self, plans, results):
+        leader = plans[0]
+        try:
+            try:
+                with leader.sampling(), \
+                        leader.tracer.span('deploy base', 'plan'):
+                    leader.deploy(tests=False)
+            except Exception as e:
+                self.log.error('Failed to deploy base for {}: {}'.format(
+                    ', '.join(p.label for p in plans), e))
+                for plan in plans:
+                    results[plan].append(e)
+                return
+
+            for plan, after in zip(plans, plans[1:] + [None]):
+                self._run_tests(plan, results[plan], after)
+        finally:
+            try:
+                if not leader._keep_base(self.keep_base):
+                    with leader.sampling(), \
+                            leader.tracer.span('destroy base', 'plan'):
+                        leader.destroy_base()
+            except Exception as e:
+                results[leader].append(e)
+            finally:
+                for plan in plans:
+                    plan.close()
+                    plan.report()
+
+    def _run_tests(self, plan, errors, after=None):
+        '''
+        Deploy plan's tests, and clean up after them, leaving installed any
+        snaps that after, the next Plan to run, installs just the same.
+
+        '''
+        keep = set()
+        if after is not None:
+            keep = set((host, snap) for host, snap, _ in
+                       plan._test_installs() & after._test_installs())
+        # What plan saw installed, at preflight, is out of date now that
+        # the Plans before it have come and gone.
+        for facts in plan._host_facts.values():
+            facts.invalidate('snaps')
+        with plan.sampling():
+            try:
+                with plan.tracer.span('deploy', 'plan'):
+                    plan.deploy(base=False)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                try:
+                    with plan.tracer.span('destroy', 'plan'):
+                        plan.destroy(keep_base=True, keep_snaps=keep)
+                except Exception as e:
+                    errors.append(e)
+
+    def summary(self, results):
+        '''
+        Return a plain text line per Plan, saying whether it passed.
+
+        '''
+        lines = []
+        for plan, errors in results.items():
+            status = 'FAILED ({})'.format(errors[0]) if errors else 'passed'
+            lines.append('  {}: {}'.format(plan.label, status))
+        return '\n'.join(lines)
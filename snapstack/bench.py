@@ -0,0 +1,203 @@
+'''
+Benchmark the harness itself, with fake snapd, scripts and github, so
+that we can measure how scheduling, caching and batching changes scale,
+without installing anything.
+
+Run it with:
+
+    python -m snapstack.bench --steps 200 --files 10
+
+Pass --save to write the results out, and --baseline to compare against
+results saved earlier, exiting non zero if we've regressed.
+
+'''
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from snapstack.cache import FetchCache
+from snapstack.plan import Plan
+from snapstack.step import Step
+from snapstack.testing import FakeRunner, FakeServer
+
+
+# Metrics that --baseline compares. Bigger is worse for all of them.
+GATED = ['wall', 'forks_per_step', 'io_events_per_step', 'peak_memory']
+
+
+class _IOCounter:
+    '''
+    Counts audit events for file, process and socket operations, as a
+    stand-in for counting syscalls. Audit hooks can't be removed, so we
+    install one once, and switch counting on and off.
+
+    '''
+    PREFIXES = ('open', 'os.', 'shutil.', 'socket.', 'subprocess.')
+
+    def __init__(self):
+        self.count = 0
+        self.enabled = False
+        self.available = hasattr(sys, 'addaudithook')
+        if self.available:
+            sys.addaudithook(self._hook)
+
+    def _hook(self, event, args):
+        if self.enabled and event.startswith(self.PREFIXES):
+            self.count += 1
+
+
+_io_counter = None
+
+
+def make_plan(server, scripts_dir, cache_dir, steps, files, width,
+              max_workers=None):
+    '''
+    Build a Plan of steps Steps, each installing a store snap, fetching
+    files remote config files from server and running one local script.
+    Steps are arranged in width independent chains.
+
+    '''
+    with open(os.path.join(scripts_dir, 'step.sh'), 'w') as f:
+        f.write('#!/bin/sh\n')
+
+    tests = []
+    for i in range(steps):
+        remote = ['s{}/f{}.conf'.format(i, j) for j in range(files)]
+        for path in remote:
+            server.put('/tests/' + path, 'step {} {}\n'.format(i, path))
+        tests.append(Step(
+            name='s{}'.format(i),
+            snap='snap{}'.format(i),
+            script_loc=server.url + '/tests/',
+            files=remote,
+            requires=['s{}'.format(i - width)] if i >= width else [],
+        ))
+        tests.append(Step(
+            name='s{}_script'.format(i),
+            script_loc=scripts_dir + '/',
+            scripts=['step.sh'],
+            requires=['s{}'.format(i)],
+        ))
+
+    return Plan(
+        tests=tests,
+        base_setup=[],
+        base_cleanup=[],
+        max_workers=max_workers,
+        cache=FetchCache(path=cache_dir),
+        resume=False,
+        warm_base=False)
+
+
+def run(steps=200, files=10, width=8, max_workers=None, delay=0.0):
+    '''
+    Deploy and destroy a generated Plan against fake backends, and return
+    a dict of measurements.
+
+    '''
+    global _io_counter
+    if _io_counter is None:
+        _io_counter = _IOCounter()
+
+    runner = FakeRunner(delay=delay)
+    with FakeServer() as server, \
+            tempfile.TemporaryDirectory() as scripts_dir, \
+            tempfile.TemporaryDirectory() as cache_dir, \
+            runner.patch():
+        plan = make_plan(server, scripts_dir, cache_dir, steps, files, width,
+                         max_workers=max_workers)
+
+        tracemalloc.start()
+        _io_counter.count = 0
+        _io_counter.enabled = True
+        start = time.time()
+        try:
+            plan.deploy()
+            plan.destroy()
+        finally:
+            wall = time.time() - start
+            _io_counter.enabled = False
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        requests = len(server.requests)
+
+    total_steps = steps * 2
+    return {
+        'steps': total_steps,
+        'files': steps * files,
+        'wall': wall,
+        'forks': len(runner.calls),
+        'forks_per_step': len(runner.calls) / total_steps,
+        'io_events_per_step': (_io_counter.count / total_steps
+                               if _io_counter.available else None),
+        'http_requests': requests,
+        'peak_memory': peak,
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Return a list of messages, one for each gated metric in results that
+    is more than tolerance (a fraction) worse than in baseline.
+
+    '''
+    regressions = []
+    for metric in GATED:
+        new, old = results.get(metric), baseline.get(metric)
+        if new is None or not old:
+            continue
+        if new > old * (1 + tolerance):
+            regressions.append('{}: {:.4g} -> {:.4g} (+{:.0%})'.format(
+                metric, old, new, new / old - 1))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n\n')[0])
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--files', type=int, default=10,
+                        help='Remote files per step.')
+    parser.add_argument('--width', type=int, default=8,
+                        help='Number of independent chains of steps.')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='Seconds that each fake command takes.')
+    parser.add_argument('--save', help='Write results to this json file.')
+    parser.add_argument('--baseline',
+                        help='Compare against results in this json file.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed regression, as a fraction.')
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = run(steps=args.steps, files=args.files, width=args.width,
+                  max_workers=args.workers, delay=args.delay)
+
+    for key, value in results.items():
+        print('{:<20} {}'.format(key, value))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
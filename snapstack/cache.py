@@ -0,0 +1,535 @@
+'''
+Persistent caches: a content addressed cache for the remote files that
+Steps fetch, and a cache of snaps built from local source.
+
+Fetched files are stored by the sha256 of their contents, and indexed by
+url. Before we reuse a cached file, we revalidate it with the server,
+using the ETag or Last-Modified headers that came with it.
+
+Built snaps are indexed by a fingerprint of the source tree that they
+were built from.
+
+'''
+
+import collections
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+
+from snapstack import config
+from snapstack.errors import InfraFailure
+
+
+MAX_SIZE = 512 * 1024 * 1024
+BUILD_MAX_SIZE = 2 * 1024 * 1024 * 1024
+SAVE_INTERVAL = 1.0
+CHUNK_SIZE = 1024 * 1024
+
+# Things in a snap's source tree that don't go into the snap: snapcraft's
+# working dirs, previous builds, and the like.
+IGNORE_DIRS = ['.git', '.tox', '.eggs', '__pycache__', 'parts', 'stage',
+               'prime']
+IGNORE_SUFFIXES = ['.snap', '.pyc']
+
+
+def default_dir():
+    '''
+    Return the directory that snapstack keeps its caches under.
+
+    '''
+    return os.environ.get('SNAPSTACK_CACHE_DIR') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'snapstack')
+
+
+class FetchCache:
+    '''
+    Cache for files fetched over http. Safe to share between threads.
+
+    The index is written atomically, so several processes may share a
+    cache dir. If they race, the loser's index entries are simply lost,
+    and those files get downloaded again next time. Only one process at a
+    time may write to a url's partial download; the others download it
+    from the top. Call flush when you're done with the cache, to make
+    sure the index is up to date.
+
+    '''
+    def __init__(self, path=None, max_size=None, offline=None):
+        '''
+        @param string path: Where to keep the cache. Defaults to a "fetch"
+          dir under SNAPSTACK_CACHE_DIR, or ~/.cache/snapstack.
+        @param int max_size: Size cap, in bytes, for cached files. The least
+          recently used files are evicted to stay under it. Defaults to
+          SNAPSTACK_CACHE_SIZE, or MAX_SIZE.
+        @param bool offline: If True, never touch the network, and serve
+          files only from the cache. Defaults to SNAPSTACK_OFFLINE.
+
+        '''
+        self.log = logging.getLogger()
+        self.path = path or os.path.join(default_dir(), 'fetch')
+        self.max_size = max_size or int(
+            os.environ.get('SNAPSTACK_CACHE_SIZE') or MAX_SIZE)
+        self.offline = config.env_flag('SNAPSTACK_OFFLINE') \
+            if offline is None else offline
+
+        self._objects = os.path.join(self.path, 'objects')
+        self._index_path = os.path.join(self.path, 'index.json')
+        self._lock = threading.Lock()
+
+        os.makedirs(self._objects, exist_ok=True)
+        self._index = self._load()
+        self._count()
+        self._saved = 0
+        self._dirty = False
+
+    def _load(self):
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, force=False):
+        '''
+        Write out the index, at most once every SAVE_INTERVAL seconds,
+        unless forced. (Rewriting it after every fetch makes fetching n
+        files O(n^2).)
+
+        '''
+        if not force and time.time() - self._saved < SAVE_INTERVAL:
+            self._dirty = True
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp, self._index_path)
+        self._saved = time.time()
+        self._dirty = False
+
+    def flush(self):
+        '''
+        Write out any changes to the index that we've held back.
+
+        '''
+        with self._lock:
+            if self._dirty:
+                self._save(force=True)
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects, digest[:2], digest)
+
+    def _partial_path(self, url):
+        return os.path.join(
+            self.path, 'partial', hashlib.sha256(url.encode()).hexdigest())
+
+    def _store(self, tmp, digest):
+        '''
+        Move the file at tmp into the object store, as digest.
+
+        '''
+        path = self._object_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp, path)
+        return path
+
+    def _cached(self, url):
+        '''
+        Return the index entry for url, if we have both it and its file.
+
+        '''
+        entry = self._index.get(url)
+        if entry and os.path.exists(self._object_path(entry['sha256'])):
+            return entry
+        return None
+
+    def has(self, url):
+        '''
+        Return True if we have a copy of url, fresh or not.
+
+        '''
+        with self._lock:
+            return self._cached(url) is not None
+
+    def _hit(self, url, entry):
+        entry['used'] = time.time()
+        self._save()
+        return self._object_path(entry['sha256'])
+
+    def get(self, url, session=None, sha256=None):
+        '''
+        Return a local path to the contents of url, downloading it only if
+        our cached copy is missing or stale.
+
+        Downloads are streamed to disk, and hashed as they go. If one is
+        interrupted, the next get picks up where it left off, as long as
+        the server supports Range requests, and the file hasn't changed.
+        We ask for unencoded bodies, so that byte offsets line up.
+
+        @param string url: The url to fetch.
+        @param session: Something with a requests style get method.
+          Defaults to the requests module.
+        @param string sha256: The expected sha256 of the file, if known. If
+          our cached copy matches, we use it without asking the server. If
+          what we download doesn't, we raise an InfraFailure.
+
+        '''
+        session = session or requests
+
+        with self._lock:
+            entry = self._cached(url)
+            if entry is not None and sha256 is not None:
+                if entry['sha256'] == sha256:
+                    return self._hit(url, entry)
+                entry = None
+            if self.offline:
+                if entry is None:
+                    raise InfraFailure(
+                        'Offline, and {} is not cached.'.format(url))
+                return self._hit(url, entry)
+
+        # requests transparently decodes gzip, so what lands on disk is
+        # the decoded body, while Range offsets count encoded bytes. Ask for
+        # the file as is, so that a partial download can be resumed.
+        headers = {'Accept-Encoding': 'identity'}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        partial, lock = self._claim_partial(url)
+        try:
+            return self._fetch(url, session, headers, entry, sha256, partial)
+        finally:
+            self._release_partial(partial, lock)
+
+    def _fetch(self, url, session, headers, entry, sha256, partial):
+        '''
+        Download url to partial, resuming it if we can, and move it into
+        the cache. Return the path to the cached file.
+
+        '''
+        validator = self._partial_validator(partial)
+        if validator is not None:
+            headers['Range'] = 'bytes={}-'.format(os.path.getsize(partial))
+            headers['If-Range'] = validator
+
+        remote = session.get(url, headers=headers, stream=True)
+        if remote.status_code == 206 and remote.headers.get(
+                'Content-Encoding', 'identity') != 'identity':
+            # The server ignored us, and we can't splice its encoded bytes
+            # onto our decoded ones. Start again from the top.
+            remote.close()
+            os.remove(partial)
+            del headers['Range'], headers['If-Range']
+            remote = session.get(url, headers=headers, stream=True)
+        try:
+            if remote.status_code == 304 and entry is not None:
+                with self._lock:
+                    return self._hit(url, entry)
+            remote.raise_for_status()
+            digest, size = self._download(remote, partial)
+        finally:
+            remote.close()
+
+        if sha256 is not None and digest != sha256:
+            os.remove(partial)
+            raise InfraFailure(
+                'Checksum mismatch for {}: expected {}, got {}'.format(
+                    url, sha256, digest))
+
+        with self._lock:
+            path = self._store(partial, digest)
+            self._add(url, {
+                'sha256': digest,
+                'size': size,
+                'etag': remote.headers.get('ETag'),
+                'last_modified': remote.headers.get('Last-Modified'),
+                'used': time.time(),
+            })
+            if self._total > self.max_size:
+                self._evict()
+            self._save()
+            return path
+
+    def _claim_partial(self, url):
+        '''
+        Return the path to download url to, and an open file that holds a
+        lock on it. Only the process holding the lock writes to, and so
+        resumes, url's partial download. If another process has it, we
+        download to a partial of our own, with no lock (None), which is
+        thrown away afterwards.
+
+        '''
+        partial = self._partial_path(url)
+        os.makedirs(os.path.dirname(partial), exist_ok=True)
+        lock = open(partial + '.lock', 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return '{}.{}'.format(partial, uuid.uuid4().hex), None
+        return partial, lock
+
+    def _release_partial(self, partial, lock):
+        if lock is not None:
+            lock.close()
+            return
+        for path in [partial, partial + '.json']:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _partial_validator(self, partial):
+        '''
+        Return the ETag or Last-Modified date of the response that we were
+        partway through downloading to partial, if we can resume it.
+
+        '''
+        try:
+            with open(partial + '.json') as f:
+                meta = json.load(f)
+            if not os.path.getsize(partial):
+                return None
+        except (OSError, ValueError):
+            return None
+        return meta.get('etag') or meta.get('last_modified')
+
+    def _download(self, remote, partial):
+        '''
+        Stream the body of remote into partial, appending to it if remote
+        is the rest of a file that we already have part of. Return the
+        file's sha256 and size.
+
+        '''
+        h = hashlib.sha256()
+        if remote.status_code == 206:
+            mode = 'ab'
+            with open(partial, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    h.update(chunk)
+        else:
+            mode = 'wb'
+            os.makedirs(os.path.dirname(partial), exist_ok=True)
+            with open(partial + '.json', 'w') as f:
+                json.dump({
+                    'etag': remote.headers.get('ETag'),
+                    'last_modified': remote.headers.get('Last-Modified'),
+                }, f)
+
+        with open(partial, mode) as f:
+            for chunk in remote.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                h.update(chunk)
+            size = f.tell()
+
+        os.remove(partial + '.json')
+        return h.hexdigest(), size
+
+    def _count(self):
+        '''
+        Count how many urls point at each file, and how big the files that
+        they point at are, in total.
+
+        '''
+        self._refs = collections.Counter(
+            e['sha256'] for e in self._index.values())
+        self._total = sum({e['sha256']: e['size']
+                           for e in self._index.values()}.values())
+
+    def _add(self, url, entry):
+        if url in self._index:
+            self._drop(url)
+        self._index[url] = entry
+        self._refs[entry['sha256']] += 1
+        if self._refs[entry['sha256']] == 1:
+            self._total += entry['size']
+
+    def _drop(self, url):
+        '''
+        Forget url, and remove its file if nothing else points at it.
+
+        '''
+        entry = self._index.pop(url)
+        self._refs[entry['sha256']] -= 1
+        if self._refs[entry['sha256']] == 0:
+            del self._refs[entry['sha256']]
+            self._total -= entry['size']
+            try:
+                os.remove(self._object_path(entry['sha256']))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        '''
+        Drop the least recently used urls until the files that they point
+        to fit in max_size.
+
+        '''
+        by_age = sorted(self._index, key=lambda u: self._index[u]['used'])
+        # Never evict the entry we've just added.
+        while self._total > self.max_size and len(by_age) > 1:
+            url = by_age.pop(0)
+            self.log.debug('Evicting {} from fetch cache.'.format(url))
+            self._drop(url)
+
+
+def file_sha256(path):
+    '''
+    Return the sha256 of the file at path, reading it a chunk at a time.
+
+    '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def verify(path, sha256, name=None):
+    '''
+    Raise an InfraFailure if the file at path doesn't have the given
+    sha256. Does nothing if sha256 is None.
+
+    '''
+    if sha256 is None:
+        return
+    digest = file_sha256(path)
+    if digest != sha256:
+        raise InfraFailure(
+            'Checksum mismatch for {}: expected {}, got {}'.format(
+                name or path, sha256, digest))
+
+
+def fingerprint_tree(path, extra=None):
+    '''
+    Return a hash of the names, modes and contents of the files under path,
+    which is usually a snap's source tree, including snap/snapcraft.yaml
+    and any wheelhouse. Skips the things in IGNORE_DIRS and
+    IGNORE_SUFFIXES.
+
+    @param string extra: Anything else that should change the hash.
+
+    '''
+    h = hashlib.sha256((extra or '').encode('utf-8'))
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d not in IGNORE_DIRS)
+        for name in sorted(files):
+            if name.endswith(tuple(IGNORE_SUFFIXES)):
+                continue
+            full = os.path.join(root, name)
+            if not os.path.isfile(full):
+                continue
+            rel = os.path.relpath(full, path)
+            mode = os.stat(full).st_mode & 0o777
+            h.update('{} {:o}\n'.format(rel, mode).encode('utf-8'))
+            with open(full, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    h.update(chunk)
+    return h.hexdigest()
+
+
+class BuildCache:
+    '''
+    Cache for snaps built from local source, so that we only rebuild a snap
+    when its source changes. Safe to share between threads.
+
+    '''
+    def __init__(self, path=None, max_size=None):
+        '''
+        @param string path: Where to keep the cache. Defaults to a "build"
+          dir under SNAPSTACK_CACHE_DIR, or ~/.cache/snapstack.
+        @param int max_size: Size cap, in bytes. The least recently used
+          snaps are evicted to stay under it. Defaults to
+          SNAPSTACK_BUILD_CACHE_SIZE, or BUILD_MAX_SIZE.
+
+        '''
+        self.log = logging.getLogger()
+        self.path = path or os.path.join(default_dir(), 'build')
+        self.max_size = max_size or int(
+            os.environ.get('SNAPSTACK_BUILD_CACHE_SIZE') or BUILD_MAX_SIZE)
+        self._index_path = os.path.join(self.path, 'index.json')
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, index):
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, self._index_path)
+
+    def _snap_path(self, fingerprint, name):
+        return os.path.join(self.path, fingerprint, name)
+
+    def get(self, fingerprint):
+        '''
+        Return the path to the snap built from source with fingerprint, or
+        None if we don't have one.
+
+        '''
+        with self._lock:
+            index = self._load()
+            entry = index.get(fingerprint)
+            if entry is None:
+                return None
+            path = self._snap_path(fingerprint, entry['name'])
+            if not os.path.exists(path):
+                return None
+            entry['used'] = time.time()
+            self._save(index)
+            return path
+
+    def put(self, fingerprint, snap):
+        '''
+        Copy a freshly built snap into the cache, and return the path to
+        our copy.
+
+        '''
+        name = os.path.basename(snap)
+        path = self._snap_path(fingerprint, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        os.close(fd)
+        shutil.copyfile(snap, tmp)
+        os.replace(tmp, path)
+
+        with self._lock:
+            index = self._load()
+            index[fingerprint] = {
+                'name': name,
+                'size': os.path.getsize(path),
+                'used': time.time(),
+            }
+            self._evict(index, keep=fingerprint)
+            self._save(index)
+        return path
+
+    def _evict(self, index, keep):
+        total = sum(e['size'] for e in index.values())
+        by_age = sorted(index, key=lambda f: index[f]['used'])
+        for fingerprint in by_age:
+            if total <= self.max_size:
+                break
+            if fingerprint == keep:
+                continue
+            self.log.debug('Evicting {} from build cache.'.format(
+                index[fingerprint]['name']))
+            total -= index.pop(fingerprint)['size']
+            shutil.rmtree(os.path.join(self.path, fingerprint),
+                          ignore_errors=True)
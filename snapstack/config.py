@@ -10,15 +10,60 @@ LOCATION_VARS = {
     'snapstack': '{snapstack}/scripts/'.format(
         snapstack=os.path.dirname(__file__)),
     'openstack': 'https://raw.githubusercontent.com/openstack',
+    'openstack_archive': 'https://github.com/openstack',
     'snap': None  # Filled in by _run
 }
 
 
 CHANNEL = 'ocata/edge'
 
+# Where the tests for each OpenStack snap live: as separate files in its
+# git repo, or in a tarball of the repo, which we fetch all at once.
+TESTS_LOC = '{openstack}/snap-{snap}/master/tests/'
+ARCHIVE_TESTS_LOC = \
+    '{openstack_archive}/snap-{snap}/archive/master.tar.gz#tests/'
 
-INSTALL_SNAP = """\
-snap list | grep -q "^{snap}\s" || {{
-    sudo snap install{classic} {channel} {snap}
-}}
-"""
+# Where a Step renders its config templates, by default. A template at
+# etc/snap-<snap>/<path> under the Step's script_loc is rendered to <path>
+# under here, where the snap's services will read it.
+CONFIG_DIR = '/var/snap/{snap}/common/etc/'
+
+# Where base.Setup renders the snaps' config templates: into BASE_DIR,
+# where each snap's own setup script copies them from.
+STAGED_CONFIG_DIR = '{base_dir}/etc/snap-{snap}/'
+
+# The variables that config templates can use, unless a Plan overrides
+# them. Steps also fill in http_proxy and https_proxy from the Plan's
+# proxies, and snap, with their snap.
+TEMPLATE_VARS = {
+    'db_host': 'localhost',
+    'rabbitmq_host': 'localhost',
+    'rabbitmq_user': 'openstack',
+    'rabbitmq_password': 'rabbitmq',
+    'keystone_host': 'localhost',
+    'http_proxy': '',
+    'https_proxy': '',
+}
+
+
+def tests_loc(snap='{snap}'):
+    '''
+    Return the script_loc for the tests of an OpenStack snap, which will be
+    ARCHIVE_TESTS_LOC if SNAPSTACK_ARCHIVE_FETCH is set, else TESTS_LOC.
+
+    @param string snap: The name of the snap. Leave it out to leave it to
+      the Step to fill in.
+
+    '''
+    loc = ARCHIVE_TESTS_LOC if env_flag('SNAPSTACK_ARCHIVE_FETCH') \
+        else TESTS_LOC
+    return loc.replace('{snap}', snap)
+
+
+def env_flag(name):
+    '''
+    Return True if the environment variable name is set to something
+    truthy, like "1" or "true".
+
+    '''
+    return os.environ.get(name, '').lower() in ('1', 'true', 'yes', 'on')
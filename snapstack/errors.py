@@ -4,7 +4,24 @@ Exception classes for those times when things don't go your way.
 '''
 
 
-class InfraFailure(Exception):
+class _Failure(Exception):
+    '''
+    Base class for our failures, which may carry the tail of the output
+    of whatever failed.
+
+    '''
+    def __init__(self, *args, output=None):
+        super(_Failure, self).__init__(*args)
+        self.output = output
+
+    def __str__(self):
+        message = super(_Failure, self).__str__()
+        if self.output:
+            message += '\n--- last output ---\n' + self.output
+        return message
+
+
+class InfraFailure(_Failure):
     '''
     Typically indicates an error in the Infrastructure around testing
     a snap, or an error in the test runner itself.
@@ -17,10 +34,38 @@ class InfraFailure(Exception):
     pass
 
 
-class TestFailure(Exception):
+class TestFailure(_Failure):
     '''
     Handy Exception to raise if there is a failure while running tests
     for a snap.
 
     '''
     pass
+
+
+class CleanupFailure(InfraFailure):
+    '''
+    Raised when one or more things went wrong while tearing down a Plan.
+    Teardown carries on past each error, so that it can clean up as much
+    as possible, and collects them here.
+
+    '''
+    def __init__(self, errors):
+        self.errors = list(errors)
+        super(CleanupFailure, self).__init__(
+            'Cleanup failed:\n' + '\n'.join(
+                '  {}'.format(e) for e in self.errors))
+
+
+class PreflightFailure(InfraFailure):
+    '''
+    Raised before a Plan deploys anything, if it can tell that it won't
+    get far: a script location that doesn't resolve, a missing file, a
+    snap or channel that isn't in the store. Lists every problem found.
+
+    '''
+    def __init__(self, problems):
+        self.problems = list(problems)
+        super(PreflightFailure, self).__init__(
+            'Preflight checks failed:\n' + '\n'.join(
+                '  {}'.format(p) for p in self.problems))
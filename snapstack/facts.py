@@ -0,0 +1,137 @@
+'''
+Facts about a host that Steps need to know, probed once per run and
+shared between all of the Steps in a Plan that run on that host.
+
+'''
+
+import os
+import subprocess
+import threading
+
+from snapstack.transport import Transport
+
+
+# Which facts each name passed to HostFacts.invalidate covers.
+GROUPS = {
+    'apt': ['apt_unauthenticated', 'package_versions'],
+    'snaps': ['installed_snaps'],
+    'env': ['environ'],
+}
+
+
+class HostFacts:
+    '''
+    Lazily probes, then remembers, facts about the host. Safe to share
+    between threads.
+
+    Steps that change the things we probe (by adding apt sources, or
+    installing snaps, for example) should call invalidate afterwards.
+
+    '''
+    def __init__(self, transport=None):
+        '''
+        @param transport.Transport transport: The host to probe. Defaults to
+          this one.
+
+        '''
+        self.transport = transport or Transport()
+        self._facts = {}
+        self._lock = threading.RLock()
+
+    def _run(self, cmd, **kwargs):
+        return subprocess.run(self.transport.command(cmd)[0], **kwargs)
+
+    def _get(self, name, probe):
+        with self._lock:
+            if name not in self._facts:
+                self._facts[name] = probe()
+            return self._facts[name]
+
+    def invalidate(self, *groups):
+        '''
+        Forget the named groups of facts (see GROUPS), so that they will be
+        probed again next time. With no args, forget everything.
+
+        '''
+        with self._lock:
+            if not groups:
+                self._facts.clear()
+                return
+            for group in groups:
+                for name in GROUPS[group]:
+                    self._facts.pop(name, None)
+
+    @property
+    def environ(self):
+        '''
+        A snapshot of os.environ. Don't modify it; copy it. This is always
+        our own environment, whichever host we probe.
+
+        '''
+        return self._get('environ', lambda: dict(os.environ))
+
+    @property
+    def apt_unauthenticated(self):
+        '''
+        True if apt has a repo from openstack.org configured. We have to
+        allow unauthenticated packages from those in the gerrit gate.
+
+        '''
+        def probe():
+            repos = self._run(
+                ['apt-cache', 'policy'], stdout=subprocess.PIPE)
+            for line in repos.stdout.decode('utf-8').split(os.linesep):
+                if "openstack.org" in line:
+                    return True
+            return False
+
+        return self._get('apt_unauthenticated', probe)
+
+    @property
+    def installed_snaps(self):
+        '''
+        A dict mapping the name of each installed snap to a dict with its
+        version, rev, tracking channel and notes (such as "classic").
+
+        '''
+        def probe():
+            p = self._run(['snap', 'list'], stdout=subprocess.PIPE)
+            snaps = {}
+            if p.returncode != 0:
+                return snaps
+            lines = p.stdout.decode('utf-8').split(os.linesep)
+            for line in lines[1:]:  # Skip the header.
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                snaps[fields[0]] = {
+                    'version': fields[1],
+                    'rev': fields[2],
+                    'tracking': fields[3] if len(fields) > 3 else None,
+                    'notes': fields[5] if len(fields) > 5 else None,
+                }
+            return snaps
+
+        return self._get('installed_snaps', probe)
+
+    def package_version(self, package):
+        '''
+        Return the candidate version of an apt package, or None if apt
+        doesn't know about it.
+
+        '''
+        versions = self._get('package_versions', dict)
+        with self._lock:
+            if package not in versions:
+                versions[package] = self._probe_package(package)
+            return versions[package]
+
+    def _probe_package(self, package):
+        p = self._run(
+            ['apt-cache', 'policy', package], stdout=subprocess.PIPE)
+        for line in p.stdout.decode('utf-8').split(os.linesep):
+            line = line.strip()
+            if line.startswith('Candidate:'):
+                version = line.split(':', 1)[1].strip()
+                return None if version == '(none)' else version
+        return None
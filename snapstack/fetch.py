@@ -0,0 +1,319 @@
+'''
+Download the remote files that a Plan needs, concurrently, over one
+pooled http session.
+
+'''
+
+import concurrent.futures
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import urllib.request
+import zipfile
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from snapstack.cache import FetchCache, verify
+from snapstack.errors import InfraFailure
+
+
+MAX_WORKERS = 8
+ARCHIVE_SUFFIXES = ('.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.tar', '.zip')
+
+
+def _pin_env(session):
+    '''
+    Read the proxy and CA bundle settings that requests would pick up from
+    the environment once, and pin them on session. Otherwise, requests
+    rescans the whole environment on every single request.
+
+    '''
+    proxies = urllib.request.getproxies()
+    if 'no' in proxies:
+        # requests only honors no_proxy when it reads the env itself.
+        return
+    for scheme, url in proxies.items():
+        session.proxies.setdefault(scheme, url)
+    bundle = (os.environ.get('REQUESTS_CA_BUNDLE') or
+              os.environ.get('CURL_CA_BUNDLE'))
+    if bundle:
+        session.verify = bundle
+    session.trust_env = False
+
+
+def is_remote(path):
+    return path.startswith(('http://', 'https://'))
+
+
+def split_archive(url):
+    '''
+    A url may point at a file inside a tarball or zip, as
+    <archive url>#<path in archive>; for example,
+    https://github.com/openstack/snap-nova/archive/master.tar.gz#tests/nova.sh
+
+    If url does, return the archive's url and the path. Otherwise, return
+    (None, None).
+
+    '''
+    archive, sep, member = url.partition('#')
+    if sep and archive.endswith(ARCHIVE_SUFFIXES):
+        return archive, member
+    return None, None
+
+
+class _Archive:
+    '''
+    A downloaded tarball or zip, from which we extract members one at a
+    time, as they're asked for. Safe to share between threads.
+
+    '''
+    def __init__(self, path, dest):
+        self._path = path
+        self._dest = dest
+        self._lock = threading.Lock()
+        self._archive = None
+        self._members = None
+        self._top = None
+        self._extracted = {}
+
+    def _open(self):
+        if self._path.endswith('.zip') or zipfile.is_zipfile(self._path):
+            self._archive = zipfile.ZipFile(self._path)
+            self._members = {
+                i.filename: i for i in self._archive.infolist()
+                if not i.filename.endswith('/')}
+        else:
+            self._archive = tarfile.open(self._path)
+            self._members = {
+                m.name: m for m in self._archive.getmembers() if m.isfile()}
+
+        # Archives of git repos, from github and the like, put everything
+        # in a single top level dir. Paths may leave it out.
+        tops = set(name.split('/', 1)[0] for name in self._members)
+        if len(tops) == 1:
+            self._top = tops.pop()
+
+    def _find(self, member):
+        if member in self._members:
+            return self._members[member]
+        if self._top is not None:
+            return self._members.get('{}/{}'.format(self._top, member))
+        return None
+
+    def extract(self, member):
+        '''
+        Return a local path to member, extracting it if need be.
+
+        '''
+        with self._lock:
+            if member in self._extracted:
+                return self._extracted[member]
+            if self._archive is None:
+                self._open()
+
+            info = self._find(member)
+            path = os.path.normpath(os.path.join(self._dest, member))
+            if info is None or not path.startswith(self._dest + os.sep):
+                raise InfraFailure('No file {} in {}'.format(
+                    member, self._path))
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if isinstance(self._archive, zipfile.ZipFile):
+                src = self._archive.open(info)
+            else:
+                src = self._archive.extractfile(info)
+            with src, open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+
+            self._extracted[member] = path
+            return path
+
+
+class Fetcher:
+    '''
+    Fetches each url at most once per run, and hands back a local path to
+    its contents. Safe to share between threads: if two Steps ask for the
+    same url at once, the second waits on the first's download.
+
+    '''
+    def __init__(self, cache=None, http_proxy=None, https_proxy=None,
+                 max_workers=None, tracer=None):
+        '''
+        @param cache.FetchCache cache: If given, downloads go through (and
+          persist in) this cache. Otherwise, they're kept in a temporary
+          dir for the life of the Fetcher.
+        @param string http_proxy: Proxy for http urls.
+        @param string https_proxy: Proxy for https urls.
+        @param int max_workers: How many files to download at once.
+        @param trace.Tracer tracer: If given, time each download.
+
+        '''
+        self.log = logging.getLogger()
+        self.cache = cache
+        self.max_workers = max_workers or MAX_WORKERS
+        self.tracer = tracer
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.max_workers,
+            pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if http_proxy is not None:
+            self.session.proxies['http'] = http_proxy
+        if https_proxy is not None:
+            self.session.proxies['https'] = https_proxy
+        _pin_env(self.session)
+
+        self._tempdir = None
+        self._futures = {}
+        self._archives = {}
+        self._lock = threading.Lock()
+
+    def _workdir(self):
+        '''
+        Return our scratch dir, creating it if need be. Call with our lock
+        held.
+
+        '''
+        if self._tempdir is None:
+            self._tempdir = tempfile.TemporaryDirectory()
+        return self._tempdir.name
+
+    def _download(self, url, sha256):
+        if self.tracer is None:
+            return self._get(url, sha256)
+        with self.tracer.span(url, 'download'):
+            return self._get(url, sha256)
+
+    def _get(self, url, sha256):
+        with self._lock:
+            if self.cache is None:
+                # Without a persistent cache, keep downloads in a private
+                # one, for the life of the Fetcher.
+                self.cache = FetchCache(
+                    path=os.path.join(self._workdir(), 'cache'),
+                    max_size=sys.maxsize, offline=False)
+        return self.cache.get(url, session=self.session, sha256=sha256)
+
+    def get(self, url, sha256=None):
+        '''
+        Return a local path to the contents of url, downloading it if
+        nobody has done so yet during this run.
+
+        If url points into an archive (see split_archive), we download the
+        whole archive, once, and extract just the file that was asked for.
+
+        @param string sha256: If given, raise an InfraFailure unless the
+          file has this sha256.
+
+        '''
+        archive_url, member = split_archive(url)
+        if archive_url is not None:
+            path = self._archive(archive_url).extract(member)
+            verify(path, sha256, name=url)
+            return path
+
+        with self._lock:
+            future = self._futures.get(url)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._futures[url] = future
+
+        if not owner:
+            path = future.result()
+            verify(path, sha256, name=url)
+            return path
+
+        try:
+            path = self._download(url, sha256)
+        except Exception as e:
+            # Forget the failure, so that a later get may try again.
+            with self._lock:
+                del self._futures[url]
+            future.set_exception(e)
+            raise
+
+        future.set_result(path)
+        return path
+
+    def _archive(self, url):
+        path = self.get(url)
+        with self._lock:
+            archive = self._archives.get(url)
+            if archive is None:
+                dest = os.path.join(
+                    self._workdir(),
+                    hashlib.sha256(url.encode()).hexdigest() + '.d')
+                archive = self._archives[url] = _Archive(path, dest)
+            return archive
+
+    def check(self, urls):
+        '''
+        Check that each of urls exists, with concurrent HEAD requests,
+        without downloading anything. For a file in an archive, we check
+        the archive. Returns a list of problems, as strings.
+
+        '''
+        urls = list(OrderedDict.fromkeys(
+            split_archive(url)[0] or url for url in urls))
+        if self.cache is not None and self.cache.offline:
+            return ['Offline, and {} is not cached'.format(url)
+                    for url in urls if not self.cache.has(url)]
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers) as pool:
+            return [p for p in pool.map(self._check, urls) if p is not None]
+
+    def _check(self, url):
+        try:
+            remote = self.session.head(url, allow_redirects=True)
+            if remote.status_code == 405:
+                # Some servers won't do HEAD. Make do with the headers of a
+                # GET.
+                remote = self.session.get(url, stream=True)
+                remote.close()
+        except requests.RequestException as e:
+            return 'Could not reach {}: {}'.format(url, e)
+        if remote.status_code >= 400:
+            return '{} returned {}'.format(url, remote.status_code)
+        return None
+
+    def prefetch(self, urls, wait=True):
+        '''
+        Download all of urls concurrently.
+
+        Failures are logged, rather than raised; the Step that needs the
+        file will try again, and raise, when it runs. Files in archives are
+        left in their (downloaded) archive until they're needed.
+
+        @param list urls: The urls to fetch.
+        @param bool wait: If False, return right away, and let the
+          downloads carry on in the background.
+
+        '''
+        pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers)
+        urls = [split_archive(url)[0] or url for url in urls]
+        futures = {pool.submit(self.get, url): url
+                   for url in OrderedDict.fromkeys(urls)}
+        pool.shutdown(wait=False)
+
+        def report(future):
+            if future.exception() is not None:
+                self.log.warning('Failed to prefetch {}: {}'.format(
+                    futures[future], future.exception()))
+
+        for future in futures:
+            future.add_done_callback(report)
+
+        if wait:
+            concurrent.futures.wait(futures)
@@ -0,0 +1,213 @@
+'''
+A history of how long each Step took, and how it went, in every run on
+this host, kept in a small SQLite database. Plans use it to start the
+Steps at the head of their longest chains first, and to predict how long
+they'll take.
+
+'''
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from snapstack.journal import default_dir
+
+
+OUTCOMES = ['passed', 'failed']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS steps (
+    step TEXT NOT NULL,
+    snap TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    host TEXT NOT NULL,
+    plan TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS steps_key ON steps (step, snap, channel, started);
+'''
+
+
+def key(step):
+    '''
+    Return the (step, snap, channel) that we file step's runs under.
+
+    '''
+    return (step.label, step.snap or '', step.channel if step.snap else '')
+
+
+class History:
+    '''
+    Records each Step's duration and outcome, keyed by the Step's name,
+    snap and channel, and answers questions about them. Safe to share
+    between threads, and between Plans in other processes.
+
+    '''
+    def __init__(self, path=None):
+        '''
+        @param string path: The database file. Defaults to history.db under
+          SNAPSTACK_STATE_DIR, or ~/.local/state/snapstack.
+
+        '''
+        self.path = path or os.path.join(default_dir(), 'history.db')
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=30,
+                                       check_same_thread=False)
+            # Let Plans in other processes read while we write.
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def record(self, step, duration, outcome, plan='', host=None,
+               started=None):
+        '''
+        Record a run of step.
+
+        @param step.Step step: The Step that ran.
+        @param float duration: How long it took, in seconds.
+        @param string outcome: One of OUTCOMES.
+        @param string plan: The label of the Plan that ran it.
+        @param string host: The name of the host that it ran on.
+        @param float started: When it started. Defaults to duration ago.
+
+        '''
+        if started is None:
+            started = time.time() - duration
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute(
+                    'INSERT INTO steps VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    key(step) + (host or '', plan, outcome, started,
+                                 duration))
+
+    def durations(self, step, snap=None, channel=None, outcome='passed',
+                  last=None):
+        '''
+        Return the durations of the runs of a step, oldest first.
+
+        @param string step: The Step's name (its label).
+        @param string snap: Only count runs that installed this snap.
+        @param string channel: Only count runs that installed from this
+          channel.
+        @param string outcome: Only count runs that ended this way; None
+          counts them all. Failures tend to be quick, so leave them out of
+          any estimates.
+        @param int last: Only count this many of the most recent runs.
+
+        '''
+        where = ['step = ?']
+        args = [step]
+        for column, value in [('snap', snap), ('channel', channel),
+                              ('outcome', outcome)]:
+            if value is not None:
+                where.append('{} = ?'.format(column))
+                args.append(value)
+        query = 'SELECT duration FROM steps WHERE {} ORDER BY started DESC'
+        if last is not None:
+            query += ' LIMIT ?'
+            args.append(last)
+        with self._lock:
+            rows = self._connect().execute(
+                query.format(' AND '.join(where)), args).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    def percentile(self, step, p, snap=None, channel=None, last=None):
+        '''
+        Return the pth percentile (0 to 100) of a step's duration in runs
+        that passed, interpolating between runs, or None if it has never
+        passed. Takes the same filters as durations.
+
+        '''
+        return percentile(
+            self.durations(step, snap, channel, last=last), p)
+
+    def trend(self, step, snap=None, channel=None, last=20):
+        '''
+        Return how many seconds a step's duration has grown by, per run,
+        over its last few runs that passed: the slope of a least squares
+        fit. Negative if it's getting quicker. None if it has fewer than two
+        runs to go on.
+
+        '''
+        durations = self.durations(step, snap, channel, last=last)
+        n = len(durations)
+        if n < 2:
+            return None
+        mean_x = (n - 1) / 2.0
+        mean_y = sum(durations) / n
+        return (sum((x - mean_x) * (y - mean_y)
+                    for x, y in enumerate(durations)) /
+                sum((x - mean_x) ** 2 for x in range(n)))
+
+    def expected(self, steps, p=50, last=20):
+        '''
+        Return a dict mapping each of steps that has passed before, under
+        the same name, snap and channel, to how long we expect it to take:
+        the pth percentile of its last few runs that passed.
+
+        '''
+        expected = {}
+        for step in steps:
+            name, snap, channel = key(step)
+            seconds = self.percentile(name, p, snap, channel, last)
+            if seconds is not None:
+                expected[step] = seconds
+        return expected
+
+    def summary(self, p=90, last=20):
+        '''
+        Return an OrderedDict mapping each (step, snap, channel) that we
+        have runs of to a dict of its number of 'runs', 'failures', median
+        ('p50'), pth percentile, and 'trend', over its last runs that
+        passed.
+
+        '''
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT step, snap, channel, COUNT(*), '
+                'SUM(outcome != ?) FROM steps '
+                'GROUP BY step, snap, channel ORDER BY step, snap, channel',
+                ['passed']).fetchall()
+        summary = OrderedDict()
+        for step, snap, channel, runs, failures in rows:
+            summary[(step, snap, channel)] = {
+                'runs': runs,
+                'failures': failures,
+                'p50': self.percentile(step, 50, snap, channel, last),
+                'p{}'.format(p): self.percentile(
+                    step, p, snap, channel, last),
+                'trend': self.trend(step, snap, channel, last),
+            }
+        return summary
+
+
+def percentile(values, p):
+    '''
+    Return the pth percentile (0 to 100) of values, interpolating between
+    them, or None if there aren't any.
+
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
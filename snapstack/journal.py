@@ -0,0 +1,82 @@
+'''
+A journal of the Steps that have been deployed on this host, so that a
+Plan can pick up where a previous run left off.
+
+'''
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+def default_dir():
+    '''
+    Return the directory that snapstack keeps its state under.
+
+    '''
+    return os.environ.get('SNAPSTACK_STATE_DIR') or os.path.join(
+        os.environ.get('XDG_STATE_HOME') or
+        os.path.expanduser('~/.local/state'),
+        'snapstack')
+
+
+class Journal:
+    '''
+    Records the fingerprint of each Step that deployed successfully, in
+    a small json file. Safe to share between threads.
+
+    '''
+    def __init__(self, path=None):
+        '''
+        @param string path: The journal file. Defaults to journal.json
+          under SNAPSTACK_STATE_DIR, or ~/.local/state/snapstack.
+
+        '''
+        self.path = path or os.path.join(default_dir(), 'journal.json')
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def _save(self):
+        d = os.path.dirname(self.path)
+        os.makedirs(d, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=d)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._entries, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def matches(self, key, fingerprint):
+        '''
+        Return True if the Step at key last deployed with fingerprint.
+
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry['fingerprint'] == fingerprint
+
+    def record(self, key, fingerprint):
+        with self._lock:
+            self._entries[key] = {
+                'fingerprint': fingerprint,
+                'time': time.time(),
+            }
+            self._save()
+
+    def forget(self, *keys):
+        '''
+        Forget the given keys or, with no args, everything. Call this when
+        the things we've recorded are torn down.
+
+        '''
+        with self._lock:
+            if keys:
+                for key in keys:
+                    self._entries.pop(key, None)
+            else:
+                self._entries.clear()
+            self._save()
@@ -0,0 +1,207 @@
+'''
+Run the same tests across a matrix of snap channels, store and local
+builds, and confinement, sharing as much of the work between the cells
+of the matrix as we can.
+
+'''
+
+import concurrent.futures
+import itertools
+import logging
+import os
+from collections import OrderedDict
+
+from snapstack import base
+from snapstack.batch import Batch
+from snapstack.cache import BuildCache, FetchCache
+from snapstack.errors import InfraFailure
+from snapstack.fetch import Fetcher
+from snapstack.plan import Plan
+from snapstack.trace import Tracer
+
+
+# The Step params that a Matrix can vary, in the order that they vary
+# across cells, slowest first.
+AXES = ['channel', 'snap_store', 'classic']
+
+
+class Matrix:
+    '''
+    Expands a set of tests into a Plan for each cell of a matrix: each
+    combination of the values given for each axis.
+
+    Cells share whatever they can. Every remote file is fetched once, and
+    every snap built from local source is built once, for the whole
+    matrix. Cells with the same base deploy it once between them (see
+    Batch), and a snap that the next cell installs from the same channel,
+    with the same flags, is left installed rather than reinstalled.
+
+    Cells that share a host run one after another, as they'd get in each
+    other's way. Give a Matrix hosts to spread the cells across them, and
+    run them concurrently.
+
+    The downloads that cells share are timed by the Matrix's tracer, as
+    they don't belong to any one cell's Plan.
+
+    '''
+    def __init__(self, tests, axes, test_cleanup=None, base_setup=None,
+                 base_cleanup=None, vary=None, hosts=None, cache=None,
+                 build_cache=None, keep_base=None, **kwargs):
+        '''
+        @param list tests: Step objects, as for Plan. Each cell gets copies.
+        @param dict axes: Maps one or more of AXES to a list of values to
+          test; for example {'channel': ['ocata/edge', 'pike/edge'],
+          'snap_store': [True, False]}.
+        @param list test_cleanup: As for Plan.
+        @param list base_setup: As for Plan. Defaults to a base.Setup.
+        @param list base_cleanup: As for Plan. Defaults to a base.Cleanup.
+        @param list vary: Names (or snaps) of the tests that the axes apply
+          to. Defaults to every test that installs a snap.
+        @param list hosts: transport.Transport objects to spread the cells
+          across; each runs its share of cells, in order, on its own. By
+          default, every cell runs on this host.
+        @param cache.FetchCache cache: Shared by every cell.
+        @param cache.BuildCache build_cache: Shared by every cell.
+        @param bool keep_base: As for Batch.
+        @param kwargs: Passed along to each Plan.
+
+        '''
+        unknown = set(axes) - set(AXES)
+        if unknown:
+            raise InfraFailure('Cannot vary {} across a Matrix'.format(
+                ', '.join(sorted(unknown))))
+
+        self.log = logging.getLogger()
+        self.axes = OrderedDict((a, list(axes[a])) for a in AXES if a in axes)
+        self.hosts = list(hosts or [])
+        self.keep_base = keep_base
+        self._tests = tests
+        self._test_cleanup = test_cleanup or []
+        self._base_setup = base_setup
+        self._base_cleanup = base_cleanup
+        self._vary = vary
+        self._kwargs = kwargs
+
+        self._cache = FetchCache() if cache is None else cache
+        self._build_cache = BuildCache() if build_cache is None \
+            else build_cache
+        self.tracer = Tracer()
+        self._fetcher = Fetcher(
+            cache=self._cache,
+            http_proxy=os.environ.get('SNAPSTACK_HTTP_PROXY'),
+            https_proxy=os.environ.get('SNAPSTACK_HTTPS_PROXY'),
+            tracer=self.tracer)
+
+    def cells(self):
+        '''
+        Return a list of OrderedDicts, one per cell, mapping each axis to
+        its value in that cell.
+
+        '''
+        return [OrderedDict(zip(self.axes, values))
+                for values in itertools.product(*self.axes.values())]
+
+    @staticmethod
+    def label(cell):
+        '''
+        Return a name for cell, such as "channel=pike/edge classic=True".
+
+        '''
+        return ' '.join('{}={}'.format(k, v) for k, v in cell.items())
+
+    def _varies(self, step):
+        if self._vary is None:
+            return bool(step.snap)
+        return step.name in self._vary or step.snap in self._vary
+
+    def plan(self, cell, host=None):
+        '''
+        Return a Plan for cell, on host, a transport.Transport, or this
+        host if None.
+
+        '''
+        tests = [step.variant(**cell) if self._varies(step) else step.clone()
+                 for step in self._tests]
+        base_setup = base.Setup().steps() if self._base_setup is None \
+            else [step.clone() for step in self._base_setup]
+        base_cleanup = base.Cleanup().steps() if self._base_cleanup is None \
+            else [step.clone() for step in self._base_cleanup]
+        test_cleanup = [step.clone() for step in self._test_cleanup]
+
+        kwargs = dict(self._kwargs)
+        if host is not None:
+            kwargs['hosts'] = [host]
+            for step in tests + test_cleanup + base_setup + base_cleanup:
+                step.host = host.name
+
+        return Plan(
+            tests=tests,
+            test_cleanup=test_cleanup,
+            base_setup=base_setup,
+            base_cleanup=base_cleanup,
+            cache=self._cache,
+            build_cache=self._build_cache,
+            fetcher=self._fetcher,
+            name=self.label(cell),
+            **kwargs)
+
+    def _assign(self, cells):
+        '''
+        Split cells into one contiguous run per host, so that neighbouring
+        cells, which have the most in common, share a host.
+
+        '''
+        workers = self.hosts or [None]
+        size = -(-len(cells) // len(workers))  # Round up.
+        return [(host, cells[i * size:(i + 1) * size])
+                for i, host in enumerate(workers)
+                if cells[i * size:(i + 1) * size]]
+
+    def run(self):
+        '''
+        Run every cell, carrying on past failures, and return an
+        OrderedDict mapping each cell's label to the list of exceptions
+        that its Plan raised; an empty list means that it passed.
+
+        '''
+        work = [(host, [(cell, self.plan(cell, host)) for cell in cells])
+                for host, cells in self._assign(self.cells())]
+
+        # Start fetching everything that any cell needs, once.
+        urls = []
+        for _, plans in work:
+            for _, plan in plans:
+                for step in plan._all_steps():
+                    urls += step.remote_files()
+        self._fetcher.prefetch(urls, wait=False)
+
+        def run(plans):
+            return Batch([plan for _, plan in plans],
+                         keep_base=self.keep_base).run()
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(work)) as pool:
+            batches = [(plans, pool.submit(run, plans)) for _, plans in work]
+            results = OrderedDict()
+            for plans, future in batches:
+                errors = future.result()
+                for cell, plan in plans:
+                    results[self.label(cell)] = errors[plan]
+
+        self.log.info('Matrix results:\n' + self.summary(results))
+        return results
+
+    def summary(self, results):
+        '''
+        Return a plain text line per cell, saying whether it passed, and a
+        count of cells that passed.
+
+        '''
+        lines = []
+        for label, errors in results.items():
+            status = 'FAILED ({})'.format(
+                str(errors[0]).split('\n')[0]) if errors else 'passed'
+            lines.append('  {}: {}'.format(label, status))
+        passed = len([e for e in results.values() if not e])
+        lines.append('{} of {} cells passed'.format(passed, len(results)))
+        return '\n'.join(lines)
@@ -0,0 +1,186 @@
+'''
+Stream the output of the scripts that Steps run into a shared log, one
+prefixed line at a time, keeping only a bounded tail of each Step's
+output in memory.
+
+'''
+
+import asyncio
+import collections
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+
+OUTPUT_BYTES = 64 * 1024
+LINE_BYTES = 8 * 1024  # Longer lines are split.
+KILL_GRACE = 1.0  # Seconds to wait for output after killing a script.
+
+
+def output_bytes():
+    '''
+    Return the default cap, in bytes, on the output we keep per Step.
+
+    '''
+    return int(os.environ.get('SNAPSTACK_OUTPUT_BYTES') or OUTPUT_BYTES)
+
+
+class RingBuffer:
+    '''
+    Keeps the last max_bytes bytes written to it. Safe to share between
+    threads.
+
+    '''
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes or output_bytes()
+        self._chunks = collections.deque()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            self._chunks.append(data)
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                extra = self._size - self.max_bytes
+                first = self._chunks[0]
+                if len(first) <= extra:
+                    self._chunks.popleft()
+                    self._size -= len(first)
+                else:
+                    self._chunks[0] = first[extra:]
+                    self._size -= extra
+
+    def tail(self):
+        '''
+        Return what we have, decoded as best we can.
+
+        '''
+        with self._lock:
+            return b''.join(self._chunks).decode('utf-8', 'replace')
+
+
+class LogSink:
+    '''
+    The one place that script output goes. Lines from different Steps may
+    interleave, but never mix, and each is prefixed with its Step's label.
+
+    '''
+    def __init__(self, stream=None):
+        '''
+        @param stream: A text stream to write to. Defaults to sys.stdout at
+          the time of each write.
+
+        '''
+        self._stream = stream
+        self._lock = threading.Lock()
+
+    def write_line(self, label, line):
+        stream = self._stream or sys.stdout
+        text = line.decode('utf-8', 'replace').rstrip('\n')
+        with self._lock:
+            stream.write('[{}] {}\n'.format(label, text))
+            stream.flush()
+
+
+def _pump(pipe, label, sink, buffer):
+    for line in iter(lambda: pipe.readline(LINE_BYTES), b''):
+        buffer.write(line)
+        sink.write_line(label, line)
+    pipe.close()
+
+
+def _kill(proc):
+    '''
+    Kill proc and, if it leads its own process group, everything that it
+    started.
+
+    '''
+    try:
+        if os.getpgid(proc.pid) == proc.pid:
+            os.killpg(proc.pid, signal.SIGKILL)
+            return
+    except OSError:
+        pass
+    try:
+        proc.kill()
+    except OSError:
+        pass
+
+
+def run_script(cmd, label, sink, buffer, timeout=None, **kwargs):
+    '''
+    Run cmd, streaming its stdout and stderr, line by line, to sink, and
+    into buffer. Returns the exit code.
+
+    stderr goes to the same pipe as stdout, so that lines stay in the
+    order that cmd wrote them, and the error that explains a failure is
+    still in the tail when the script exits.
+
+    @param list cmd: The command to run, as for subprocess.Popen.
+    @param string label: The prefix for each line of output.
+    @param LogSink sink: Where the output goes.
+    @param RingBuffer buffer: Keeps the tail of the output.
+    @param float timeout: If given, kill cmd, and anything it started, if
+      it runs for longer than this many seconds, and raise
+      subprocess.TimeoutExpired.
+    @param kwargs: Passed along to subprocess.Popen.
+
+    '''
+    if timeout is not None:
+        kwargs['start_new_session'] = True
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+    pump = threading.Thread(target=_pump, args=(proc.stdout, label, sink,
+                                                buffer))
+    pump.daemon = True
+    pump.start()
+    try:
+        returncode = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill(proc)
+        proc.wait()
+        pump.join(KILL_GRACE)
+        raise
+    pump.join()
+    return returncode
+
+
+async def _apump(stream, label, sink, buffer):
+    while True:
+        try:
+            line = await stream.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:
+            line = e.partial
+        except asyncio.LimitOverrunError as e:
+            line = await stream.read(e.consumed)
+        if not line:
+            break
+        buffer.write(line)
+        sink.write_line(label, line)
+
+
+async def arun_script(cmd, label, sink, buffer, timeout=None, **kwargs):
+    '''
+    A coroutine that does what run_script does, with an asyncio
+    subprocess. If it is cancelled, or times out, it kills cmd, and
+    anything that cmd started, before it returns.
+
+    Raises asyncio.TimeoutError on timeout.
+
+    '''
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT, limit=LINE_BYTES,
+        start_new_session=True, **kwargs)
+    try:
+        await asyncio.wait_for(asyncio.gather(
+            _apump(proc.stdout, label, sink, buffer),
+            proc.wait()), timeout)
+    finally:
+        if proc.returncode is None:
+            _kill(proc)
+            await proc.wait()
+    return proc.returncode
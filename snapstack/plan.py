@@ -4,11 +4,115 @@ for a snap inside of a temporary Openstack environment.
 
 '''
 
+import asyncio
+import concurrent.futures
+import contextlib
+import logging
 import os
-import subprocess
 import tempfile
+import time
+from collections import Counter, OrderedDict
 
-from snapstack import base
+from snapstack import base, config, warm
+from snapstack.cache import BuildCache, FetchCache
+from snapstack.errors import CleanupFailure, InfraFailure, PreflightFailure
+from snapstack.facts import HostFacts
+from snapstack.fetch import Fetcher
+from snapstack.history import History
+from snapstack.journal import Journal
+from snapstack.output import LogSink
+from snapstack.render import Renderer
+from snapstack.resources import Sampler
+from snapstack.retry import RetryLog
+from snapstack.scheduler import Scheduler, predict, resolve
+from snapstack.snaps import SnapInstaller
+from snapstack.stage import Stager
+from snapstack.trace import Tracer
+from snapstack.transport import LOCAL, Transport
+
+
+def _env_seconds(name):
+    value = os.environ.get(name)
+    return float(value) if value else None
+
+
+def _name_steps(*groups):
+    '''
+    Name each Step, in groups of (steps, prefix), that hasn't got a name
+    after its snap, or <prefix>_<index> if it has none, adding a number
+    if another Step already has that name. Raise an InfraFailure if two
+    Steps were given the same name, as nothing could tell them apart.
+
+    '''
+    steps = [step for group, _ in groups for step in group]
+    named = Counter(
+        step.name for step in steps if step.name is not None)
+    duplicates = sorted(name for name, count in named.items() if count > 1)
+    if duplicates:
+        raise InfraFailure('More than one step is named {}'.format(
+            ', '.join('"{}"'.format(name) for name in duplicates)))
+
+    taken = set(named)
+    for group, prefix in groups:
+        for index, step in enumerate(group):
+            if step.name is not None:
+                continue
+            name = step.snap or '{}_{}'.format(prefix, index)
+            unique, n = name, 2
+            while unique in taken:
+                unique = '{}_{}'.format(name, n)
+                n += 1
+            step.name = unique
+            taken.add(unique)
+
+
+def _place(steps, placement):
+    '''
+    Put each of steps that placement names on the host, or hosts, given
+    for it. A Step placed on several hosts is replaced by a clone per host,
+    named <name>@<host>, which all run concurrently, and Steps that
+    required the original require every clone instead.
+
+    '''
+    placed = []
+    clones = {}
+    previous = None
+    for step in steps:
+        hosts = placement.get(step.name)
+        if isinstance(hosts, str):
+            hosts = [hosts]
+
+        requires = step.requires
+        if requires is None and previous is not None and \
+                previous.name in clones:
+            requires = clones[previous.name]
+
+        if not hosts:
+            step.requires = requires
+            placed.append(step)
+        elif len(hosts) == 1:
+            step.host = hosts[0]
+            step.requires = requires
+            placed.append(step)
+        else:
+            if requires is None and previous is not None and \
+                    previous.name is not None:
+                # Wait on the Step before, as the original would have, but
+                # not on each other.
+                requires = [previous.name]
+            clones[step.name] = []
+            for host in hosts:
+                clone = step.clone(name='{}@{}'.format(step.name, host),
+                                   host=host, requires=requires)
+                clones[step.name].append(clone.name)
+                placed.append(clone)
+        previous = step
+
+    for step in placed:
+        if step.requires is not None:
+            step.requires = [name for required in step.requires
+                             for name in clones.get(required, [required])]
+    return placed
 
 
 class Plan:
@@ -16,7 +120,12 @@ class Plan:
 
     '''
     def __init__(self, tests=None, test_cleanup=None, base_setup=None,
-                 base_cleanup=None):
+                 base_cleanup=None, max_workers=None, cache=None,
+                 resume=None, force=None, journal=None, warm_base=None,
+                 trace=None, step_timeout=None, script_timeout=None,
+                 build_cache=None, preflight=None, retries=None,
+                 hosts=None, placement=None, fetcher=None, name=None,
+                 history=None, sample_interval=None, variables=None):
         '''
         @param list tests: A list of Step objects, comprising tests
           for a snap or snaps.
@@ -30,8 +139,73 @@ class Plan:
         @param list base_cleanup: A list of Step objects, comprising general
           cleanup for snapstack. Similar to the above, you can customize
           this with a base.Cleanup object.
+        @param int max_workers: The most Steps to run at once during deploy.
+          Steps run in parallel only when they declare their requirements;
+          see Step's requires param. Defaults to SNAPSTACK_MAX_WORKERS, or
+          scheduler.MAX_WORKERS.
+        @param cache.FetchCache cache: Cache for remote files. Defaults to a
+          FetchCache in the default cache dir.
+        @param bool resume: If True, skip setup and test steps that have
+          already deployed successfully on this host, and whose fingerprints
+          haven't changed since. (Their files are still staged.) Steps that
+          depend on a step that does run are always run, too. Defaults to
+          SNAPSTACK_RESUME.
+        @param list force: Names of steps to run even if they're unchanged.
+          Everything that depends on them will run as well.
+        @param journal.Journal journal: Where to record deployed steps when
+          resuming. Defaults to a Journal in the default state dir.
+        @param warm_base: If True, or a warm.WarmBase, deploy the base once,
+          snapshot it, and leave it in place when the Plan is destroyed. The
+          next Plan with an identical base restores the snapshot instead of
+          redeploying. Defaults to SNAPSTACK_WARM_BASE.
+        @param string trace: A path to write a Chrome trace of the run to,
+          when run finishes. Defaults to SNAPSTACK_TRACE. A summary of
+          where the time went is logged either way.
+        @param float step_timeout: Fail any step that takes longer than this
+          many seconds, unless it sets its own timeout. Only enforced by
+          arun. Defaults to SNAPSTACK_STEP_TIMEOUT.
+        @param float script_timeout: Kill, and fail, any script that runs
+          for longer than this many seconds, unless its step sets its own
+          script_timeout. Defaults to SNAPSTACK_SCRIPT_TIMEOUT.
+        @param cache.BuildCache build_cache: Cache for snaps built from
+          local source. Defaults to a BuildCache in the default cache dir.
+        @param bool preflight: If False, don't run preflight before
+          deploying. Defaults to True, unless SNAPSTACK_SKIP_PREFLIGHT is
+          set.
+        @param dict retries: Maps an operation in retry.OPERATIONS ('fetch',
+          'install' or 'script') to the retry.Retry policy for our steps,
+          unless they set their own. Operations left out get
+          retry.default_policy. Retries are logged in the run report.
+        @param list hosts: transport.Transport objects, such as
+          transport.SSHTransport, for the other hosts that our Steps may run
+          on. This host is always available, as transport.LOCAL.
+        @param dict placement: Maps Step names to the name of the host, or
+          a list of the names of the hosts, that each should run on, in
+          setup, tests and cleanup. For example, {'nova_hypervisor': ['hv1',
+          'hv2']} runs the hypervisor steps on both hosts, concurrently.
+          Steps may also name their host themselves. Warm bases, and snaps
+          built from local source, only work on this host.
+        @param fetch.Fetcher fetcher: Fetches remote files. Pass one
+          Fetcher to several Plans to have each file fetched only once
+          between them. Defaults to a Fetcher of our own, using cache.
+        @param string name: What to call this Plan in logs and reports.
+          Defaults to the names of its tests.
+        @param history: If True, or a history.History, record how long each
+          step takes, and whether it passes, and use what previous runs
+          recorded to start the longest chains of steps first, and to
+          predict how long deploying will take. Defaults to
+          SNAPSTACK_HISTORY.
+        @param float sample_interval: If set, sample this host's CPU,
+          memory, disk and network use, and that of its snap services,
+          every this many seconds while we run, and report the peak and mean
+          for each step. Defaults to SNAPSTACK_SAMPLE_INTERVAL.
+        @param dict variables: Values for the variables in our steps' config
+          templates, such as {'db_host': '10.0.0.2'}, over the defaults in
+          config.TEMPLATE_VARS.
 
         '''
+        self.log = logging.getLogger()
+        self.name = name
         self._tempdir = tempfile.TemporaryDirectory()
         self.tempdir = self._tempdir.name
 
@@ -40,48 +214,748 @@ class Plan:
         self._base_cleanup = base.Cleanup().steps() if\
             base_cleanup is None else base_cleanup
 
-        self._tests = tests or []
-        self._test_cleanup = test_cleanup or []
+        # We name, place and configure our Steps, so work on copies of
+        # them, leaving the caller's free to go into other Plans.
+        self._base_setup = [step.clone() for step in self._base_setup]
+        self._base_cleanup = [step.clone() for step in self._base_cleanup]
+        self._tests = [step.clone() for step in tests or []]
+        self._test_cleanup = [step.clone() for step in test_cleanup or []]
+        # Steps are journaled, required and timed by name, so each needs
+        # one of its own.
+        _name_steps((self._base_setup, 'setup'), (self._tests, 'test'))
+        _name_steps((self._test_cleanup, 'test_cleanup'))
+        _name_steps((self._base_cleanup, 'cleanup'))
+
+        if placement:
+            self._base_setup = _place(self._base_setup, placement)
+            self._tests = _place(self._tests, placement)
+            self._test_cleanup = _place(self._test_cleanup, placement)
+            self._base_cleanup = _place(self._base_cleanup, placement)
 
         self._http_proxy = os.environ.get('SNAPSTACK_HTTP_PROXY')
         self._https_proxy = os.environ.get('SNAPSTACK_HTTPS_PROXY')
 
-    def deploy(self):
+        if max_workers is None and os.environ.get('SNAPSTACK_MAX_WORKERS'):
+            max_workers = int(os.environ['SNAPSTACK_MAX_WORKERS'])
+        self._scheduler = Scheduler(max_workers=max_workers)
+        self.tracer = Tracer()
+        self._trace = trace or os.environ.get('SNAPSTACK_TRACE')
+        self._cache = FetchCache() if cache is None else cache
+        self._build_cache = BuildCache() if build_cache is None \
+            else build_cache
+        self._fetcher = fetcher or Fetcher(
+            cache=self._cache,
+            http_proxy=self._http_proxy,
+            https_proxy=self._https_proxy,
+            tracer=self.tracer)
+        self._facts = HostFacts()
+        self._installer = SnapInstaller(self._facts)
+        self._transports = OrderedDict([(LOCAL, Transport())])
+        self._host_facts = {LOCAL: self._facts}
+        self._installers = {LOCAL: self._installer}
+        for transport in hosts or []:
+            facts = HostFacts(transport)
+            self._transports[transport.name] = transport
+            self._host_facts[transport.name] = facts
+            self._installers[transport.name] = SnapInstaller(
+                facts, transport)
+        self._connected = False
+        for step in self._all_steps():
+            if (step.host or LOCAL) not in self._transports:
+                raise InfraFailure(
+                    'Step {} is placed on unknown host {}'.format(
+                        step.label, step.host))
+        self._sink = LogSink()
+        self._stager = Stager()
+        self._renderer = Renderer()
+        self._variables = dict(variables or {})
+        self._retries = retries or {}
+        self.retry_log = RetryLog()
+        self._step_timeout = step_timeout or _env_seconds(
+            'SNAPSTACK_STEP_TIMEOUT')
+        self._script_timeout = script_timeout or _env_seconds(
+            'SNAPSTACK_SCRIPT_TIMEOUT')
+
+        if resume is None:
+            resume = config.env_flag('SNAPSTACK_RESUME')
+        self._journal = None
+        if resume:
+            self._journal = Journal() if journal is None else journal
+        self._force = set(force or [])
+
+        if history is None:
+            history = config.env_flag('SNAPSTACK_HISTORY')
+        if history is True:
+            history = History()
+        self._history = history or None
+        self._expected = {}
+
+        sample_interval = sample_interval or _env_seconds(
+            'SNAPSTACK_SAMPLE_INTERVAL')
+        self.sampler = Sampler(self.tracer, sample_interval) \
+            if sample_interval else None
+
+        if warm_base is None:
+            warm_base = config.env_flag('SNAPSTACK_WARM_BASE')
+        if warm_base is True:
+            warm_base = warm.WarmBase()
+        self._warm = warm_base or None
+        if preflight is None:
+            preflight = not config.env_flag('SNAPSTACK_SKIP_PREFLIGHT')
+        self._preflight = preflight
+        self._keys = {}
+        self._deps = {}
+        self._ran = set()
+
+    @property
+    def label(self):
+        '''
+        A name to show for this Plan in logs and reports: our name, or the
+        names of our tests.
+
+        '''
+        return self.name or ', '.join(
+            step.name for step in self._tests) or 'base'
+
+    def _all_steps(self):
+        return (self._base_setup + self._tests + self._test_cleanup +
+                self._base_cleanup)
+
+    def step(self, name):
+        '''
+        Return the Step named name, as we run it, to see how it went: the
+        config files that it changed, and the tail of its output. We run
+        copies of the Steps that we're given, so the originals don't
+        change. Setup and test steps are looked for before cleanup steps,
+        which may share their names. Raises a KeyError if we have none.
+
+        '''
+        for step in self._all_steps():
+            if step.name == name:
+                return step
+        raise KeyError(name)
+
+    def prefetch(self, wait=True):
+        '''
+        Download the remote scripts and files for every step in the plan,
+        concurrently. Steps will then read them from local disk.
+
+        @param bool wait: If False, let the downloads carry on in the
+          background. A step that needs a file that is still on its way
+          will wait for it.
+
+        '''
+        urls = []
+        for step in self._all_steps():
+            urls += step.remote_files()
+        self._fetcher.prefetch(urls, wait=wait)
+
+    def preflight(self):
+        '''
+        Check, before we deploy anything, that our steps will find what
+        they need: that every script_loc resolves, that local scripts and
+        files exist, that remote ones answer a HEAD request, that every
+        store snap and channel exists, and that no steps depend on each
+        other in a cycle. Remote files and snaps are checked concurrently.
+
+        Raises a PreflightFailure listing every problem found, rather than
+        just the first.
+
+        '''
+        problems = []
+        for steps, done in self._phases():
+            try:
+                resolve(steps, done)
+            except InfraFailure as e:
+                problems.append(str(e))
+
+        urls = []
+        for step in self._all_steps():
+            # Steps check themselves against the host that they'll run on.
+            step.configure(**self._step_kwargs(step))
+            step_problems = step.check()
+            problems += step_problems
+            if not step_problems:
+                urls += step.remote_files()
+
+        self._connect()
+        hosts = self._by_host(self._base_setup + self._tests)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(hosts) + 1) as pool:
+            remote = pool.submit(self._fetcher.check, urls)
+            snaps = [pool.submit(self._installers[host].check, steps)
+                     for host, steps in hosts.items()]
+            problems += remote.result()
+            for future in snaps:
+                problems += future.result()
+
+        if problems:
+            raise PreflightFailure(problems)
+
+    def deploy(self, base=True, tests=True):
         '''
         Deploy the snaps in our plan, and run any auxillary scripts.
 
+        Remote files are prefetched in the background while the first steps
+        run. Each step's store snap starts installing as soon as the steps
+        it requires have finished, alongside the snaps of any other steps
+        that became ready with it. Independent steps run concurrently. If
+        any step fails, no further steps are started, and the first failure
+        is raised once the steps already in flight have finished.
+
+        @param bool base: If False, assume that our base is already
+          deployed, by another Plan with the same base, and only stage its
+          files for our tests.
+        @param bool tests: If False, only deploy the base.
+
+        '''
+        steps = self._begin_deploy(base, tests)
+
+        if not base:
+            self._stage_base()
+        if self._warm is None or not base:
+            self._scheduler.run(steps, self._deploy_step,
+                                durations=self._expected,
+                                done=self._done(base),
+                                on_ready=self._start_installs)
+            self._cache.flush()
+            return
+
+        fingerprint = self._warm_fingerprint()
+        if not self._restore_warm(fingerprint):
+            self._teardown_stale_warm()
+            self._scheduler.run(self._base_setup, self._deploy_step,
+                                durations=self._expected,
+                                on_ready=self._start_installs)
+            self._capture_warm(fingerprint)
+
+        if tests:
+            self._scheduler.run(self._tests, self._deploy_step,
+                                durations=self._expected,
+                                done=self._done(False),
+                                on_ready=self._start_installs)
+        self._cache.flush()
+
+    async def adeploy(self, base=True, tests=True):
+        '''
+        A coroutine that does what deploy does, running steps as tasks on
+        the current event loop. If it is cancelled, the steps in flight are
+        cancelled, and their scripts killed.
+
+        '''
+        loop = asyncio.get_event_loop()
+        steps = self._begin_deploy(base, tests)
+
+        if not base:
+            await loop.run_in_executor(None, self._stage_base)
+        if self._warm is None or not base:
+            await self._scheduler.arun(steps, self._adeploy_step,
+                                       durations=self._expected,
+                                       done=self._done(base),
+                                       on_ready=self._start_installs)
+            self._cache.flush()
+            return
+
+        fingerprint = await loop.run_in_executor(None, self._warm_fingerprint)
+        restored = await loop.run_in_executor(
+            None, self._restore_warm, fingerprint)
+        if not restored:
+            await loop.run_in_executor(None, self._teardown_stale_warm)
+            await self._scheduler.arun(
+                self._base_setup, self._adeploy_step,
+                durations=self._expected, on_ready=self._start_installs)
+            await loop.run_in_executor(None, self._capture_warm, fingerprint)
+
+        if tests:
+            await self._scheduler.arun(self._tests, self._adeploy_step,
+                                       durations=self._expected,
+                                       done=self._done(False),
+                                       on_ready=self._start_installs)
+        self._cache.flush()
+
+    def _begin_deploy(self, base, tests):
+        steps = ((self._base_setup if base else []) +
+                 (self._tests if tests else []))
+        self._keys = {step: 'setup:{}'.format(step.name)
+                      for step in self._base_setup}
+        self._keys.update({step: 'test:{}'.format(step.name)
+                           for step in self._tests})
+        self._deps = resolve(self._base_setup + self._tests)
+        if base:
+            self._ran = set()
+
+        if self._history is not None:
+            self._expected = self._history.expected(self._all_steps())
+            self.log.info(
+                'Expecting to deploy in about {:.0f}s ({} of {} steps have '
+                'run before).'.format(
+                    predict(steps, self._expected,
+                            self._scheduler.max_workers, self._done(base)),
+                    len([s for s in steps if s in self._expected]),
+                    len(steps)))
+
+        self._connect()
+        self.prefetch(wait=False)
+        return steps
+
+    def _start_installs(self, steps):
+        '''
+        Start installing the store snaps of steps, which the scheduler has
+        just found ready to run, in the background. Snaps of steps that
+        become ready together are queued with snapd together, but never
+        before the steps that they require have finished, as those may
+        set up snapd, or the snaps it needs, themselves.
+
+        '''
+        for host, host_steps in self._by_host(steps).items():
+            self._installers[host].start(host_steps)
+
+    def _done(self, base):
+        '''
+        Return the names of the steps that have finished before we deploy
+        our tests: none if we're deploying our base along with them, else
+        those of our base.
+
+        '''
+        return [] if base else [step.name for step in self._base_setup]
+
+    def _phases(self):
+        '''
+        Return a list of (steps, done) for each phase of a run, in order:
+        deploying, test cleanup and base cleanup. done names the steps of
+        the phases before, which the steps of each phase may require.
+
+        '''
+        setup = self._base_setup + self._tests
+        names = [step.name for step in setup]
+        return [
+            (setup, []),
+            (self._test_cleanup, names),
+            (self._base_cleanup,
+             names + [step.name for step in self._test_cleanup]),
+        ]
+
+    def _by_host(self, steps):
+        '''
+        Return an OrderedDict mapping the name of each host to the ones of
+        steps that run on it.
+
+        '''
+        hosts = OrderedDict()
+        for step in steps:
+            hosts.setdefault(step.host or LOCAL, []).append(step)
+        return hosts
+
+    def _connect(self):
+        '''
+        Connect to all of our remote hosts at once, so that adding hosts
+        doesn't add to the time that it takes to get going.
+
+        '''
+        if self._connected:
+            return
+        remote = [t for t in self._transports.values() if t.remote]
+        if remote:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(remote)) as pool:
+                list(pool.map(lambda t: t.connect(), remote))
+        self._connected = True
+
+    @contextlib.contextmanager
+    def sampling(self):
+        '''
+        Sample resource use for the body of a with statement, if we were
+        asked to. run does this for us.
+
         '''
-        for step in self._base_setup + self._tests:
-            step.run(
-                tempdir=self._tempdir,
-                http_proxy=self._http_proxy,
-                https_proxy=self._https_proxy)
+        if self.sampler is None:
+            yield
+            return
+        self.sampler.start()
+        try:
+            yield
+        finally:
+            self.sampler.stop()
+
+    def close(self):
+        '''
+        Close our connections to remote hosts. run does this for us.
+
+        '''
+        for transport in self._transports.values():
+            transport.close()
+        self._connected = False
+
+    def _stage_base(self):
+        for step in self._base_setup:
+            step.stage(**self._step_kwargs(step))
+
+    def base_fingerprint(self):
+        '''
+        Return a fingerprint of our base setup and cleanup. Plans with the
+        same base fingerprint can share one deployment of their base.
+
+        '''
+        steps = self._base_setup + self._base_cleanup
+        for step in steps:
+            step.configure(**self._step_kwargs(step))
+        return warm.fingerprint(steps)
+
+    def _warm_fingerprint(self):
+        for step in self._base_setup:
+            step.configure(**self._step_kwargs(step))
+        return warm.fingerprint(self._base_setup)
+
+    def _restore_warm(self, fingerprint):
+        '''
+        Restore our warm base, if it matches fingerprint. Return True if we
+        did.
+
+        '''
+        if not self._warm.matches(fingerprint, self._facts.installed_snaps):
+            return False
+        self.log.info('Restoring warm base.')
+        self._warm.restore()
+        for step in self._base_setup:
+            step.stage()
+        return True
+
+    def _teardown_stale_warm(self):
+        '''
+        If our warm base holds some other base, one that we couldn't
+        restore, tear it down, by running our base cleanup and removing its
+        snaps, so that we deploy our base from scratch rather than on top
+        of it.
+
+        '''
+        manifest = self._warm.manifest
+        if manifest is None:
+            return
+        self.log.info('Tearing down stale warm base.')
+        steps, done = self._phases()[2]
+        errors = [e for _, e in self._scheduler.run(
+            steps, self._run_step, fail_fast=False, done=done)]
+        errors += self._installer.remove(manifest['snaps'])
+        self._warm.discard()
+        if self._journal is not None:
+            self._journal.forget()
+        if errors:
+            raise InfraFailure(
+                'Failed to tear down stale warm base: {}'.format(
+                    '; '.join(str(e) for e in errors)))
+
+    def _capture_warm(self, fingerprint):
+        self._warm.capture(
+            fingerprint, [s.snap for s in self._base_setup if s.snap])
+
+    def _step_kwargs(self, step):
+        host = step.host or LOCAL
+        return {
+            'tempdir': self._tempdir,
+            'http_proxy': self._http_proxy,
+            'https_proxy': self._https_proxy,
+            'fetcher': self._fetcher,
+            'facts': self._host_facts[host],
+            'installer': self._installers[host],
+            'transport': self._transports[host],
+            'tracer': self.tracer,
+            'sink': self._sink,
+            'build_cache': self._build_cache,
+            'stager': self._stager,
+            'step_timeout': self._step_timeout,
+            'script_timeout': self._script_timeout,
+            'retries': self._retries,
+            'retry_log': self.retry_log,
+            'variables': self._variables,
+            'renderer': self._renderer,
+        }
+
+    def _run_step(self, step):
+        start = time.time()
+        try:
+            step.run(**self._step_kwargs(step))
+        except Exception:
+            self._remember(step, start, 'failed')
+            raise
+        self._remember(step, start, 'passed')
+
+    async def _arun_step(self, step):
+        start = time.time()
+        try:
+            await step.arun(**self._step_kwargs(step))
+        except Exception:
+            self._remember(step, start, 'failed')
+            raise
+        self._remember(step, start, 'passed')
+
+    def _remember(self, step, start, outcome):
+        if self._history is None:
+            return
+        self._history.record(step, time.time() - start, outcome,
+                             plan=self.label, host=step.host, started=start)
+
+    def predict(self, max_workers=None, base=True, tests=True):
+        '''
+        Return how many seconds we expect deploy to take, going by how long
+        each step took in previous runs (steps that haven't run before
+        count as a typical step), or None if we don't keep a history.
+
+        @param int max_workers: Predict for this many workers, rather than
+          for our own. Compare a few, to size the pool.
+        @param bool base: As for deploy.
+        @param bool tests: As for deploy.
+
+        '''
+        if self._history is None:
+            return None
+        steps = ((self._base_setup if base else []) +
+                 (self._tests if tests else []))
+        return predict(steps, self._history.expected(steps),
+                       max_workers or self._scheduler.max_workers,
+                       self._done(base))
+
+    def _deploy_step(self, step):
+        '''
+        Run a setup or test step, unless we're resuming, and it has already
+        been deployed.
+
+        '''
+        if self._unchanged(step):
+            return
+        self._run_step(step)
+        self._record(step)
+
+    async def _adeploy_step(self, step):
+        loop = asyncio.get_event_loop()
+        if await loop.run_in_executor(None, self._unchanged, step):
+            return
+        await self._arun_step(step)
+        await loop.run_in_executor(None, self._record, step)
+
+    def _unchanged(self, step):
+        '''
+        If we're resuming, and step has already been deployed, stage its
+        files and return True.
+
+        '''
+        if self._journal is None:
+            return False
+
+        step.configure(**self._step_kwargs(step))
+        unchanged = (
+            step.name not in self._force and
+            not any(dep in self._ran for dep in self._deps[step]) and
+            self._journal.matches(self._keys[step], step.fingerprint()))
 
-    def destroy(self):
+        if unchanged:
+            self.log.info('Skipping unchanged step {}'.format(step.name))
+            step.stage()
+        return unchanged
+
+    def _record(self, step):
+        if self._journal is None:
+            return
+        self._ran.add(step)
+        self._journal.record(self._keys[step], step.fingerprint())
+
+    def destroy(self, keep_base=None, keep_snaps=None):
         '''
         Run any cleanup scripts that we have specified and remove any
         snaps that we have installed.
 
+        Test cleanup runs before base cleanup. Within each, independent
+        steps run concurrently. Every cleanup step runs, even if others
+        fail, and then all of our snaps that are still installed are
+        removed in one go. Any errors are raised together at the end, as a
+        CleanupFailure.
+
+        @param bool keep_base: If True, only clean up after the tests, and
+          leave the base deployed. Defaults to True if we have a warm base.
+          If False, tear everything down, and discard any warm base.
+        @param set keep_snaps: (host, snap) pairs for snaps to leave
+          installed, because the next Plan will install them just the same.
+          Hosts are as in Step's host; None for this host.
+
         '''
+        keep_base = self._keep_base(keep_base)
+        errors = []
+        for steps, done in self._cleanup_steps(keep_base):
+            errors += [e for _, e in self._scheduler.run(
+                steps, self._run_step, fail_fast=False,
+                durations=self._expected, done=done)]
+        self._finish_destroy(keep_base, errors, keep_snaps)
 
-        for step in self._test_cleanup:
-            step.run(tempdir=self._tempdir)
+    async def adestroy(self, keep_base=None, keep_snaps=None):
+        '''
+        A coroutine that does what destroy does, running cleanup steps as
+        tasks on the current event loop.
 
-        for step in self._base_cleanup:
-            step.run(tempdir=self._tempdir)
+        '''
+        keep_base = self._keep_base(keep_base)
+        errors = []
+        for steps, done in self._cleanup_steps(keep_base):
+            errors += [e for _, e in await self._scheduler.arun(
+                steps, self._arun_step, fail_fast=False,
+                durations=self._expected, done=done)]
+        await asyncio.get_event_loop().run_in_executor(
+            None, self._finish_destroy, keep_base, errors, keep_snaps)
 
-        for step in self._base_setup + self._tests:
-            if not step.snap:
-                continue
-            subprocess.run(['sudo', 'snap', 'remove', step.snap])
+    def _keep_base(self, keep_base):
+        if keep_base is None:
+            return self._warm is not None
+        return keep_base
+
+    def _cleanup_steps(self, keep_base):
+        phases = self._phases()
+        return phases[1:] if not keep_base else phases[1:2]
+
+    def _finish_destroy(self, keep_base, errors, keep_snaps=None):
+        '''
+        Remove our snaps, apart from keep_snaps, forget what we deployed,
+        and raise errors, plus any more that we run into, as a
+        CleanupFailure.
+
+        '''
+        steps = self._tests if keep_base else self._base_setup + self._tests
+        keep = set(keep_snaps or [])
+        if keep_base:
+            keep |= set((s.host, s.snap) for s in self._base_setup)
+        errors = errors + self._remove_snaps([
+            step for step in steps
+            if step.snap and (step.host, step.snap) not in keep])
+
+        if self._journal is not None:
+            if keep_base:
+                self._journal.forget(
+                    *['test:{}'.format(s.name) for s in self._tests])
+            else:
+                self._journal.forget()
+
+        if self._warm is not None and not keep_base:
+            self._warm.discard()
+
+        if errors:
+            raise CleanupFailure(errors)
+
+    def _test_installs(self):
+        '''
+        Return a set of (host, snap, install flags) for the store snaps
+        that our tests install.
+
+        '''
+        return set((step.host, step.snap, tuple(step.install_flags()))
+                   for step in self._tests if step.from_store)
+
+    def _remove_snaps(self, steps):
+        '''
+        Remove the snaps of steps from the hosts that they're on, one host
+        at a time. Returns a list of errors.
+
+        '''
+        errors = []
+        for host, host_steps in self._by_host(steps).items():
+            errors += self._installers[host].remove(
+                [step.snap for step in host_steps])
+        return errors
+
+    def destroy_base(self):
+        '''
+        Tear down our base, once destroy(keep_base=True) has cleaned up
+        after our tests: run base cleanup, remove the base's snaps, and
+        discard any warm base. Errors are raised together, as a
+        CleanupFailure.
+
+        '''
+        steps, done = self._phases()[2]
+        errors = [e for _, e in self._scheduler.run(
+            steps, self._run_step, fail_fast=False,
+            durations=self._expected, done=done)]
+        errors += self._remove_snaps(
+            [step for step in self._base_setup if step.snap])
+
+        if self._journal is not None:
+            self._journal.forget()
+        if self._warm is not None:
+            self._warm.discard()
+
+        if errors:
+            raise CleanupFailure(errors)
 
     def run(self, cleanup=True):
         '''
         Execute all of our steps. Cleanup may be skipped.
 
+        Unless we were told not to, we run preflight first, and deploy
+        nothing if it finds problems.
+
         '''
+        if self._preflight:
+            try:
+                with self.tracer.span('preflight', 'plan'):
+                    self.preflight()
+            except BaseException:
+                self.close()
+                raise
         try:
-            self.deploy()
+            with self.sampling():
+                try:
+                    with self.tracer.span('deploy', 'plan'):
+                        self.deploy()
+                finally:
+                    if cleanup:
+                        with self.tracer.span('destroy', 'plan'):
+                            self.destroy()
         finally:
-            if cleanup:
-                self.destroy()
+            self.close()
+            self.report()
+
+    async def arun(self, cleanup=True):
+        '''
+        A coroutine that does what run does, so that Plans can be driven
+        from an existing event loop, several at a time:
+
+            await asyncio.gather(plan_a.arun(), plan_b.arun())
+
+        Cleanup still runs if we're cancelled while deploying, though
+        cancelling us again will interrupt it.
+
+        '''
+        if self._preflight:
+            try:
+                with self.tracer.span('preflight', 'plan'):
+                    await asyncio.get_event_loop().run_in_executor(
+                        None, self.preflight)
+            except BaseException:
+                self.close()
+                raise
+        try:
+            with self.sampling():
+                try:
+                    with self.tracer.span('deploy', 'plan'):
+                        await self.adeploy()
+                finally:
+                    if cleanup:
+                        with self.tracer.span('destroy', 'plan'):
+                            await self.adestroy()
+        finally:
+            self.close()
+            self.report()
+
+    def report(self):
+        '''
+        Log a summary of where the time went, and of anything that we had
+        to retry, and write out a Chrome trace if we were asked for one.
+
+        '''
+        self._cache.flush()
+        self.log.info('Step timings:\n' + self.tracer.summary())
+        if self.retry_log.retries:
+            self.log.info('Retries:\n' + self.retry_log.summary())
+        if any(self._renderer.counts.values()):
+            self.log.info(
+                'Config templates: {changed} changed, {unchanged} '
+                'unchanged.'.format(**self._renderer.counts))
+        if self.sampler is not None and self.sampler.stats():
+            self.log.info('Resource usage:\n' + self.sampler.summary())
+        if self._trace:
+            self.tracer.write(self._trace)
@@ -0,0 +1,234 @@
+'''
+Conditions that a Step can wait on, once its scripts have run, before
+the Steps that depend on it start: a port accepting connections, an
+HTTP endpoint answering, a systemd unit running, or a command
+succeeding. Conditions are polled concurrently, with exponential
+backoff, until they all hold or a deadline passes.
+
+A Step checks its conditions on the host that it runs on: commands go
+through its Transport, and ports default to its host.
+
+'''
+
+import asyncio
+import concurrent.futures
+import copy
+import os
+import socket
+import subprocess
+import time
+
+import requests
+
+
+READY_TIMEOUT = 300.0  # Seconds to wait for a Step's conditions.
+FIRST_DELAY = 0.1  # Seconds between the first two polls.
+MAX_DELAY = 5.0  # The longest we back off to between polls.
+CHECK_TIMEOUT = 5.0  # Seconds to allow a single connection or request.
+
+
+def ready_timeout():
+    '''
+    Return the default deadline, in seconds, for a Step's conditions.
+
+    '''
+    return float(os.environ.get('SNAPSTACK_READY_TIMEOUT') or READY_TIMEOUT)
+
+
+class Condition:
+    '''
+    Something that will be true once a service is up. Subclasses
+    implement check, which must return True or False, and never raise.
+
+    '''
+    transport = None  # Where to check; None for this host.
+
+    def on(self, transport):
+        '''
+        Return a copy of this condition that checks the host that
+        transport reaches.
+
+        '''
+        condition = copy.copy(self)
+        condition.transport = transport
+        return condition
+
+    def check(self):
+        raise NotImplementedError()
+
+
+class Port(Condition):
+    '''
+    Holds once something accepts TCP connections on a port.
+
+    '''
+    def __init__(self, port, host=None):
+        '''
+        @param int port: The port to connect to.
+        @param string host: The host to connect to. Defaults to the one
+          that we check, or localhost.
+
+        '''
+        self.port = port
+        self.host = host
+
+    def _host(self):
+        if self.host is not None:
+            return self.host
+        return getattr(self.transport, 'host', None) or 'localhost'
+
+    def check(self):
+        try:
+            with socket.create_connection((self._host(), self.port),
+                                          timeout=CHECK_TIMEOUT):
+                return True
+        except OSError:
+            return False
+
+    def __str__(self):
+        return 'port {}:{}'.format(self._host(), self.port)
+
+
+class Http(Condition):
+    '''
+    Holds once a GET of a url returns a 2xx response.
+
+    '''
+    def __init__(self, url, verify=True):
+        '''
+        @param string url: What to GET. Proxies are ignored, as the
+          services that we wait on are usually local.
+        @param bool verify: If False, don't verify TLS certificates.
+
+        '''
+        self.url = url
+        self.verify = verify
+        self._session = requests.Session()
+        self._session.trust_env = False
+
+    def check(self):
+        try:
+            response = self._session.get(
+                self.url, timeout=CHECK_TIMEOUT, verify=self.verify)
+            response.close()
+        except requests.RequestException:
+            return False
+        return 200 <= response.status_code < 300
+
+    def __str__(self):
+        return 'http {}'.format(self.url)
+
+
+class Command(Condition):
+    '''
+    Holds once a command exits 0, on the host that we check.
+
+    '''
+    def __init__(self, cmd, **kwargs):
+        '''
+        @param list cmd: The command to run, as for subprocess.run.
+        @param kwargs: Passed along to subprocess.run.
+
+        '''
+        self.cmd = cmd
+        self.kwargs = kwargs
+
+    def check(self):
+        cmd, kwargs = self.cmd, dict(self.kwargs)
+        if self.transport is not None:
+            cmd, kwargs['env'] = self.transport.command(
+                cmd, kwargs.pop('env', None))
+        try:
+            p = subprocess.run(
+                cmd, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL, **kwargs)
+        except OSError:
+            return False
+        return p.returncode == 0
+
+    def __str__(self):
+        return 'command "{}"'.format(' '.join(self.cmd))
+
+
+class Unit(Command):
+    '''
+    Holds once a systemd unit is active.
+
+    '''
+    def __init__(self, unit):
+        super(Unit, self).__init__(['systemctl', 'is-active', '--quiet', unit])
+        self.unit = unit
+
+    def __str__(self):
+        return 'unit {}'.format(self.unit)
+
+
+def _delays(deadline):
+    '''
+    Yield how long to sleep between polls, doubling each time up to
+    MAX_DELAY, and never past deadline. Stops once deadline has passed.
+
+    '''
+    delay = FIRST_DELAY
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        yield min(delay, remaining)
+        delay = min(delay * 2, MAX_DELAY)
+
+
+def _poll(condition, deadline):
+    if condition.check():
+        return True
+    for delay in _delays(deadline):
+        time.sleep(delay)
+        if condition.check():
+            return True
+    return False
+
+
+async def _apoll(condition, deadline):
+    loop = asyncio.get_event_loop()
+    if await loop.run_in_executor(None, condition.check):
+        return True
+    for delay in _delays(deadline):
+        await asyncio.sleep(delay)
+        if await loop.run_in_executor(None, condition.check):
+            return True
+    return False
+
+
+def wait_ready(conditions, timeout=None):
+    '''
+    Poll conditions, concurrently, until they all hold, or timeout
+    seconds have passed. Returns a list of the conditions that never
+    held; an empty list means that we're ready.
+
+    @param list conditions: Condition objects.
+    @param float timeout: Defaults to SNAPSTACK_READY_TIMEOUT, or
+      READY_TIMEOUT.
+
+    '''
+    if not conditions:
+        return []
+    deadline = time.monotonic() + (timeout or ready_timeout())
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(conditions)) as pool:
+        results = list(pool.map(
+            lambda c: _poll(c, deadline), conditions))
+    return [c for c, ready in zip(conditions, results) if not ready]
+
+
+async def await_ready(conditions, timeout=None):
+    '''
+    A coroutine that does what wait_ready does, sleeping on the event loop
+    between polls, so that it can be cancelled.
+
+    '''
+    if not conditions:
+        return []
+    deadline = time.monotonic() + (timeout or ready_timeout())
+    results = await asyncio.gather(
+        *[_apoll(c, deadline) for c in conditions])
+    return [c for c, ready in zip(conditions, results) if not ready]
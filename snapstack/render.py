@@ -0,0 +1,177 @@
+'''
+Render config templates into place, writing only the files whose
+contents have actually changed, so that the services that read them
+aren't restarted for nothing.
+
+Templates are plain config files, with $name or ${name} wherever a Plan
+variable (see config.TEMPLATE_VARS) goes, and $$ for a literal $.
+
+'''
+
+import binascii
+import hashlib
+import os
+import shlex
+import string
+import subprocess
+import tempfile
+import threading
+
+from snapstack.errors import InfraFailure
+
+
+class Renderer:
+    '''
+    Fills in templates, and puts the results in place. Parsed templates
+    are cached, so Steps and Plans that share a Renderer read and parse
+    each template once. Safe to share between threads.
+
+    '''
+    def __init__(self):
+        self._templates = {}
+        self._lock = threading.Lock()
+        self.counts = {'changed': 0, 'unchanged': 0}
+
+    def template(self, path):
+        '''
+        Return the string.Template in the file at path, parsing it only if
+        we haven't already, or it has changed since.
+
+        '''
+        st = os.stat(path)
+        identity = (st.st_ino, st.st_dev, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            cached = self._templates.get(path)
+        if cached is not None and cached[0] == identity:
+            return cached[1]
+
+        with open(path) as f:
+            template = string.Template(f.read())
+        with self._lock:
+            self._templates[path] = (identity, template)
+        return template
+
+    def render(self, path, variables):
+        '''
+        Return the bytes of the template at path, filled in from
+        variables.
+
+        '''
+        try:
+            return self.template(path).substitute(variables).encode('utf-8')
+        except KeyError as e:
+            raise InfraFailure('Template {} needs variable {}'.format(
+                path, e.args[0]))
+        except ValueError as e:
+            raise InfraFailure('Bad template {}: {}'.format(path, e))
+
+    def install(self, files, transport, tempdir):
+        '''
+        Put each rendered file in place, on transport's host, unless what's
+        there already has the same contents. Returns the list of paths
+        that we wrote.
+
+        @param dict files: Maps each destination path to its rendered
+          bytes.
+        @param transport.Transport transport: The host to write to.
+        @param string tempdir: A local dir under which to stage files
+          that need copying to another host, or writing with sudo.
+
+        '''
+        if transport.remote:
+            changed = [dest for dest, digest in self._remote_digests(
+                list(files), transport).items()
+                if digest != _sha256(files[dest])]
+            self._install_sudo(changed, files, transport, tempdir)
+        else:
+            changed = [dest for dest in files
+                       if _read(dest) != files[dest]]
+            denied = []
+            for dest in changed:
+                try:
+                    _write(dest, files[dest])
+                except PermissionError:
+                    denied.append(dest)
+            self._install_sudo(denied, files, transport, tempdir)
+
+        with self._lock:
+            self.counts['changed'] += len(changed)
+            self.counts['unchanged'] += len(files) - len(changed)
+        return changed
+
+    def _remote_digests(self, dests, transport):
+        '''
+        Return a dict mapping each of dests to the sha256 of the file there
+        on transport's host, or None if there isn't one, in one command.
+
+        '''
+        cmd, _ = transport.command(['sudo', 'sha256sum', '--'] + dests)
+        # Files that don't exist yet make sha256sum fail, but it still
+        # tells us about the rest.
+        p = subprocess.run(cmd, stdout=subprocess.PIPE,
+                           stderr=subprocess.DEVNULL)
+        digests = {dest: None for dest in dests}
+        for line in (p.stdout or b'').decode('utf-8').splitlines():
+            digest, _, path = line.partition('  ')
+            if path in digests:
+                digests[path] = digest
+        return digests
+
+    def _install_sudo(self, dests, files, transport, tempdir):
+        '''
+        Write dests with sudo, on transport's host, in one command.
+
+        '''
+        if not dests:
+            return
+        staging = tempfile.mkdtemp(prefix='render-', dir=tempdir)
+        staged = []
+        for index, dest in enumerate(dests):
+            name = '{}-{}'.format(index, os.path.basename(dest))
+            _write(os.path.join(staging, name), files[dest])
+            staged.append(name)
+        transport.put(staging, staged)
+
+        script = ' && '.join(
+            'install -D -m 0644 {} {}'.format(
+                shlex.quote(os.path.join(staging, name)), shlex.quote(dest))
+            for name, dest in zip(staged, dests))
+        cmd, _ = transport.command(['sudo', 'sh', '-c', script])
+        if subprocess.run(cmd).returncode != 0:
+            raise InfraFailure('Failed to write {} on {}'.format(
+                ', '.join(dests), transport))
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+    except PermissionError:
+        # We can't tell, so write it (with sudo).
+        return None
+
+
+def _write(path, data):
+    '''
+    Write data to path atomically, so that a service never reads half a
+    file.
+
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(path), '.render-{}-{}'.format(
+        os.path.basename(path), binascii.hexlify(os.urandom(6)).decode()))
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
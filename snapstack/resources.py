@@ -0,0 +1,361 @@
+'''
+Sample this host's CPU, memory, disk and network use, and that of the
+snap services on it, in the background while a Plan runs, and attribute
+each sample to the Steps and scripts that were running at the time.
+
+Everything comes from reading a few small files under /proc and
+/sys/fs/cgroup, once per interval, so sampling costs next to nothing.
+
+'''
+
+import glob
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+DEFAULT_INTERVAL = 1.0  # Seconds between samples.
+
+# The host wide metrics that we sample, and the units that we report
+# them in.
+METRICS = OrderedDict([
+    ('cpu', '%'),  # Of all cores.
+    ('load', ''),  # 1 minute load average.
+    ('mem', 'MB'),  # In use, apart from caches.
+    ('disk', 'MB/s'),  # Read and written.
+    ('net', 'MB/s'),  # Received and sent, apart from loopback.
+])
+
+MB = 1024.0 * 1024.0
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return ''
+
+
+class _Stat:
+    '''
+    The peak and running mean of a series of values.
+
+    '''
+    def __init__(self):
+        self.peak = None
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, value):
+        self.peak = value if self.peak is None else max(self.peak, value)
+        self.total += value
+        self.count += 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+class Sampler:
+    '''
+    Samples resource use on a background thread, between start and stop.
+    It may be started and stopped several times; samples accumulate.
+
+    Rates (CPU, disk and network) are measured over each interval, so the
+    first sample after start only sets a baseline.
+
+    '''
+    def __init__(self, tracer, interval=None, proc='/proc',
+                 cgroup='/sys/fs/cgroup'):
+        '''
+        @param trace.Tracer tracer: Tells us which Steps, and scripts, are
+          running. Samples are also recorded on it, as counters.
+        @param float interval: Seconds between samples. Defaults to
+          DEFAULT_INTERVAL.
+        @param string proc: Where procfs is mounted.
+        @param string cgroup: Where the cgroup hierarchy is mounted. Both
+          cgroup v2 (unified) and v1 layouts are understood.
+
+        '''
+        self.log = logging.getLogger()
+        self.tracer = tracer
+        self.interval = interval or DEFAULT_INTERVAL
+        self.proc = proc
+        self.cgroup = cgroup
+        self._stats = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._last = None
+        self._thread = threading.Thread(target=self._loop,
+                                        name='snapstack-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _loop(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                # Never let sampling get in the way of a deploy.
+                self.log.debug('Failed to sample resources: {}'.format(e))
+            if self._stop.wait(self.interval):
+                return
+
+    def sample(self):
+        '''
+        Take one sample, and attribute it to whatever is running. Returns
+        the sample: a dict of METRICS, plus 'services', mapping each snap
+        service to a dict of its 'cpu' and 'mem'; or None for a baseline.
+
+        '''
+        now = time.monotonic()
+        counters = self._counters()
+        last, self._last = self._last, (now, counters)
+        if last is None:
+            return None
+
+        elapsed = now - last[0]
+        if elapsed <= 0:
+            return None
+        prev = last[1]
+
+        busy, total = counters['cpu']
+        prev_busy, prev_total = prev['cpu']
+        sample = {
+            'cpu': 100.0 * (busy - prev_busy) / (total - prev_total)
+            if total > prev_total else 0.0,
+            'load': counters['load'],
+            'mem': counters['mem'] / MB,
+            'disk': (counters['disk'] - prev['disk']) / MB / elapsed,
+            'net': (counters['net'] - prev['net']) / MB / elapsed,
+            'services': {},
+        }
+        for service, (cpu, mem) in counters['services'].items():
+            if service not in prev['services']:
+                continue
+            sample['services'][service] = {
+                'cpu': 100.0 * (cpu - prev['services'][service][0]) /
+                elapsed / counters['cores'],
+                'mem': mem / MB,
+            }
+
+        self.tracer.counter('resources', {m: round(sample[m], 2)
+                                          for m in METRICS})
+        self._attribute(sample)
+        return sample
+
+    def _attribute(self, sample):
+        '''
+        Add sample to the stats of each Step, and script, that is running.
+
+        '''
+        keys = set()
+        for step, cat, name in self.tracer.active():
+            if step is None:
+                continue
+            keys.add(step)
+            if cat == 'script':
+                keys.add('{} {}'.format(step, os.path.basename(name)))
+
+        with self._lock:
+            for key in sorted(keys):
+                stats = self._stats.setdefault(key, {
+                    'metrics': {m: _Stat() for m in METRICS},
+                    'services': {},
+                })
+                for metric in METRICS:
+                    stats['metrics'][metric].add(sample[metric])
+                for service, usage in sample['services'].items():
+                    row = stats['services'].setdefault(
+                        service, {'cpu': _Stat(), 'mem': _Stat()})
+                    row['cpu'].add(usage['cpu'])
+                    row['mem'].add(usage['mem'])
+
+    def _counters(self):
+        '''
+        Read the raw counters that a sample is worked out from.
+
+        '''
+        busy, total, cores = self._cpu()
+        return {
+            'cpu': (busy, total),
+            'cores': cores,
+            'load': self._load(),
+            'mem': self._mem(),
+            'disk': self._disk(),
+            'net': self._net(),
+            'services': self._services(),
+        }
+
+    def _cpu(self):
+        '''
+        Return the (busy, total) jiffies spent by all cores, and the number
+        of cores.
+
+        '''
+        busy = total = cores = 0
+        for line in _read(os.path.join(self.proc, 'stat')).splitlines():
+            if line.startswith('cpu '):
+                fields = [int(f) for f in line.split()[1:]]
+                # user nice system idle iowait irq softirq steal ...; guest
+                # time is already counted in user.
+                total = sum(fields[:8])
+                busy = total - fields[3] - fields[4]
+            elif line.startswith('cpu'):
+                cores += 1
+        return busy, total, max(1, cores)
+
+    def _load(self):
+        fields = _read(os.path.join(self.proc, 'loadavg')).split()
+        return float(fields[0]) if fields else 0.0
+
+    def _mem(self):
+        '''
+        Return the bytes of memory in use, not counting what the kernel
+        could reclaim (MemTotal - MemAvailable).
+
+        '''
+        info = {}
+        for line in _read(os.path.join(self.proc, 'meminfo')).splitlines():
+            name, _, value = line.partition(':')
+            if value.strip():
+                info[name] = int(value.split()[0]) * 1024
+        return info.get('MemTotal', 0) - info.get('MemAvailable', 0)
+
+    def _disk(self):
+        '''
+        Return the bytes read and written by all disks. Partitions, loop
+        devices and ramdisks are left out, so nothing is counted twice.
+
+        '''
+        sectors = {}
+        text = _read(os.path.join(self.proc, 'diskstats'))
+        for line in text.splitlines():
+            fields = line.split()
+            if len(fields) < 10 or fields[2].startswith(('loop', 'ram')):
+                continue
+            sectors[fields[2]] = int(fields[5]) + int(fields[9])
+        return 512 * sum(
+            count for name, count in sectors.items()
+            if not any(name != other and name.startswith(other)
+                       for other in sectors))
+
+    def _net(self):
+        '''
+        Return the bytes received and sent by every interface but lo.
+
+        '''
+        total = 0
+        text = _read(os.path.join(self.proc, 'net', 'dev'))
+        for line in text.splitlines()[2:]:
+            name, _, fields = line.partition(':')
+            fields = fields.split()
+            if name.strip() == 'lo' or len(fields) < 9:
+                continue
+            total += int(fields[0]) + int(fields[8])
+        return total
+
+    def _services(self):
+        '''
+        Return a dict mapping each snap service (snap.<snap>.<app>) to its
+        (CPU seconds, bytes of memory), from its cgroup.
+
+        '''
+        services = {}
+        # cgroup v2
+        for path in glob.glob(os.path.join(
+                self.cgroup, 'system.slice', 'snap.*.service')):
+            usec = 0
+            for line in _read(os.path.join(path, 'cpu.stat')).splitlines():
+                if line.startswith('usage_usec '):
+                    usec = int(line.split()[1])
+            mem = _read(os.path.join(path, 'memory.current')).strip()
+            services[self._service(path)] = (usec / 1e6,
+                                             int(mem) if mem else 0)
+        if services:
+            return services
+
+        # cgroup v1
+        for path in glob.glob(os.path.join(
+                self.cgroup, 'cpuacct', 'system.slice', 'snap.*.service')):
+            ns = _read(os.path.join(path, 'cpuacct.usage')).strip()
+            mem = _read(os.path.join(
+                self.cgroup, 'memory', 'system.slice', os.path.basename(path),
+                'memory.usage_in_bytes')).strip()
+            services[self._service(path)] = (int(ns) / 1e9 if ns else 0.0,
+                                             int(mem) if mem else 0)
+        return services
+
+    @staticmethod
+    def _service(path):
+        return os.path.basename(path)[:-len('.service')]
+
+    def stats(self):
+        '''
+        Return an OrderedDict mapping each Step that we sampled, and each
+        of its scripts (as "<step> <script>"), to a dict of:
+
+        samples: How many samples were taken while it ran.
+        <metric>: A dict of the 'peak' and 'mean' of each of METRICS.
+        services: A dict mapping each snap service to a dict of the 'peak'
+          and 'mean' of its 'cpu' and 'mem'.
+
+        '''
+        result = OrderedDict()
+        with self._lock:
+            for key, stats in self._stats.items():
+                row = {'samples': stats['metrics']['cpu'].count}
+                for metric, stat in stats['metrics'].items():
+                    row[metric] = {'peak': stat.peak, 'mean': stat.mean}
+                row['services'] = {
+                    service: {name: {'peak': stat.peak, 'mean': stat.mean}
+                              for name, stat in usage.items()}
+                    for service, usage in stats['services'].items()}
+                result[key] = row
+        return result
+
+    def summary(self):
+        '''
+        Return a plain text table of the mean and peak of each metric, for
+        each Step and script, and the snap service that used the most CPU
+        while it ran.
+
+        '''
+        rows = [['step'] + ['{} {}'.format(m, u).strip()
+                            for m, u in METRICS.items()] + ['busiest']]
+        for key, row in self.stats().items():
+            busiest = sorted(row['services'].items(),
+                             key=lambda s: -s[1]['cpu']['mean'])
+            rows.append(
+                [key] +
+                ['{:.1f}/{:.1f}'.format(row[m]['mean'], row[m]['peak'])
+                 for m in METRICS] +
+                ['{} {:.0f}%'.format(busiest[0][0],
+                                     busiest[0][1]['cpu']['mean'])
+                 if busiest else '-'])
+
+        widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+        lines = ['(mean/peak)']
+        for row in rows:
+            lines.append('  '.join(
+                [row[0].ljust(widths[0])] +
+                [c.rjust(w) for c, w in zip(row[1:-1], widths[1:-1])] +
+                [row[-1]]))
+        return '\n'.join(lines)
@@ -0,0 +1,207 @@
+'''
+Retry policies for the things that a Step does, so that one dropped
+connection, or a snapd change that conflicts with another, doesn't fail
+a whole Plan.
+
+'''
+
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+from snapstack.errors import InfraFailure, TestFailure
+
+
+# The kinds of operation that we retry.
+OPERATIONS = ['fetch', 'install', 'script']
+
+
+def _transient_fetch(error):
+    '''
+    Return True if a failed download is worth trying again: the
+    connection failed, or the server had a problem, rather than telling us
+    that the file doesn't exist.
+
+    '''
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None \
+            else None
+        return status is None or status == 429 or status >= 500
+    return isinstance(error, requests.RequestException)
+
+
+# What counts as a failure worth retrying, for each operation.
+RETRYABLE = {
+    'fetch': _transient_fetch,
+    'install': lambda error: isinstance(error, InfraFailure),
+    'script': lambda error: isinstance(error, TestFailure),
+}
+
+
+class Retry:
+    '''
+    A retry policy: how many times to try again, and how long to wait in
+    between. Waits grow exponentially, and are jittered ("full jitter":
+    a random time up to the exponential delay), so that Steps that fail
+    together don't all try again at once.
+
+    '''
+    def __init__(self, retries=2, delay=1.0, max_delay=30.0, factor=2.0):
+        '''
+        @param int retries: How many times to try again after the first
+          failure. 0 disables retries.
+        @param float delay: The cap on the first wait, in seconds.
+        @param float max_delay: The cap on any wait, in seconds.
+        @param float factor: What the cap is multiplied by after each wait.
+
+        '''
+        self.retries = retries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.factor = factor
+
+    def delays(self):
+        '''
+        Yield how long to wait before each retry.
+
+        '''
+        for n in range(self.retries):
+            yield random.uniform(
+                0, min(self.max_delay, self.delay * self.factor ** n))
+
+    def call(self, func, *args, retryable=None, on_retry=None):
+        '''
+        Call func(*args), trying again, after a wait, if it raises an
+        error that retryable returns True for. Once we run out of retries,
+        the last error is raised.
+
+        @param callable retryable: Given the error; defaults to retrying
+          anything.
+        @param callable on_retry: Called with the attempt that failed
+          (counting from 1), the wait, and the error, before each wait.
+
+        '''
+        delays = self.delays()
+        attempt = 1
+        while True:
+            try:
+                return func(*args)
+            except Exception as e:
+                delay = self._next(delays, e, retryable)
+                if on_retry is not None:
+                    on_retry(attempt, delay, e)
+            time.sleep(delay)
+            attempt += 1
+
+    async def acall(self, func, *args, retryable=None, on_retry=None):
+        '''
+        A coroutine that does what call does, for a coroutine function,
+        waiting on the event loop.
+
+        '''
+        delays = self.delays()
+        attempt = 1
+        while True:
+            try:
+                return await func(*args)
+            except Exception as e:
+                delay = self._next(delays, e, retryable)
+                if on_retry is not None:
+                    on_retry(attempt, delay, e)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _next(self, delays, error, retryable):
+        '''
+        Return the wait before the next retry, or re-raise error if we're
+        not to retry it.
+
+        '''
+        if retryable is not None and not retryable(error):
+            raise error
+        delay = next(delays, None)
+        if delay is None:
+            raise error
+        return delay
+
+
+def default_policy(operation):
+    '''
+    Return the Retry policy for operation when neither Step nor Plan sets
+    one. Downloads and snap installs are retried twice, by default, and
+    scripts, which may not be safe to run twice, not at all. Set
+    SNAPSTACK_<OPERATION>_RETRIES (eg SNAPSTACK_FETCH_RETRIES) to change
+    the number of retries.
+
+    '''
+    retries = {'fetch': 2, 'install': 2, 'script': 0}[operation]
+    env = os.environ.get('SNAPSTACK_{}_RETRIES'.format(operation.upper()))
+    if env:
+        retries = int(env)
+    if operation == 'install':
+        # snapd conflicts clear when the other change finishes, which
+        # can take a while.
+        return Retry(retries, delay=5.0, max_delay=60.0)
+    return Retry(retries)
+
+
+class RetryLog:
+    '''
+    Records each retry, for the run report. Safe to share between threads.
+
+    '''
+    def __init__(self):
+        self.log = logging.getLogger()
+        self._retries = []
+        self._lock = threading.Lock()
+
+    def record(self, step, operation, attempt, delay, error):
+        error = str(error).split('\n')[0]
+        self.log.warning(
+            'Step {}: {} failed (attempt {}): {}. Retrying in {:.1f}s.'.format(
+                step, operation, attempt, error, delay))
+        with self._lock:
+            self._retries.append({
+                'step': step,
+                'operation': operation,
+                'attempt': attempt,
+                'delay': delay,
+                'error': error,
+                'time': time.time(),
+            })
+
+    @property
+    def retries(self):
+        with self._lock:
+            return list(self._retries)
+
+    def totals(self):
+        '''
+        Return an OrderedDict mapping (step, operation) to a dict of the
+        number of retries, and the seconds spent waiting, in total.
+
+        '''
+        totals = OrderedDict()
+        for retry in self.retries:
+            row = totals.setdefault((retry['step'], retry['operation']),
+                                    {'retries': 0, 'delay': 0.0})
+            row['retries'] += 1
+            row['delay'] += retry['delay']
+        return totals
+
+    def summary(self):
+        '''
+        Return a plain text line for each step and operation that we had
+        to retry.
+
+        '''
+        return '\n'.join(
+            '  {} {}: {} retries, {:.1f}s waiting'.format(
+                step, operation, row['retries'], row['delay'])
+            for (step, operation), row in self.totals().items())
@@ -0,0 +1,334 @@
+'''
+Run the Steps in a Plan concurrently, honoring the dependencies that
+they declare on one another.
+
+'''
+
+import asyncio
+import concurrent.futures
+import heapq
+from collections import OrderedDict
+
+from snapstack.errors import InfraFailure
+
+
+MAX_WORKERS = 4
+
+
+def resolve(steps, done=None):
+    '''
+    Given a list of Steps, return an OrderedDict mapping each Step to the
+    list of Steps that must finish before it may start.
+
+    A Step whose requires is None waits on the Step before it in the
+    list, which keeps the old, serial behavior for Steps that don't say
+    otherwise. A Step that does declare requires waits on exactly the
+    named Steps.
+
+    @param list done: Names of Steps that have already finished, outside
+      of steps, such as a Plan's base when it deploys its tests on their
+      own. Requiring one of them is no reason to wait. Requiring any other
+      name that isn't in steps raises an InfraFailure, as the Step would
+      otherwise start before whatever it needs. (To take a Step out of a
+      base.Setup, use its remove_steps, which hands the Steps that
+      required it on to what it required.)
+
+    '''
+    by_name = {s.name: s for s in steps if s.name is not None}
+    done = set(done or [])
+
+    deps = OrderedDict()
+    previous = None
+    for step in steps:
+        if step.requires is None:
+            deps[step] = [previous] if previous is not None else []
+        else:
+            deps[step] = []
+            for name in step.requires:
+                if name in by_name:
+                    deps[step].append(by_name[name])
+                elif name not in done:
+                    raise InfraFailure(
+                        'Step "{}" requires "{}", which is not in this '
+                        'plan'.format(step.name, name))
+        previous = step
+
+    _check_cycles(deps)
+
+    return deps
+
+
+def _check_cycles(deps):
+    '''
+    Raise an InfraFailure if the dependency graph can never finish.
+
+    '''
+    done = set()
+    visiting = set()
+
+    def visit(step):
+        if step in done:
+            return
+        if step in visiting:
+            raise InfraFailure(
+                'Dependency cycle detected at step "{}"'.format(step.name))
+        visiting.add(step)
+        for dep in deps[step]:
+            visit(dep)
+        visiting.discard(step)
+        done.add(step)
+
+    for step in deps:
+        visit(step)
+
+
+class _Graph:
+    '''
+    Tracks which of a list of Steps are ready to start, as the Steps they
+    depend on finish.
+
+    '''
+    def __init__(self, steps, durations=None, done=None):
+        '''
+        @param list done: As for resolve.
+        @param dict durations: Maps Steps to how many seconds we expect
+          them to take. If given, ready Steps at the head of the longest
+          expected chains go first, so that the chain that decides how long
+          the whole run takes isn't kept waiting. Otherwise, ready Steps
+          are kept in Plan order.
+
+        '''
+        deps = resolve(steps, done)
+        self._order = {step: index for index, step in enumerate(deps)}
+        self._waiting = {step: set(d) for step, d in deps.items()}
+        self._dependents = {step: [] for step in deps}
+        for step, d in deps.items():
+            for dep in d:
+                self._dependents[dep].append(step)
+        self._chains = _chains(self._dependents, durations)
+        self.ready = [step for step in deps if not self._waiting[step]]
+        self.ready.sort(key=self._key)
+
+    def _key(self, step):
+        return (-self._chains[step], self._order[step])
+
+    def finished(self, step):
+        '''
+        Mark step as finished, readying any Steps that were only waiting on
+        it, and return a list of them. Ready Steps are kept in order of
+        priority.
+
+        '''
+        readied = []
+        for dependent in self._dependents[step]:
+            self._waiting[dependent].discard(step)
+            if not self._waiting[dependent]:
+                readied.append(dependent)
+        self.ready += readied
+        self.ready.sort(key=self._key)
+        return readied
+
+
+def _announce(on_ready, steps):
+    if on_ready is not None and steps:
+        on_ready(steps)
+
+
+def _typical(durations):
+    '''
+    Return the median of durations' values, or 0 if there are none.
+
+    '''
+    known = sorted(durations.values())
+    return known[len(known) // 2] if known else 0.0
+
+
+def _chains(dependents, durations):
+    '''
+    Return a dict mapping each Step to the expected seconds from when it
+    starts until the last Step that depends on it, however indirectly,
+    finishes: the length of the longest chain that it heads. Steps that
+    durations leaves out count as a typical (median) Step; all of them
+    count as 0 if durations is empty.
+
+    '''
+    durations = durations or {}
+    default = _typical(durations)
+
+    # Work back from the end of each chain. (Plans can be thousands of
+    # Steps long, which is too deep to recurse.)
+    chains = {}
+    for root in dependents:
+        stack = [root]
+        while stack:
+            step = stack[-1]
+            if step in chains:
+                stack.pop()
+                continue
+            todo = [d for d in dependents[step] if d not in chains]
+            if todo:
+                stack += todo
+                continue
+            stack.pop()
+            chains[step] = durations.get(step, default) + max(
+                [chains[d] for d in dependents[step]] or [0.0])
+    return chains
+
+
+def predict(steps, durations, max_workers=None, done=None):
+    '''
+    Return how many seconds we expect a Scheduler to take to run steps,
+    given how long we expect each to take, by playing the run out with
+    the same workers and priorities.
+
+    @param list steps: The Steps to run.
+    @param dict durations: Maps Steps to seconds, as for _Graph. Steps
+      left out count as a typical Step.
+    @param int max_workers: As for Scheduler.
+    @param list done: As for resolve.
+
+    '''
+    max_workers = max_workers or MAX_WORKERS
+    graph = _Graph(steps, durations, done)
+    durations = durations or {}
+    default = _typical(durations)
+
+    now = 0.0
+    running = []  # (finish time, plan order, step)
+    while graph.ready or running:
+        while graph.ready and len(running) < max_workers:
+            step = graph.ready.pop(0)
+            heapq.heappush(running, (now + durations.get(step, default),
+                                     graph._order[step], step))
+        now, _, step = heapq.heappop(running)
+        graph.finished(step)
+    return now
+
+
+class Scheduler:
+    '''
+    Runs a callable against each of a list of Steps on a bounded pool of
+    worker threads, or a coroutine function as tasks on an event loop. A
+    Step is only started once all of the Steps it depends upon have
+    finished.
+
+    '''
+    def __init__(self, max_workers=None):
+        '''
+        @param int max_workers: The maximum number of Steps to run at once.
+
+        '''
+        self.max_workers = max_workers or MAX_WORKERS
+
+    def run(self, steps, func, fail_fast=True, durations=None, done=None,
+            on_ready=None):
+        '''
+        Call func(step) for each step in steps.
+
+        @param list steps: The Steps to run.
+        @param callable func: Called once for each Step, in a worker thread.
+        @param bool fail_fast: If True, stop starting new Steps as soon as
+          one raises, wait for the ones already running, then re-raise the
+          first exception. If False, keep going, treating a failed Step as
+          finished, and return a list of (step, exception) tuples.
+        @param dict durations: Maps Steps to how long we expect them to
+          take, in seconds, so that the longest chains of Steps start
+          first. Without it, ready Steps start in Plan order.
+        @param list done: Names of Steps that have already finished, as for
+          resolve.
+        @param callable on_ready: Called, from our own thread, with each
+          list of Steps whose requirements have all just finished, before
+          any of them is started. Lets the caller make a start on work
+          for them, such as installing their snaps, that mustn't begin
+          any sooner. Steps may still have to wait for a worker after.
+
+        '''
+        graph = _Graph(steps, durations, done)
+        running = {}
+        errors = []
+        _announce(on_ready, list(graph.ready))
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers) as pool:
+            while graph.ready or running:
+                # Only hand the pool as many Steps as it has workers, so
+                # that nothing is left queued up if we have to stop early.
+                while (graph.ready and len(running) < self.max_workers and
+                       not (fail_fast and errors)):
+                    step = graph.ready.pop(0)
+                    running[pool.submit(func, step)] = step
+
+                if not running:
+                    # Failed fast, and nothing left in flight.
+                    break
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                readied = []
+                for future in finished:
+                    step = running.pop(future)
+                    exc = future.exception()
+                    if exc is not None:
+                        errors.append((step, exc))
+                        if fail_fast:
+                            continue
+                    readied += graph.finished(step)
+                if not (fail_fast and errors):
+                    _announce(on_ready, readied)
+
+        if fail_fast and errors:
+            raise errors[0][1]
+
+        return errors
+
+    async def arun(self, steps, func, fail_fast=True, durations=None,
+                   done=None, on_ready=None):
+        '''
+        A coroutine that does what run does, but awaits func(step), as a
+        task on the current event loop, rather than calling it in a thread.
+
+        If we are cancelled, the Steps in flight are cancelled too, and we
+        wait for them to wind down before re-raising.
+
+        '''
+        graph = _Graph(steps, durations, done)
+        running = {}
+        errors = []
+        _announce(on_ready, list(graph.ready))
+
+        try:
+            while graph.ready or running:
+                while (graph.ready and len(running) < self.max_workers and
+                       not (fail_fast and errors)):
+                    step = graph.ready.pop(0)
+                    running[asyncio.ensure_future(func(step))] = step
+
+                if not running:
+                    break
+
+                finished, _ = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED)
+
+                readied = []
+                for task in finished:
+                    step = running.pop(task)
+                    exc = task.exception()
+                    if exc is not None:
+                        errors.append((step, exc))
+                        if fail_fast:
+                            continue
+                    readied += graph.finished(step)
+                if not (fail_fast and errors):
+                    _announce(on_ready, readied)
+        except asyncio.CancelledError:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.wait(running)
+            raise
+
+        if fail_fast and errors:
+            raise errors[0][1]
+
+        return errors
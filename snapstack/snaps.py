@@ -0,0 +1,289 @@
+'''
+Install the store snaps for a Plan's Steps, queueing those that are
+ready to install together with snapd all at once.
+
+'''
+
+import concurrent.futures
+import logging
+import subprocess
+import threading
+from collections import OrderedDict
+
+from snapstack.errors import InfraFailure
+from snapstack.transport import Transport
+
+
+RISKS = ['stable', 'candidate', 'beta', 'edge']
+
+
+def parse_channels(output):
+    '''
+    Parse the output of "snap info <snap>" into a dict mapping each
+    channel that it lists to its description; "–" for a closed channel.
+
+    '''
+    channels = {}
+    listing = False
+    for line in output.splitlines():
+        if line.startswith('channels:'):
+            listing = True
+            continue
+        if listing:
+            if not line.startswith(' '):
+                break
+            name, _, rest = line.strip().partition(':')
+            channels[name] = rest.strip()
+    return channels
+
+
+def channel_names(channel):
+    '''
+    Return the names that "snap info" might list channel under.
+
+    '''
+    parts = channel.split('/')
+    if len(parts) == 1:
+        if channel in RISKS:
+            return [channel, 'latest/' + channel]
+        return [channel + '/stable']
+    if parts[0] == 'latest':
+        return ['/'.join(parts[:2]), parts[1]]
+    if parts[1] in RISKS:
+        return ['/'.join(parts[:2])]
+    # risk/branch
+    return [parts[0], 'latest/' + parts[0]]
+
+
+def flag_channel(flags):
+    '''
+    Return the channel named by the --channel flag in flags, or None.
+
+    '''
+    for flag in flags:
+        if flag.startswith('--channel='):
+            return flag[len('--channel='):]
+    return None
+
+
+def satisfies(installed, flags):
+    '''
+    Return True if a snap that is installed as described by installed (its
+    entry in facts.HostFacts.installed_snaps, or None if it isn't
+    installed) is what "snap install" with flags would give us: tracking
+    the same channel, with the same confinement.
+
+    '''
+    if installed is None:
+        return False
+    channel = flag_channel(flags)
+    tracking = installed.get('tracking')
+    if channel is not None and tracking != channel and \
+            tracking not in channel_names(channel):
+        return False
+    classic = 'classic' in (installed.get('notes') or '').split(',')
+    return classic == ('--classic' in flags)
+
+
+class SnapInstaller:
+    '''
+    Installs store snaps on behalf of Steps, and reports success or
+    failure back to each Step.
+
+    The snap cli only accepts --channel and --classic when it is given a
+    single snap, and every Step names its channel, so each snap is its
+    own snapd change. The snaps that we're asked to start together are
+    all queued with snapd at once (via --no-wait) and then watched, so
+    that snapd works on them together.
+
+    A snap that is already installed from the channel, and with the
+    confinement, that a Step asks for is left alone. One installed some
+    other way is refreshed to what the Step asks for.
+
+    '''
+    def __init__(self, facts, transport=None):
+        '''
+        @param facts.HostFacts facts: Used to find out, once, which snaps
+          are already installed.
+        @param transport.Transport transport: The host to install snaps
+          on. Defaults to this one.
+
+        '''
+        self.log = logging.getLogger()
+        self.facts = facts
+        self.transport = transport or Transport()
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def _claim(self, steps):
+        '''
+        Return an OrderedDict of snap name -> install flags for each store
+        snap in steps that nobody has started installing yet.
+
+        '''
+        pending = OrderedDict()
+        with self._lock:
+            for step in steps:
+                if not step.from_store or step.snap in self._results:
+                    continue
+                self._results[step.snap] = concurrent.futures.Future()
+                pending[step.snap] = step.install_flags()
+        return pending
+
+    def start(self, steps):
+        '''
+        Start installing the store snaps for steps in the background.
+
+        '''
+        pending = self._claim(steps)
+        if pending:
+            thread = threading.Thread(target=self._install, args=(pending,))
+            thread.daemon = True
+            thread.start()
+
+    def install(self, steps):
+        '''
+        Install the store snaps for steps, and wait for them.
+
+        '''
+        self._install(self._claim(steps))
+
+    def result(self, step):
+        '''
+        Wait for step's snap to be installed, installing it now if nobody
+        has asked for it yet. Returns None on success, or a message
+        describing the failure.
+
+        '''
+        self.install([step])
+        return self._results[step.snap].result()
+
+    def _run(self, cmd, **kwargs):
+        return subprocess.run(self.transport.command(cmd)[0], **kwargs)
+
+    def forget(self, snap):
+        '''
+        Forget how installing snap went, if it has finished, so that the
+        next Step to ask for it installs it again.
+
+        '''
+        with self._lock:
+            result = self._results.get(snap)
+            if result is not None and result.done():
+                del self._results[snap]
+
+    def _done(self, snap, error=None):
+        if error is not None:
+            self.log.error(error)
+        self._results[snap].set_result(error)
+
+    def _install(self, pending):
+        if not pending:
+            return
+
+        try:
+            installed = self.facts.installed_snaps
+            queue = OrderedDict()
+            for snap, flags in pending.items():
+                if satisfies(installed.get(snap), flags):
+                    self._done(snap)
+                    continue
+                queue[snap] = (flags, snap in installed)
+            self._install_each(queue)
+        except Exception as e:
+            for snap in pending:
+                if not self._results[snap].done():
+                    self._done(snap, 'Failed to install snap {}: {}'.format(
+                        snap, e))
+        finally:
+            self.facts.invalidate('snaps')
+
+    def _install_each(self, queue):
+        '''
+        Queue each snap in queue, an OrderedDict of snap name -> (install
+        flags, whether it's installed already), with snapd, then wait for
+        each change to finish. Snaps that are installed already are
+        refreshed with the flags instead.
+
+        '''
+        changes = OrderedDict()
+        for snap, (flags, installed) in queue.items():
+            verb = 'refresh' if installed else 'install'
+            if installed:
+                self.log.info('Refreshing snap {} to {}'.format(
+                    snap, ' '.join(flags)))
+            p = self._run(
+                ['sudo', 'snap', verb, '--no-wait'] + flags + [snap],
+                stdout=subprocess.PIPE)
+            if p.returncode != 0:
+                self._done(snap, 'Failed to install snap {}'.format(snap))
+                continue
+            changes[snap] = p.stdout.decode('utf-8').strip()
+
+        for snap, change in changes.items():
+            p = self._run(['snap', 'watch', change])
+            if p.returncode != 0:
+                self._done(snap, 'Failed to install snap {}'.format(snap))
+                continue
+            self._done(snap)
+
+    def check(self, steps):
+        '''
+        Ask the store whether the snap, and channel, of each store snap in
+        steps exists, concurrently. Snaps that are already installed as
+        their steps ask are skipped. Returns a list of problems, as strings.
+
+        '''
+        installed = self.facts.installed_snaps
+        wanted = OrderedDict()
+        for step in steps:
+            flags = step.install_flags()
+            if step.from_store and \
+                    not satisfies(installed.get(step.snap), flags):
+                wanted[step.snap] = flag_channel(flags)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            results = pool.map(lambda item: self._check(*item),
+                               wanted.items())
+            return [problem for problem in results if problem is not None]
+
+    def _check(self, snap, channel):
+        p = self._run(['snap', 'info', snap], stdout=subprocess.PIPE,
+                      stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            return 'Snap {} not found in the store'.format(snap)
+        if channel is None:
+            return None
+
+        channels = parse_channels(p.stdout.decode('utf-8'))
+        for name in channel_names(channel):
+            if channels.get(name, '–') not in ('–', '--', '-'):
+                return None
+        return 'Snap {} has no open {} channel'.format(snap, channel)
+
+    def remove(self, snaps):
+        '''
+        Remove those of snaps that are installed, in one go. Returns a list
+        of errors, one per snap that we failed to remove.
+
+        '''
+        self.facts.invalidate('snaps')
+        installed = self.facts.installed_snaps
+        snaps = [s for s in OrderedDict.fromkeys(snaps) if s in installed]
+        if not snaps:
+            return []
+
+        try:
+            p = self._run(['sudo', 'snap', 'remove'] + snaps)
+            if p.returncode == 0:
+                return []
+            if len(snaps) == 1:
+                return [InfraFailure(
+                    'Failed to remove snap {}'.format(snaps[0]))]
+            # As with install, find out which snap(s) to blame.
+            errors = []
+            for snap in snaps:
+                errors += self.remove([snap])
+            return errors
+        finally:
+            self.facts.invalidate('snaps')
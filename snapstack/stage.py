@@ -0,0 +1,153 @@
+'''
+Stage scripts and files into a Plan's BASE_DIR as cheaply as we can:
+cloning them where the filesystem supports it, and not touching files
+that are already in place.
+
+'''
+
+import binascii
+import errno
+import fcntl
+import os
+import shutil
+import threading
+
+from snapstack import config
+from snapstack.cache import file_sha256
+
+
+# From linux/fs.h. Makes the destination share the source's blocks,
+# copy on write, on filesystems that support it (btrfs, xfs, ...).
+FICLONE = 0x40049409
+
+# Errors that mean "this filesystem (or pair of filesystems) can't do
+# that", rather than that something is actually wrong.
+_UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                errno.EPERM, errno.EMLINK)
+
+
+def _reflink(src, dest):
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+class Stager:
+    '''
+    Puts copies of files in place. Safe to share between threads, and
+    between the Steps of a Plan, which often stage the same files.
+
+    Each file is cloned (reflinked) if the filesystem allows, and copied
+    if not. Hardlinks are cheaper still, but scripts may edit their staged
+    files in place, and a hardlink would pass those edits back to the
+    original (which may well be in the fetch cache), so we only use them
+    if asked to.
+
+    '''
+    def __init__(self, hardlinks=None):
+        '''
+        @param bool hardlinks: If True, hardlink files, rather than copying
+          them, where we can't clone them. Defaults to
+          SNAPSTACK_STAGE_HARDLINKS.
+
+        '''
+        self.hardlinks = config.env_flag('SNAPSTACK_STAGE_HARDLINKS') \
+            if hardlinks is None else hardlinks
+        self._staged = {}
+        self._no_reflink = set()  # (src dev, dest dev) pairs.
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.counts = {'skip': 0, 'reflink': 0, 'hardlink': 0, 'copy': 0}
+
+    def stage(self, src, dest):
+        '''
+        Make dest a copy of src, unless it already is one. Returns how we
+        did it: 'skip', 'reflink', 'hardlink' or 'copy'.
+
+        '''
+        with self._lock:
+            lock = self._locks.setdefault(dest, threading.Lock())
+
+        with lock:
+            src_stat = os.stat(src)
+            if self._identical(src, src_stat, dest):
+                how = 'skip'
+            else:
+                how = self._place(src, src_stat, dest)
+                # Match src's mtime, so that we can spot an identical copy
+                # next time, even in another run.
+                if how != 'hardlink':
+                    os.utime(dest, ns=(src_stat.st_atime_ns,
+                                       src_stat.st_mtime_ns))
+
+            dest_stat = os.stat(dest)
+            with self._lock:
+                self._staged[dest] = (
+                    _identity(src_stat), _identity(dest_stat))
+                self.counts[how] += 1
+            return how
+
+    def _identical(self, src, src_stat, dest):
+        try:
+            dest_stat = os.stat(dest)
+        except FileNotFoundError:
+            return False
+
+        with self._lock:
+            staged = self._staged.get(dest)
+        if staged == (_identity(src_stat), _identity(dest_stat)):
+            # We put it there, and neither file has changed since.
+            return True
+
+        if (dest_stat.st_size != src_stat.st_size or
+                dest_stat.st_mtime_ns != src_stat.st_mtime_ns):
+            return False
+        if os.path.samefile(src, dest):
+            return True
+        return file_sha256(src) == file_sha256(dest)
+
+    def _place(self, src, src_stat, dest):
+        '''
+        Put a copy of src at dest, atomically, so that a script that is
+        reading dest never sees half a file.
+
+        '''
+        # Let the clone or copy create tmp, so that it gets the usual
+        # permissions, rather than mkstemp's 0600.
+        tmp = os.path.join(os.path.dirname(dest), '.stage-{}-{}'.format(
+            os.path.basename(dest), binascii.hexlify(os.urandom(6)).decode()))
+        try:
+            how = self._clone(src, src_stat, tmp)
+            os.replace(tmp, dest)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+        return how
+
+    def _clone(self, src, src_stat, tmp):
+        devs = (src_stat.st_dev, os.stat(os.path.dirname(tmp)).st_dev)
+        if devs not in self._no_reflink:
+            try:
+                _reflink(src, tmp)
+                return 'reflink'
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                os.remove(tmp)
+                # Don't bother trying again between these filesystems.
+                self._no_reflink.add(devs)
+
+        if self.hardlinks:
+            try:
+                os.link(src, tmp)
+                return 'hardlink'
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+
+        shutil.copyfile(src, tmp)
+        return 'copy'
+
+
+def _identity(st):
+    return (st.st_ino, st.st_dev, st.st_size, st.st_mtime_ns)
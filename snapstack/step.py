@@ -3,18 +3,40 @@ Define an individual step in a Plan.
 
 '''
 
+import asyncio
+import copy
+import glob
+import hashlib
+import json
 import logging
 import os
-import requests
-import shutil
 import stat
 import subprocess
 import tempfile
+from collections import OrderedDict
 
 from snapstack import config
+from snapstack.cache import BuildCache, fingerprint_tree, verify
+from snapstack.facts import HostFacts
+from snapstack.fetch import Fetcher, is_remote
+from snapstack.output import LogSink, RingBuffer, arun_script, run_script
+from snapstack.ready import await_ready, ready_timeout, wait_ready
+from snapstack.render import Renderer
+from snapstack.retry import RETRYABLE, RetryLog, default_policy
+from snapstack.snaps import SnapInstaller
+from snapstack.stage import Stager
+from snapstack.trace import Tracer
+from snapstack.transport import Transport
 from snapstack.errors import InfraFailure, TestFailure
 
 
+# What we run to build a snap from local source, in the current dir.
+BUILD_COMMANDS = [
+    ['snapcraft', 'clean'],
+    ['snapcraft'],
+]
+
+
 class Step:
     '''
     A Step is a single Step in a Plan. Each step may do multiple
@@ -23,7 +45,11 @@ class Step:
 
     '''
     def __init__(self, snap=None, script_loc='{local}', scripts=None,
-                 files=None, snap_store=True, classic=False, channel=None):
+                 files=None, snap_store=True, classic=False, channel=None,
+                 name=None, requires=None, invalidates=None,
+                 output_bytes=None, timeout=None, script_timeout=None,
+                 checksums=None, ready=None, ready_timeout=None,
+                 retries=None, host=None, templates=None, config_dir=None):
         '''
         @param string snap: The name of a snap, if any, to be installed in
           this Step.
@@ -35,13 +61,71 @@ class Step:
         @param bool snap_store: if True, install the snap from the store.
           If False, install it from local source.
         @param bool classic: if True, install the snap with the --classic flag.
+        @param string name: A name for this step. Steps in a base.Setup or
+          base.Cleanup are named after their key. A Plan names any others
+          after their snap, or their place in it, so that every step in
+          it has a name of its own.
+        @param list requires: Names of steps that must finish before this
+          one starts. If None, this step waits on the step before it in the
+          Plan. Pass an empty list to let the step start right away.
+        @param list invalidates: Groups of host facts (see facts.GROUPS)
+          that this step changes, and that should be probed again once it
+          has run. For example, ['apt'] for a step that adds apt sources.
+        @param int output_bytes: How much of the output of our scripts to
+          keep in memory, and attach to any failure. Defaults to
+          SNAPSTACK_OUTPUT_BYTES, or output.OUTPUT_BYTES.
+        @param float timeout: Fail if this Step takes longer than this many
+          seconds. Only enforced when the Step is run with arun. Defaults
+          to the Plan's step_timeout.
+        @param float script_timeout: Kill any of our scripts that takes
+          longer than this many seconds, and fail. Defaults to the Plan's
+          script_timeout.
+        @param dict checksums: Maps entries in scripts or files to their
+          expected sha256. We fail if a file that we fetch doesn't match,
+          and skip revalidating a cached download that does.
+        @param list ready: ready.Condition objects, such as ready.Port(5000),
+          that must all hold before this Step counts as finished, and the
+          Steps that require it may start. They're polled concurrently, with
+          backoff, once our scripts have run, against the host we run on.
+        @param float ready_timeout: Fail if our ready conditions don't all
+          hold within this many seconds. Defaults to SNAPSTACK_READY_TIMEOUT,
+          or ready.READY_TIMEOUT.
+        @param dict retries: Maps an operation in retry.OPERATIONS ('fetch',
+          'install' or 'script') to the retry.Retry policy for it. Overrides
+          the Plan's policies, which default to retry.default_policy.
+        @param string host: The name of the host, in the Plan's hosts, to
+          run on. Defaults to this one. A Plan's placement can also put a
+          Step on a host, or on several.
+        @param list templates: Config files, relative to script_loc, to fill
+          in from the Plan's variables (see render) and write to config_dir,
+          once our snap is installed, and before our scripts run. Files are
+          only written if their contents change. Our scripts get the paths
+          of the ones that did in $SNAPSTACK_CHANGED_CONFIG, so that they
+          can skip restarting services that haven't changed.
+        @param string config_dir: Where to write templates. A template at
+          etc/snap-<snap>/<path> goes to <path> under config_dir; others go
+          to their own path under it. {snap} is filled in with our snap,
+          and {base_dir} with $BASE_DIR, for scripts that put config in
+          place themselves. Defaults to config.CONFIG_DIR.
 
         '''
         self.log = logging.getLogger()
         self.snap = snap
+        self.name = name
+        self.requires = requires
+        self.invalidates = invalidates or []
+        self.timeout = timeout
+        self.script_timeout = script_timeout
+        self.ready = ready or []
+        self.ready_timeout = ready_timeout
+        self.retries = retries or {}
+        self.host = host
         self._location = script_loc
         self._scripts = scripts or []
         self._files = files or []
+        self._templates = templates or []
+        self._config_dir = config_dir
+        self._checksums = checksums or {}
         self._snap_store = snap_store
         self._tempdir = None
         self._classic = ' --classic' if classic else ''
@@ -49,6 +133,22 @@ class Step:
             channel=channel or config.CHANNEL)
         self._http_proxy = None
         self._https_proxy = None
+        self._fetcher = None
+        self._facts = None
+        self._installer = None
+        self._build_cache = None
+        self._stager = None
+        self._tracer = None
+        self._sink = None
+        self._default_timeout = None
+        self._default_script_timeout = None
+        self._default_retries = {}
+        self._retry_log = None
+        self._transport = None
+        self._variables = {}
+        self._renderer = None
+        self.changed = []
+        self.output = RingBuffer(output_bytes)
 
     @property
     def tempdir(self):
@@ -69,55 +169,198 @@ class Step:
         '''Given a parent location and a relative path to a file, return a
         local path to the file.
 
-        If the parent location is a url, download the file first.
+        If the parent location is a url, get the file from our Fetcher,
+        which will usually have downloaded it already. Files are staged by
+        our Stager, which skips those that are already in place.
 
         '''
-        path_ = ''.join([parent, rel_path])
         working_path = os.sep.join([self.tempdir, rel_path])
-        d = os.path.dirname(working_path)
-        if not os.path.exists(d):
-            os.makedirs(d)
+        os.makedirs(os.path.dirname(working_path), exist_ok=True)
 
-        if path_.startswith('https://'):
-            # Download remote file and write to disk.
-            remote = requests.get(path_)
-            remote.raise_for_status()
+        with self.tracer.span(rel_path, 'fetch', step=self.label):
+            source = self._retry('fetch', self._source, parent, rel_path)
+            self.stager.stage(source, working_path)
 
-            with open(working_path, 'w') as f:
-                f.write(remote.text)
+        return working_path
 
-        else:
-            shutil.copyfile(path_, working_path)
+    @property
+    def from_store(self):
+        '''
+        True if this Step installs a snap from the snap store.
 
-        return working_path
+        '''
+        return bool(self.snap) and self._snap_store
+
+    def install_flags(self):
+        '''
+        Return the flags to pass to "snap install" for our snap.
+
+        '''
+        flags = [self._channel]
+        if self._classic:
+            flags.append('--classic')
+        return flags
+
+    @property
+    def installer(self):
+        '''
+        The SnapInstaller for this run. Usually shared with the rest of the
+        Plan, which will have started installing our snap already.
+
+        '''
+        if self._installer is None:
+            self._installer = SnapInstaller(self.facts)
+        return self._installer
+
+    def _build_env(self):
+        env = dict(self.facts.environ)
+        if self._http_proxy is not None:
+            env['HTTP_PROXY'] = self._http_proxy
+        if self._https_proxy is not None:
+            env['HTTPS_PROXY'] = self._https_proxy
+        return env
 
     def _install_snap(self):
         '''
         Install a snap. This will be a noop if the snap is alrady installed.
 
+        Snaps built from local source are only rebuilt if the source has
+        changed since they were last built.
+
         '''
-        if not self._snap_store:
-            env = dict(os.environ)
-            if self._http_proxy is not None:
-                env['HTTP_PROXY'] = self._http_proxy
-            if self._https_proxy is not None:
-                env['HTTPS_PROXY'] = self._https_proxy
+        if self._snap_store:
+            self._retry('install', self._install_from_store)
+            return
 
-            subprocess.run(["snapcraft", "clean"], env=env, check=True)
-            subprocess.run(["snapcraft"], env=env, check=True)
-            subprocess.run(["sudo snap install --dangerous *.snap"], env=env,
-                           check=True, shell=True)
+        self._check_local_build()
+        env = self._build_env()
+        fingerprint, snap = self._cached_build()
+        if snap is None:
+            for cmd in BUILD_COMMANDS:
+                self._build(cmd, env=env)
+            snap = self._cache_build(fingerprint)
+        self._build(self._install_cmd(snap), env=env)
+
+    def _install_from_store(self):
+        '''
+        Wait for the installer to install our snap from the store. This is
+        the only part of an install that we retry: a failed build won't
+        succeed the second time around.
+
+        '''
+        error = self.installer.result(self)
+        if error is not None:
+            # Let a retry install our snap again.
+            self.installer.forget(self.snap)
+            raise InfraFailure(error)
+
+    async def _ainstall_from_store(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._install_from_store)
+
+    async def _ainstall_snap(self):
+        loop = asyncio.get_event_loop()
+        if self._snap_store:
+            await self._aretry('install', self._ainstall_from_store)
             return
 
-        # TODO: Add handling for channels?
-        p = subprocess.run(
-            [config.INSTALL_SNAP.format(
-                snap=self.snap, classic=self._classic, channel=self._channel)],
-            shell=True
-        )
-        if p.returncode > 0:
+        self._check_local_build()
+        env = await loop.run_in_executor(None, self._build_env)
+        fingerprint, snap = await loop.run_in_executor(
+            None, self._cached_build)
+        if snap is None:
+            for cmd in BUILD_COMMANDS:
+                await self._abuild(cmd, env=env)
+            snap = await loop.run_in_executor(
+                None, self._cache_build, fingerprint)
+        await self._abuild(self._install_cmd(snap), env=env)
+
+    def _check_local_build(self):
+        if self.transport.remote:
             raise InfraFailure(
-                "Failed to install snap {}".format(self.snap))
+                'Cannot build {} from local source on {}'.format(
+                    self.snap, self.transport))
+
+    def _cached_build(self):
+        '''
+        Fingerprint the snap source in the current dir, and return the
+        fingerprint, along with the path to a matching build, if we have
+        one.
+
+        '''
+        fingerprint = fingerprint_tree(os.getcwd(), extra=self.snap)
+        snap = self.build_cache.get(fingerprint)
+        if snap is not None:
+            self.log.info('Reusing cached build of {}'.format(self.snap))
+        return fingerprint, snap
+
+    def _cache_build(self, fingerprint):
+        '''
+        Find the snap that we've just built, in the current dir, and put it
+        in the build cache.
+
+        '''
+        built = glob.glob('{}_*.snap'.format(self.snap)) or glob.glob('*.snap')
+        if not built:
+            raise InfraFailure(
+                'Built {}, but found no .snap file.'.format(self.snap),
+                output=self.output.tail())
+        newest = max(built, key=os.path.getmtime)
+        return self.build_cache.put(fingerprint, os.path.abspath(newest))
+
+    def _install_cmd(self, snap):
+        return ['sudo', 'snap', 'install', '--dangerous', snap]
+
+    def _build(self, cmd, **kwargs):
+        '''
+        Run a command to build and install our snap from local source.
+
+        '''
+        if run_script(cmd, self.label, self.sink, self.output, **kwargs):
+            raise self._build_failure(cmd)
+
+    async def _abuild(self, cmd, **kwargs):
+        if await arun_script(
+                cmd, self.label, self.sink, self.output, **kwargs):
+            raise self._build_failure(cmd)
+
+    def _build_failure(self, cmd):
+        return InfraFailure(
+            'Failed to build snap {}: "{}"'.format(self.snap, ' '.join(cmd)),
+            output=self.output.tail())
+
+    @property
+    def stager(self):
+        '''
+        The stage.Stager that puts our scripts and files in place. Usually
+        shared with the rest of the Plan.
+
+        '''
+        if self._stager is None:
+            self._stager = Stager()
+        return self._stager
+
+    @property
+    def build_cache(self):
+        '''
+        The cache.BuildCache that keeps snaps we've built from local
+        source. Usually shared with the rest of the Plan.
+
+        '''
+        if self._build_cache is None:
+            self._build_cache = BuildCache()
+        return self._build_cache
+
+    @property
+    def facts(self):
+        '''
+        The HostFacts for this run. Usually shared with the rest of the
+        Plan, but we'll make our own if we're run on our own.
+
+        '''
+        if self._facts is None:
+            self._facts = HostFacts()
+        return self._facts
 
     def _make_env(self):
         '''
@@ -125,7 +368,8 @@ class Step:
         it.
 
         '''
-        env = dict(os.environ)
+        # A remote host has an environment of its own; only send it ours.
+        env = {} if self.transport.remote else dict(self.facts.environ)
 
         # Add env variables used in scripts
         env['BASE_DIR'] = self.tempdir
@@ -135,22 +379,238 @@ class Step:
             env['SNAPSTACK_HTTPS_PROXY'] = self._https_proxy
 
         # Fix issue with unauthenticated apt repos in gerrit gate
-        repos = subprocess.run(['apt-cache', 'policy'], stdout=subprocess.PIPE)
-        for line in repos.stdout.decode('utf-8').split(os.linesep):
-            if "openstack.org" in line:
-                env['ALLOW_UNAUTHENTICATED'] = "--allow-unauthenticated"
-                break
+        if self.facts.apt_unauthenticated:
+            env['ALLOW_UNAUTHENTICATED'] = "--allow-unauthenticated"
 
         return env
 
-    def run(self, tempdir=None, http_proxy=None, https_proxy=None,
-            channel=None):
+    def location(self):
         '''
-        Run the set of tests defined by this snap (or just download some
-        config files, if the step has no executable components).
+        Return our script_loc, with the variables in config.LOCATION_VARS
+        filled in.
+
+        '''
+        location_vars = dict(config.LOCATION_VARS)  # Copy
+        location_vars['snap'] = self.snap
+        return self._location.format(**location_vars)
 
+    def remote_files(self):
         '''
+        Return the urls of any remote scripts and files that this Step
+        will fetch when it runs.
 
+        '''
+        if not self._sources():
+            return []
+        location = self.location()
+        if not is_remote(location):
+            return []
+        return [''.join([location, f]) for f in self._sources()]
+
+    def _sources(self):
+        '''
+        Return the paths, relative to script_loc, of all of our scripts,
+        files and templates.
+
+        '''
+        return self._files + self._scripts + self._templates
+
+    def check(self):
+        '''
+        Return a list of problems that would stop this Step from fetching
+        its scripts and files: a script_loc that we can't fill in, or local
+        scripts and files that don't exist. Remote files are left to the
+        Plan, which checks them all at once. Also catches a snap that we'd
+        have to build from local source on a remote host.
+
+        '''
+        if self.snap and not self._snap_store and self.transport.remote:
+            return ['Step {}: cannot build {} from local source on {}'.format(
+                self.label, self.snap, self.transport)]
+        if self._templates and self.snap is None and \
+                '{snap}' in (self._config_dir or config.CONFIG_DIR):
+            return ['Step {}: templates need a snap, or a config_dir'.format(
+                self.label)]
+        if not self._sources():
+            return []
+        try:
+            location = self.location()
+        except (KeyError, IndexError, ValueError) as e:
+            return ['Step {}: cannot resolve {}: {!r}'.format(
+                self.label, self._location, e)]
+        if self.snap is None and '{snap}' in self._location:
+            return ['Step {}: {} needs a snap'.format(
+                self.label, self._location)]
+        if is_remote(location):
+            return []
+        return ['Step {}: {}{} does not exist'.format(self.label, location, f)
+                for f in self._sources()
+                if not os.path.exists(''.join([location, f]))]
+
+    @property
+    def label(self):
+        '''
+        A name to show for this Step in logs and reports.
+
+        '''
+        return self.name or self.snap or ','.join(self._scripts) or 'step'
+
+    @property
+    def channel(self):
+        '''
+        The channel that we install our snap from.
+
+        '''
+        return self._channel.partition('=')[2]
+
+    @property
+    def tracer(self):
+        '''
+        The trace.Tracer that times this Step. Usually shared with the rest
+        of the Plan.
+
+        '''
+        if self._tracer is None:
+            self._tracer = Tracer()
+        return self._tracer
+
+    @property
+    def transport(self):
+        '''
+        The transport.Transport that reaches the host that we run on.
+
+        '''
+        if self._transport is None:
+            self._transport = Transport()
+        return self._transport
+
+    @property
+    def renderer(self):
+        '''
+        The render.Renderer that renders our templates. Usually shared with
+        the rest of the Plan.
+
+        '''
+        if self._renderer is None:
+            self._renderer = Renderer()
+        return self._renderer
+
+    def clone(self, **kwargs):
+        '''
+        Return a copy of this Step, with the attributes in kwargs (such as
+        name, host or requires) changed, and output of its own. Plans keep
+        copies of the Steps that they're given, and fan Steps out across
+        hosts, this way.
+
+        '''
+        step = copy.copy(self)
+        step.output = RingBuffer(self.output.max_bytes)
+        for key, value in kwargs.items():
+            setattr(step, key, value)
+        return step
+
+    def variant(self, channel=None, snap_store=None, classic=None):
+        '''
+        Return a clone of this Step that installs its snap from a
+        different channel, from local source rather than the store (or vice
+        versa), or with or without --classic. Anything left as None stays
+        as it is.
+
+        '''
+        step = self.clone()
+        if channel is not None:
+            step._channel = '--channel={}'.format(channel)
+        if snap_store is not None:
+            step._snap_store = snap_store
+        if classic is not None:
+            step._classic = ' --classic' if classic else ''
+        return step
+
+    @property
+    def retry_log(self):
+        '''
+        The retry.RetryLog that records our retries. Usually shared with the
+        rest of the Plan.
+
+        '''
+        if self._retry_log is None:
+            self._retry_log = RetryLog()
+        return self._retry_log
+
+    def retry_policy(self, operation):
+        '''
+        Return the retry.Retry policy for operation: ours, if we have one,
+        else the Plan's, else the default.
+
+        '''
+        return (self.retries.get(operation) or
+                self._default_retries.get(operation) or
+                default_policy(operation))
+
+    def _retried(self, operation):
+        def record(attempt, delay, error):
+            self.retry_log.record(
+                self.label, operation, attempt, delay, error)
+        return record
+
+    def _retry(self, operation, func, *args):
+        return self.retry_policy(operation).call(
+            func, *args, retryable=RETRYABLE[operation],
+            on_retry=self._retried(operation))
+
+    async def _aretry(self, operation, func, *args):
+        return await self.retry_policy(operation).acall(
+            func, *args, retryable=RETRYABLE[operation],
+            on_retry=self._retried(operation))
+
+    @property
+    def sink(self):
+        '''
+        The output.LogSink that our scripts' output goes to. Usually shared
+        with the rest of the Plan.
+
+        '''
+        if self._sink is None:
+            self._sink = LogSink()
+        return self._sink
+
+    def configure(self, tempdir=None, http_proxy=None, https_proxy=None,
+                  fetcher=None, facts=None, installer=None, tracer=None,
+                  sink=None, step_timeout=None, script_timeout=None,
+                  build_cache=None, stager=None, retries=None,
+                  retry_log=None, transport=None, variables=None,
+                  renderer=None):
+        '''
+        Hand this Step the things that it shares with the rest of a Plan.
+        Anything left as None keeps its current value.
+
+        @param tempfile.TemporaryDirectory tempdir: Where to stage files.
+        @param string http_proxy: Proxy for http requests.
+        @param string https_proxy: Proxy for https requests.
+        @param fetch.Fetcher fetcher: Fetcher for remote files.
+        @param facts.HostFacts facts: Facts about the host.
+        @param snaps.SnapInstaller installer: Installs our snap, if it comes
+          from the store, usually queued along with the snaps of the Plan's
+          other ready steps.
+        @param trace.Tracer tracer: Records how long each phase of this
+          Step takes.
+        @param output.LogSink sink: Where our scripts' output goes.
+        @param float step_timeout: The timeout for this Step, if it doesn't
+          have one of its own.
+        @param float script_timeout: The timeout for each of our scripts,
+          if this Step doesn't have one of its own.
+        @param cache.BuildCache build_cache: Keeps snaps built from local
+          source.
+        @param stage.Stager stager: Puts our scripts and files in place.
+        @param dict retries: Retry policies, by operation, for any
+          operation that this Step doesn't have its own policy for.
+        @param retry.RetryLog retry_log: Where we record our retries.
+        @param transport.Transport transport: Reaches our host. If it's a
+          remote host, facts and installer should be for that host, too.
+        @param dict variables: The Plan's variables, for our templates.
+        @param render.Renderer renderer: Renders our templates.
+
+        '''
         # Possibly override temp dir.
         if tempdir is not None:
             self._tempdir = tempdir
@@ -160,26 +620,336 @@ class Step:
         if https_proxy is not None:
             self._https_proxy = https_proxy
 
+        if fetcher is not None:
+            self._fetcher = fetcher
+        if facts is not None:
+            self._facts = facts
+        if installer is not None:
+            self._installer = installer
+        if tracer is not None:
+            self._tracer = tracer
+        if sink is not None:
+            self._sink = sink
+        if build_cache is not None:
+            self._build_cache = build_cache
+        if stager is not None:
+            self._stager = stager
+        if step_timeout is not None:
+            self._default_timeout = step_timeout
+        if script_timeout is not None:
+            self._default_script_timeout = script_timeout
+        if retries is not None:
+            self._default_retries = retries
+        if retry_log is not None:
+            self._retry_log = retry_log
+        if transport is not None:
+            self._transport = transport
+        if variables is not None:
+            self._variables = variables
+        if renderer is not None:
+            self._renderer = renderer
+
+    def _source(self, location, rel_path):
+        '''
+        Return a local path to the original of a script or file, fetching
+        it if it's remote, and checking it against its expected checksum,
+        if it has one.
+
+        '''
+        path_ = ''.join([location, rel_path])
+        sha256 = self._checksums.get(rel_path)
+        if is_remote(path_):
+            if self._fetcher is None:
+                self._fetcher = Fetcher(
+                    http_proxy=self._http_proxy,
+                    https_proxy=self._https_proxy)
+            return self._fetcher.get(path_, sha256=sha256)
+        verify(path_, sha256)
+        return path_
+
+    def fingerprint(self, installed=True):
+        '''
+        Return a hash of everything that goes into this Step: its scripts
+        and files, its snap, channel and installed revision, and the parts
+        of the environment that we pass on to its scripts.
+
+        If two runs of a Step have the same fingerprint, the second one
+        shouldn't have anything to do. For a snap built from local source,
+        that includes the source tree in the current dir.
+
+        @param bool installed: If False, leave out the installed revision of
+          our snap, to describe the Step itself rather than its effect on
+          this host.
+
+        '''
+        location = self.location() if self._sources() else ''
+        rev = None
+        if self.snap and installed:
+            rev = self.facts.installed_snaps.get(self.snap, {}).get('rev')
+
+        source = None
+        if self.snap and not self._snap_store:
+            source = fingerprint_tree(os.getcwd(), extra=self.snap)
+
+        fields = {
+            'snap': self.snap,
+            'source': source,
+            'location': location,
+            'scripts': self._scripts,
+            'files': self._files,
+            'templates': self._templates,
+            'variables': self._template_vars() if self._templates else None,
+            'config_dir': self._config_dir,
+            'snap_store': self._snap_store,
+            'flags': self.install_flags() if self.snap else None,
+            'rev': rev,
+            'http_proxy': self._http_proxy,
+            'https_proxy': self._https_proxy,
+            'allow_unauthenticated': self.facts.apt_unauthenticated,
+        }
+        if self.host is not None:
+            fields['host'] = self.host
+
+        h = hashlib.sha256()
+        h.update(json.dumps(fields, sort_keys=True).encode('utf-8'))
+
+        for rel_path in self._sources():
+            with open(self._source(location, rel_path), 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+
+        return h.hexdigest()
+
+    def stage(self, **kwargs):
+        '''
+        Put our scripts and files in place, without installing or running
+        anything. Used when a Plan skips a Step that has already run, so
+        that later Steps can still find its files in $BASE_DIR.
+
+        Takes the same keyword args as configure.
+
+        '''
+        self.configure(**kwargs)
+        with self.tracer.span(self.label, 'step', skipped=True):
+            location = self.location()
+            for rel_path in self._files + self._scripts:
+                self._fetch(location, rel_path)
+            self._put()
+
+    def run(self, tempdir=None, http_proxy=None, https_proxy=None,
+            channel=None, **kwargs):
+        '''
+        Run the set of tests defined by this snap (or just download some
+        config files, if the step has no executable components).
+
+        Any other keyword args are passed along to configure.
+
+        '''
+        self._prepare(tempdir, http_proxy, https_proxy, channel, **kwargs)
+        with self.tracer.span(self.label, 'step'):
+            self._run()
+
+    async def arun(self, tempdir=None, http_proxy=None, https_proxy=None,
+                   channel=None, **kwargs):
+        '''
+        A coroutine that does what run does, running our scripts as asyncio
+        subprocesses, and the rest in the event loop's default executor.
+
+        Enforces our timeout. If cancelled, or timed out, kills whichever
+        of our scripts is running.
+
+        '''
+        self._prepare(tempdir, http_proxy, https_proxy, channel, **kwargs)
+        timeout = self.timeout or self._default_timeout
+        with self.tracer.span(self.label, 'step'):
+            try:
+                await asyncio.wait_for(self._arun(), timeout)
+            except asyncio.TimeoutError:
+                raise TestFailure(
+                    'Step "{}" timed out after {}s'.format(
+                        self.label, timeout),
+                    output=self.output.tail())
+
+    def _prepare(self, tempdir, http_proxy, https_proxy, channel, **kwargs):
+        self.configure(tempdir=tempdir, http_proxy=http_proxy,
+                       https_proxy=https_proxy, **kwargs)
+
         # Possibly override channel.
         if channel is not None:
-            self._channel = '--channel={channel}'.format(channel)
+            self._channel = '--channel={channel}'.format(channel=channel)
 
-        location_vars = dict(config.LOCATION_VARS)  # Copy
-        location_vars['snap'] = self.snap
-        location = self._location.format(**location_vars)
+    def _stage_script(self, location, script):
+        script = self._fetch(location, script)
+        os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
+        return script
 
-        env = self._make_env()
+    def _check_script(self, script, returncode):
+        if returncode > 0:
+            raise TestFailure(
+                'Failed to run test "{script}'.format(script=script),
+                output=self.output.tail())
 
-        if self.snap:
-            self._install_snap()
+    def _script_timed_out(self, script, timeout):
+        return TestFailure(
+            'Test "{}" timed out after {}s'.format(script, timeout),
+            output=self.output.tail())
 
-        for f in self._files:
-            self._fetch(location, f)
+    def _ready(self):
+        '''
+        Return our ready conditions, set to check the host that we run on.
 
-        for script in self._scripts:
-            script = self._fetch(location, script)
-            os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
-            p = subprocess.run([script], env=env)
-            if p.returncode > 0:
-                raise TestFailure(
-                    'Failed to run test "{script}'.format(script=script))
+        '''
+        return [condition.on(self.transport) for condition in self.ready]
+
+    def _check_ready(self, waiting, timeout):
+        if waiting:
+            raise TestFailure(
+                'Step "{}" not ready after {}s; still waiting on {}'.format(
+                    self.label, timeout, ', '.join(str(c) for c in waiting)),
+                output=self.output.tail())
+
+    def _put(self):
+        '''
+        Copy our staged scripts and files to our host, if it's remote, to
+        the same place under BASE_DIR.
+
+        '''
+        if not self.transport.remote:
+            return
+        with self.tracer.span(str(self.transport), 'fetch', step=self.label):
+            self.transport.put(self.tempdir, self._files + self._scripts)
+
+    def _template_vars(self):
+        variables = dict(config.TEMPLATE_VARS)
+        variables['http_proxy'] = self._http_proxy or ''
+        variables['https_proxy'] = self._https_proxy or ''
+        variables['snap'] = self.snap or ''
+        variables.update(self._variables)
+        return variables
+
+    def _config_path(self, rel_path):
+        '''
+        Return the path on our host that the template at rel_path renders
+        to.
+
+        '''
+        config_dir = (self._config_dir or config.CONFIG_DIR).format(
+            snap=self.snap, base_dir=self.tempdir)
+        prefix = 'etc/snap-{}/'.format(self.snap)
+        if rel_path.startswith(prefix):
+            rel_path = rel_path[len(prefix):]
+        return os.path.join(config_dir, rel_path)
+
+    def _render(self, location, env):
+        '''
+        Render our templates into place, note which files changed in
+        self.changed, and tell our scripts about them via env.
+
+        '''
+        self.changed = []
+        if not self._templates:
+            return
+        with self.tracer.span('templates', 'render', step=self.label):
+            variables = self._template_vars()
+            files = OrderedDict()
+            for rel_path in self._templates:
+                source = self._retry('fetch', self._source, location,
+                                     rel_path)
+                files[self._config_path(rel_path)] = self.renderer.render(
+                    source, variables)
+            self.changed = self.renderer.install(
+                files, self.transport, self.tempdir)
+        self.log.info('Step {}: {} of {} config files changed{}'.format(
+            self.label, len(self.changed), len(files),
+            ': ' + ', '.join(self.changed) if self.changed else ''))
+        env['SNAPSTACK_CHANGED_CONFIG'] = ' '.join(self.changed)
+
+    def _run_script(self, script, env, timeout):
+        cmd, env = self.transport.command([script], env)
+        with self.tracer.span(script, 'script', step=self.label):
+            try:
+                returncode = run_script(
+                    cmd, self.label, self.sink, self.output,
+                    timeout=timeout, env=env)
+            except subprocess.TimeoutExpired:
+                raise self._script_timed_out(script, timeout)
+        self._check_script(script, returncode)
+
+    async def _arun_script(self, script, env, timeout):
+        cmd, env = self.transport.command([script], env)
+        with self.tracer.span(script, 'script', step=self.label):
+            try:
+                returncode = await arun_script(
+                    cmd, self.label, self.sink, self.output,
+                    timeout=timeout, env=env)
+            except asyncio.TimeoutError:
+                raise self._script_timed_out(script, timeout)
+        self._check_script(script, returncode)
+
+    def _run(self):
+        location = self.location()
+        script_timeout = self.script_timeout or self._default_script_timeout
+
+        with self.tracer.span('env', 'env', step=self.label):
+            env = self._make_env()
+
+        try:
+            if self.snap:
+                with self.tracer.span(self.snap, 'install', step=self.label):
+                    self._install_snap()
+                self.facts.invalidate('snaps')
+
+            for f in self._files:
+                self._fetch(location, f)
+            scripts = [self._stage_script(location, script)
+                       for script in self._scripts]
+            self._put()
+            self._render(location, env)
+
+            for script in scripts:
+                self._retry('script', self._run_script, script, env,
+                            script_timeout)
+
+            if self.ready:
+                timeout = self.ready_timeout or ready_timeout()
+                with self.tracer.span('ready', 'ready', step=self.label):
+                    self._check_ready(
+                        wait_ready(self._ready(), timeout), timeout)
+        finally:
+            if self.invalidates:
+                self.facts.invalidate(*self.invalidates)
+
+    async def _arun(self):
+        loop = asyncio.get_event_loop()
+        location = self.location()
+        script_timeout = self.script_timeout or self._default_script_timeout
+
+        with self.tracer.span('env', 'env', step=self.label):
+            env = await loop.run_in_executor(None, self._make_env)
+
+        try:
+            if self.snap:
+                with self.tracer.span(self.snap, 'install', step=self.label):
+                    await self._ainstall_snap()
+                self.facts.invalidate('snaps')
+
+            for f in self._files:
+                await loop.run_in_executor(None, self._fetch, location, f)
+            scripts = []
+            for script in self._scripts:
+                scripts.append(await loop.run_in_executor(
+                    None, self._stage_script, location, script))
+            await loop.run_in_executor(None, self._put)
+            await loop.run_in_executor(None, self._render, location, env)
+
+            for script in scripts:
+                await self._aretry('script', self._arun_script, script, env,
+                                   script_timeout)
+
+            if self.ready:
+                timeout = self.ready_timeout or ready_timeout()
+                with self.tracer.span('ready', 'ready', step=self.label):
+                    self._check_ready(
+                        await await_ready(self._ready(), timeout), timeout)
+        finally:
+            if self.invalidates:
+                self.facts.invalidate(*self.invalidates)
@@ -0,0 +1,357 @@
+'''
+Helpers for testing snapstack, and Plans built on it, without touching
+the network.
+
+'''
+
+import email.utils
+import hashlib
+import http.server
+import io
+import os
+import socketserver
+import subprocess
+import threading
+import time
+from unittest import mock
+
+from snapstack import config
+from snapstack.transport import Transport
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    '''
+    Serve the files registered on our FakeServer, honoring the conditional
+    request headers that snapstack sends.
+
+    '''
+    protocol_version = 'HTTP/1.1'  # Allow keep-alive.
+    disable_nagle_algorithm = True  # Don't stall small responses.
+
+    def log_message(self, *args):
+        pass  # Keep test output quiet.
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        self.server.fake.requests.append(
+            (self.command, self.path, dict(self.headers)))
+        self.server.fake.clients.add(self.client_address)
+
+        files = self.server.fake.files
+        if self.path not in files:
+            self.send_error(404)
+            return
+
+        body = files[self.path]
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        modified = email.utils.formatdate(
+            self.server.fake.mtimes.get(self.path, 0), usegmt=True)
+
+        if self.headers.get('If-None-Match') == etag or (
+                self.headers.get('If-None-Match') is None and
+                self.headers.get('If-Modified-Since') == modified):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start = self._range_start(etag, modified)
+        if start is not None and start < len(body):
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(body) - 1, len(body)))
+            self.send_header('Content-Length', str(len(body) - start))
+            if self.server.fake.etags:
+                self.send_header('ETag', etag)
+            self.send_header('Last-Modified', modified)
+            self.end_headers()
+            if not head:
+                self.wfile.write(body[start:])
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if self.server.fake.etags:
+            self.send_header('ETag', etag)
+        self.send_header('Last-Modified', modified)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _range_start(self, etag, modified):
+        '''
+        Return the offset that the client asked to resume from, if it asked
+        for an open ended range, of the current version of the file.
+
+        '''
+        requested = self.headers.get('Range', '')
+        if not (requested.startswith('bytes=') and requested.endswith('-')):
+            return None
+        if self.headers.get('If-Range') not in (None, etag, modified):
+            return None
+        return int(requested[len('bytes='):-1])
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer:
+    '''
+    A local stand-in for raw.githubusercontent.com. Register files with
+    put, point a Step's script_loc at url, and inspect requests afterwards.
+    Honors conditional requests, and open ended Range requests.
+
+    May be used as a context manager, which starts and stops the server.
+
+    '''
+    def __init__(self, etags=True):
+        '''
+        @param bool etags: If False, don't send ETag headers, so that clients
+          have to fall back to Last-Modified.
+
+        '''
+        self.files = {}
+        self.mtimes = {}
+        self.requests = []
+        self.clients = set()  # One (host, port) per connection.
+        self.etags = etags
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def put(self, path, body):
+        '''
+        Serve body (a str or bytes) at path, which should start with a "/".
+
+        '''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.files[path] = body
+        self.mtimes[path] = time.time()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _FakeProcess:
+    '''
+    What FakeRunner.popen returns: a finished process, with its output
+    waiting in its pipes.
+
+    '''
+    pid = 0
+
+    def __init__(self, returncode, output):
+        self.returncode = returncode
+        self.stdout = io.BytesIO(output)
+        self.stderr = io.BytesIO(b'')
+
+    def wait(self, timeout=None):
+        return self.returncode
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        pass
+
+    terminate = kill
+
+
+def fake_popen(returncode=0, output=b''):
+    '''
+    Return a function to use as the side_effect of a mock Popen, which
+    hands back finished processes.
+
+    @param returncode: An int, or a function that takes the command and
+      returns one.
+    @param bytes output: What each process writes to stdout.
+
+    '''
+    def popen(cmd, **kwargs):
+        rc = returncode(cmd) if callable(returncode) else returncode
+        return _FakeProcess(rc, output)
+    return popen
+
+
+# Starts a command that a FakeTransport with its own runner should run.
+_ON_HOST = 'snapstack-fake-host'
+
+
+class FakeRunner:
+    '''
+    A stand-in for subprocess.run, which pretends that every command
+    succeeds, and keeps track of which snaps are "installed", and how, so
+    that snap list, snap install, snap refresh and snap remove behave
+    sensibly. snap info lists config.CHANNEL and latest/stable as open
+    channels.
+
+    Use patch to install it for the duration of a with statement.
+    FakeTransports given a FakeRunner run their commands against a runner
+    of their own, from host, so that each host has its own snaps.
+
+    '''
+    def __init__(self, delay=0, installed=None, fail=None, output=None):
+        '''
+        @param float delay: Seconds to sleep in each call, to stand in for
+          real work.
+        @param list installed: Names of snaps to start out installed, from
+          config.CHANNEL.
+        @param callable fail: Called with each command; if it returns True,
+          the command "fails" with a returncode of 1.
+        @param callable output: Called with each command started with
+          Popen; returns the bytes that the command writes to stdout.
+
+        '''
+        self.delay = delay
+        self.installed = set(installed or [])
+        self.tracking = {}  # snap -> (channel, notes)
+        self.fail = fail
+        self.output = output
+        self.calls = []
+        self.hosts = {}  # Host name -> FakeRunner
+        self._lock = threading.Lock()
+
+    def host(self, name):
+        '''
+        Return the FakeRunner for the host called name, which fails, and
+        writes output, as we do, but keeps track of its own snaps.
+
+        '''
+        with self._lock:
+            if name not in self.hosts:
+                self.hosts[name] = FakeRunner(
+                    delay=self.delay, fail=self.fail, output=self.output)
+            return self.hosts[name]
+
+    def patch(self):
+        '''
+        Stand in for subprocess.run and subprocess.Popen.
+
+        '''
+        return mock.patch.multiple('subprocess', run=self, Popen=self.popen)
+
+    def popen(self, cmd, **kwargs):
+        argv = cmd[0].split() if kwargs.get('shell') else list(cmd)
+        if argv[:1] == [_ON_HOST]:
+            return self.host(argv[1]).popen(argv[2:],
+                                            **dict(kwargs, shell=False))
+        kwargs.pop('stdout', None)
+        result = self(cmd, **kwargs)
+        output = self.output(argv) if self.output is not None else b''
+        return _FakeProcess(result.returncode, output)
+
+    def __call__(self, cmd, **kwargs):
+        argv = cmd[0].split() if kwargs.get('shell') else list(cmd)
+        if argv[:1] == [_ON_HOST]:
+            return self.host(argv[1])(argv[2:], **dict(kwargs, shell=False))
+        with self._lock:
+            self.calls.append(argv)
+        if self.delay:
+            time.sleep(self.delay)
+
+        returncode = 1 if self.fail is not None and self.fail(argv) else 0
+        stdout = b''
+        if argv[:1] == ['sudo']:
+            argv = argv[1:]
+
+        if argv[:2] == ['snap', 'list']:
+            with self._lock:
+                stdout = ''.join(
+                    ['Name Version Rev Tracking Publisher Notes\n'] +
+                    ['{} 1.0 1 {} fake {}\n'.format(
+                        snap, *self.tracking.get(snap, (config.CHANNEL, '-')))
+                     for snap in sorted(self.installed)]).encode('utf-8')
+        elif argv[:2] in (['snap', 'install'], ['snap', 'refresh']) and \
+                returncode == 0:
+            snaps = [a for a in argv[2:] if not a.startswith('-')]
+            channel = 'latest/stable'
+            for a in argv:
+                if a.startswith('--channel='):
+                    channel = a[len('--channel='):]
+            notes = 'classic' if '--classic' in argv else '-'
+            with self._lock:
+                self.installed.update(snaps)
+                for snap in snaps:
+                    self.tracking[snap] = (channel, notes)
+            if '--no-wait' in argv:
+                stdout = b'1\n'
+        elif argv[:2] == ['snap', 'info'] and returncode == 0:
+            stdout = ''.join(
+                ['name: {}\n'.format(argv[2]), 'channels:\n'] +
+                ['  {}: 1.0 1 1MB -\n'.format(channel)
+                 for channel in [config.CHANNEL, 'latest/stable']]
+            ).encode('utf-8')
+        elif argv[:2] == ['snap', 'remove'] and returncode == 0:
+            with self._lock:
+                self.installed.difference_update(argv[2:])
+
+        return subprocess.CompletedProcess(
+            cmd, returncode,
+            stdout=stdout if kwargs.get('stdout') == subprocess.PIPE
+            else None)
+
+
+class FakeTransport(Transport):
+    '''
+    A stand-in for a remote host, which runs everything on this one, and
+    records what it was asked to run, and copy, there.
+
+    '''
+    remote = True
+
+    def __init__(self, name, runner=None):
+        '''
+        @param string name: The host's name.
+        @param FakeRunner runner: The FakeRunner that will be patched in.
+          If given, our commands are run by runner.host(name), which is
+          kept as our runner, rather than by runner itself.
+
+        '''
+        super(FakeTransport, self).__init__(name)
+        self.runner = None if runner is None else runner.host(name)
+        self.commands = []
+        self.envs = []
+        self.puts = []
+        self.connects = 0
+        self._lock = threading.Lock()
+
+    def command(self, cmd, env=None):
+        with self._lock:
+            self.commands.append(list(cmd))
+            self.envs.append(env)
+        if env is not None:
+            env = dict(os.environ, **env)
+        if self.runner is not None:
+            return [_ON_HOST, self.name] + list(cmd), env
+        return list(cmd), env
+
+    def put(self, root, paths):
+        with self._lock:
+            self.puts.append((root, list(paths)))
+
+    def connect(self):
+        with self._lock:
+            self.connects += 1
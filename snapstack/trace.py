@@ -0,0 +1,180 @@
+'''
+Record how long each Step, and each phase of each Step, takes, and
+export the results as a Chrome trace (which Perfetto will also open) or
+a plain summary table.
+
+'''
+
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+PHASES = ['env', 'install', 'fetch', 'script', 'ready']
+
+
+class Tracer:
+    '''
+    Collects timed spans. Safe to share between threads.
+
+    '''
+    def __init__(self):
+        self._events = []
+        self._open = {}
+        self._threads = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def span(self, name, cat, **args):
+        '''
+        Time the body of a with statement.
+
+        @param string name: What we're timing; a step name, a script path...
+        @param string cat: The kind of thing we're timing. Steps use 'step'
+          for themselves, and the names in PHASES for their phases.
+        @param args: Anything else worth recording. Spans opened inside a
+          'step' span, on the same thread, are tagged with step=<the step's
+          name>. Steps that run as coroutines share a thread, so they pass
+          step explicitly.
+
+        '''
+        stack = self._stack()
+        if cat == 'step':
+            args.setdefault('step', name)
+        elif stack:
+            args.setdefault('step', stack[-1])
+
+        stack.append(args.get('step'))
+        token = object()
+        with self._lock:
+            self._open[token] = (args.get('step'), cat, name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            stack.pop()
+            with self._lock:
+                del self._open[token]
+            self._record(name, cat, start, end, args)
+
+    def active(self):
+        '''
+        Return a list of (step, cat, name) for each span that is open right
+        now, on any thread. step is None for spans outside of a Step.
+
+        '''
+        with self._lock:
+            return list(self._open.values())
+
+    def counter(self, name, values):
+        '''
+        Record the values of one or more counters, such as CPU or memory
+        use, at this moment. They show up as graphs in the Chrome trace.
+
+        @param dict values: Maps the name of each series to its value.
+
+        '''
+        with self._lock:
+            self._events.append({
+                'name': name,
+                'cat': 'counter',
+                'ph': 'C',
+                'ts': int(time.time() * 1e6),
+                'pid': os.getpid(),
+                'args': dict(values),
+            })
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _record(self, name, cat, start, end, args):
+        thread = threading.current_thread()
+        with self._lock:
+            tid = self._threads.setdefault(
+                thread.ident, (len(self._threads) + 1, thread.name))[0]
+            self._events.append({
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': int(start * 1e6),
+                'dur': int((end - start) * 1e6),
+                'pid': os.getpid(),
+                'tid': tid,
+                'args': args,
+            })
+
+    @property
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def chrome_trace(self):
+        '''
+        Return our spans in the Chrome trace event format.
+
+        '''
+        with self._lock:
+            meta = [{
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': os.getpid(),
+                'tid': tid,
+                'args': {'name': name},
+            } for tid, name in self._threads.values()]
+            return {
+                'traceEvents': meta + list(self._events),
+                'displayTimeUnit': 'ms',
+            }
+
+    def write(self, path):
+        '''
+        Write our spans to path as a Chrome trace.
+
+        '''
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def durations(self):
+        '''
+        Return an OrderedDict mapping each step's name to a dict of
+        seconds spent: 'total', plus one key per phase in PHASES.
+
+        '''
+        steps = OrderedDict()
+        for event in sorted(self.events, key=lambda e: e['ts']):
+            step = event['args'].get('step')
+            if step is None:
+                continue
+            row = steps.setdefault(
+                step, dict({p: 0.0 for p in PHASES}, total=0.0))
+            seconds = event['dur'] / 1e6
+            if event['cat'] == 'step':
+                row['total'] += seconds
+            elif event['cat'] in row:
+                row[event['cat']] += seconds
+        return steps
+
+    def summary(self):
+        '''
+        Return a plain text table of the time spent in each step.
+
+        '''
+        rows = [['step', 'total'] + PHASES]
+        for step, row in self.durations().items():
+            rows.append([step] + ['{:.2f}s'.format(row[c])
+                                  for c in ['total'] + PHASES])
+
+        widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+        lines = []
+        for row in rows:
+            lines.append('  '.join(
+                [row[0].ljust(widths[0])] +
+                [c.rjust(w) for c, w in zip(row[1:], widths[1:])]))
+        return '\n'.join(lines)
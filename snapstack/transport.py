@@ -0,0 +1,170 @@
+'''
+Transports carry the commands that Steps run, and the files that they
+stage, to the host that the Step is placed on: this one, or another
+reached over ssh.
+
+A Transport doesn't run anything itself. It turns a command into the
+argv to run here, so that the rest of snapstack can keep running
+everything through subprocess, whichever host it's for.
+
+'''
+
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+
+from snapstack.errors import InfraFailure
+
+
+LOCAL = 'local'  # The name of the host that snapstack runs on.
+CONTROL_PERSIST = 600  # Seconds to keep an idle ssh connection open.
+
+
+class Transport:
+    '''
+    Runs commands on this host. Subclasses reach other hosts.
+
+    '''
+    remote = False
+
+    def __init__(self, name=LOCAL):
+        self.name = name
+
+    def command(self, cmd, env=None):
+        '''
+        Return the argv, and environment, with which to run cmd here so
+        that it runs on our host.
+
+        @param list cmd: The command to run.
+        @param dict env: The environment for cmd. Remote transports only
+          send what's in env, which should be just the variables that
+          snapstack adds, not a copy of our own environment.
+
+        '''
+        return list(cmd), env
+
+    def put(self, root, paths):
+        '''
+        Copy paths, relative to the dir root, to the same place under root
+        on our host, in one go. A no-op for this host.
+
+        '''
+        pass
+
+    def connect(self):
+        '''
+        Get ready to run commands. A no-op for this host.
+
+        '''
+        pass
+
+    def close(self):
+        '''
+        Let go of anything that connect set up.
+
+        '''
+        pass
+
+    def __str__(self):
+        return self.name
+
+
+class SSHTransport(Transport):
+    '''
+    Runs commands on another host over ssh, sharing one connection between
+    all of them, via ssh's ControlMaster multiplexing. That saves a
+    handshake per command, which adds up quickly with many hosts.
+
+    Needs key based, non interactive, login, and passwordless sudo on the
+    other host.
+
+    '''
+    remote = True
+
+    def __init__(self, host, name=None, user=None, port=None, options=None,
+                 persist=None):
+        '''
+        @param string host: The host to connect to.
+        @param string name: What to call the host in a Plan's placement,
+          and in logs. Defaults to host.
+        @param string user: Log in as this user.
+        @param int port: Connect to this port.
+        @param list options: Any other args for ssh, such as
+          ['-i', '/path/to/key'].
+        @param int persist: Seconds to keep the connection open once it's
+          idle. Defaults to CONTROL_PERSIST.
+
+        '''
+        super(SSHTransport, self).__init__(name or host)
+        self.host = host
+        self.user = user
+        self.port = port
+        self.options = list(options or [])
+        self.persist = persist or CONTROL_PERSIST
+        # Control sockets have to have short paths.
+        self._control_dir = tempfile.mkdtemp(prefix='snapstack-ssh-')
+
+    def ssh(self):
+        '''
+        Return the ssh command, up to and including the host, that reuses
+        our connection.
+
+        '''
+        cmd = [
+            'ssh',
+            '-o', 'BatchMode=yes',
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={}'.format(
+                os.path.join(self._control_dir, '%C')),
+            '-o', 'ControlPersist={}'.format(self.persist),
+        ]
+        if self.user is not None:
+            cmd += ['-l', self.user]
+        if self.port is not None:
+            cmd += ['-p', str(self.port)]
+        return cmd + self.options + [self.host]
+
+    def command(self, cmd, env=None):
+        words = list(cmd)
+        if env:
+            words = ['env'] + ['{}={}'.format(k, v)
+                               for k, v in sorted(env.items())] + words
+        return self.ssh() + [' '.join(shlex.quote(w) for w in words)], None
+
+    def put(self, root, paths):
+        '''
+        Copy paths to our host as a single tar stream, over our shared
+        connection.
+
+        '''
+        if not paths:
+            return
+        tar = subprocess.Popen(['tar', '-C', root, '-cf', '-', '--'] +
+                               list(paths), stdout=subprocess.PIPE)
+        p = subprocess.run(
+            self.ssh() + ['mkdir -p {0} && tar -C {0} -xf -'.format(
+                shlex.quote(root))],
+            stdin=tar.stdout)
+        tar.stdout.close()
+        if tar.wait() != 0 or p.returncode != 0:
+            raise InfraFailure('Failed to copy files to {}'.format(self))
+
+    def connect(self):
+        '''
+        Open our shared connection, which then stays open in the
+        background, so that the first command doesn't pay for it.
+
+        '''
+        os.makedirs(self._control_dir, exist_ok=True)
+        p = subprocess.run(self.ssh() + ['true'])
+        if p.returncode != 0:
+            raise InfraFailure('Failed to connect to {}'.format(self))
+
+    def close(self):
+        if not os.path.isdir(self._control_dir):
+            return
+        subprocess.run(self.ssh()[:-1] + ['-O', 'exit', self.host],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self._control_dir, ignore_errors=True)
@@ -0,0 +1,206 @@
+'''
+Keep a deployed base cloud around between Plans, and put it back the way
+it was before each one, rather than reinstalling it.
+
+'''
+
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import tempfile
+
+from snapstack import config, journal
+from snapstack.errors import InfraFailure
+
+
+def fingerprint(steps):
+    '''
+    Return a fingerprint for a list of base Steps, which must already have
+    been configured. Plans whose bases have the same fingerprint may share
+    a warm base.
+
+    '''
+    h = hashlib.sha256()
+    for step in steps:
+        h.update('{}={}\n'.format(
+            step.name, step.fingerprint(installed=False)).encode('utf-8'))
+    return h.hexdigest()
+
+
+class WarmBase:
+    '''
+    A snapshot of a deployed base: a "snap save" of each base snap, a dump
+    of the MySQL databases, and the RabbitMQ users, and their permissions
+    on the default vhost. (rabbitmqctl only exports definitions from 3.8
+    on, and the distro rabbitmq-server that packages.sh installs is older,
+    so we list them ourselves.)
+
+    '''
+    def __init__(self, path=None, passwords=None):
+        '''
+        @param string path: Where to keep the snapshot's manifest and dumps.
+          Defaults to a "warm" dir under the state dir.
+        @param dict passwords: Maps RabbitMQ users to their passwords, which
+          rabbitmqctl won't list, so that we can add them back if they've
+          been deleted since we captured them. Defaults to the user and
+          password in config.TEMPLATE_VARS, which rabbitmq.sh sets up.
+
+        '''
+        self.log = logging.getLogger()
+        self.path = path or os.path.join(journal.default_dir(), 'warm')
+        self.passwords = passwords or {
+            config.TEMPLATE_VARS['rabbitmq_user']:
+                config.TEMPLATE_VARS['rabbitmq_password'],
+        }
+        self._manifest_path = os.path.join(self.path, 'manifest.json')
+        self._mysql_path = os.path.join(self.path, 'mysql.sql')
+        self._rabbitmq_path = os.path.join(self.path, 'rabbitmq.json')
+
+    @property
+    def manifest(self):
+        try:
+            with open(self._manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _run(self, cmd, **kwargs):
+        p = subprocess.run(cmd, **kwargs)
+        if p.returncode != 0:
+            raise InfraFailure('Failed to run "{}"'.format(' '.join(cmd)))
+        return p
+
+    def capture(self, fingerprint, snaps):
+        '''
+        Snapshot the base that we've just deployed.
+
+        @param string fingerprint: The fingerprint of the base's steps.
+        @param list snaps: The snaps installed by the base.
+
+        '''
+        self.discard()
+        os.makedirs(self.path, exist_ok=True)
+
+        snapshot = None
+        if snaps:
+            p = self._run(['sudo', 'snap', 'save'] + snaps,
+                          stdout=subprocess.PIPE)
+            # The first column of the first row after the header is the id
+            # of the snapshot set.
+            lines = p.stdout.decode('utf-8').strip().split(os.linesep)
+            snapshot = lines[1].split()[0]
+
+        with open(self._mysql_path, 'wb') as f:
+            self._run(['sudo', 'mysqldump', '--all-databases',
+                       '--single-transaction'], stdout=f)
+
+        with open(self._rabbitmq_path, 'w') as f:
+            json.dump({
+                'users': self._rabbitmq_users(),
+                'permissions': self._rabbitmq_list('list_permissions'),
+            }, f)
+
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'fingerprint': fingerprint,
+                'snapshot': snapshot,
+                'snaps': snaps,
+            }, f)
+        os.replace(tmp, self._manifest_path)
+
+    def matches(self, fingerprint, installed):
+        '''
+        Return True if we have a snapshot of a base with fingerprint, and
+        its snaps are all still installed.
+
+        @param dict installed: The installed snaps, as in
+          facts.HostFacts.installed_snaps.
+
+        '''
+        manifest = self.manifest
+        return (manifest is not None and
+                manifest['fingerprint'] == fingerprint and
+                all(snap in installed for snap in manifest['snaps']))
+
+    def restore(self):
+        '''
+        Put the base back the way it was when we captured it.
+
+        '''
+        manifest = self.manifest
+        if manifest['snapshot'] is not None:
+            self._run(['sudo', 'snap', 'restore', manifest['snapshot']])
+            self._run(['sudo', 'snap', 'restart'] + manifest['snaps'])
+
+        with open(self._mysql_path, 'rb') as f:
+            self._run(['sudo', 'mysql'], stdin=f)
+
+        with open(self._rabbitmq_path) as f:
+            self._restore_rabbitmq(json.load(f))
+
+    def _rabbitmq_list(self, command):
+        '''
+        Return the rows that rabbitmqctl command lists, for the default
+        vhost, as lists of fields, leaving out the banners and headers that
+        various versions of rabbitmqctl add.
+
+        '''
+        p = self._run(['sudo', 'rabbitmqctl', '-q', command],
+                      stdout=subprocess.PIPE)
+        rows = []
+        for line in p.stdout.decode('utf-8').splitlines():
+            fields = line.split('\t')
+            if len(fields) < 2 or fields[0] == 'user':
+                continue
+            rows.append(fields)
+        return rows
+
+    def _rabbitmq_users(self):
+        '''
+        Return a dict mapping each RabbitMQ user to its list of tags.
+
+        '''
+        return {fields[0]: fields[1].strip('[]').replace(',', ' ').split()
+                for fields in self._rabbitmq_list('list_users')}
+
+    def _restore_rabbitmq(self, saved):
+        '''
+        Put the RabbitMQ users, and their permissions, back as they were in
+        saved: delete users added since, add back ones deleted since (if we
+        know their passwords), and reset everyone's permissions.
+
+        '''
+        users = self._rabbitmq_users()
+        for user in users:
+            if user not in saved['users']:
+                self._run(['sudo', 'rabbitmqctl', 'delete_user', user])
+        for user, tags in saved['users'].items():
+            if user in users:
+                continue
+            if user not in self.passwords:
+                raise InfraFailure(
+                    'Cannot restore RabbitMQ user {} without its '
+                    'password'.format(user))
+            self._run(['sudo', 'rabbitmqctl', 'add_user', user,
+                       self.passwords[user]])
+            self._run(['sudo', 'rabbitmqctl', 'set_user_tags', user] + tags)
+        for user in saved['users']:
+            self._run(['sudo', 'rabbitmqctl', 'clear_permissions', user])
+        for fields in saved['permissions']:
+            self._run(['sudo', 'rabbitmqctl', 'set_permissions'] +
+                      fields[:4])
+
+    def discard(self):
+        '''
+        Forget our snapshot, if we have one.
+
+        '''
+        manifest = self.manifest
+        if manifest is None:
+            return
+        if manifest['snapshot'] is not None:
+            subprocess.run(['sudo', 'snap', 'forget', manifest['snapshot']])
+        os.remove(self._manifest_path)
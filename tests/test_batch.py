@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+
+from snapstack import Batch, Plan, Step
+from snapstack.cache import FetchCache
+from snapstack.testing import FakeRunner
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.scripts = tempfile.TemporaryDirectory()
+        self.addCleanup(self.scripts.cleanup)
+        for name in ['base.sh', 'other_base.sh', 'base_cleanup.sh',
+                     'a.sh', 'b.sh', 'c.sh', 'cleanup.sh']:
+            with open(os.path.join(self.scripts.name, name), 'w') as f:
+                f.write('#!/bin/sh\n')
+
+        self.runner = FakeRunner(fail=lambda argv: argv[0].endswith('b.sh'))
+        patcher = self.runner.patch()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _step(self, script, **kwargs):
+        return Step(script_loc=self.scripts.name + '/', scripts=[script],
+                    name=script, **kwargs)
+
+    def _plan(self, test, base='base.sh'):
+        return Plan(
+            tests=[self._step(test)],
+            test_cleanup=[self._step('cleanup.sh')],
+            base_setup=[self._step(base, snap='keystone')],
+            base_cleanup=[self._step('base_cleanup.sh')],
+            cache=FetchCache(path=os.path.join(self.scripts.name, 'cache')),
+            resume=False,
+            warm_base=False)
+
+    def _ran(self, script):
+        return len([c for c in self.runner.calls if c[0].endswith(script)])
+
+    def test_shared_base(self):
+        a, b, c = self._plan('a.sh'), self._plan('b.sh'), self._plan(
+            'c.sh', base='other_base.sh')
+        batch = Batch([a, b, c])
+
+        self.assertEqual(list(batch.groups().values()), [[a, b], [c]])
+
+        results = batch.run()
+
+        self.assertEqual(results[a], [])
+        self.assertEqual(len(results[b]), 1)
+        self.assertEqual(results[c], [])
+
+        # Each base deploys, and is torn down, once.
+        self.assertEqual(self._ran('/base.sh'), 1)
+        self.assertEqual(self._ran('/other_base.sh'), 1)
+        self.assertEqual(self._ran('/base_cleanup.sh'), 2)
+        # Every plan cleans up after its tests, even the one that failed.
+        self.assertEqual(self._ran('/cleanup.sh'), 3)
+        # Each plan's base files are staged for its tests.
+        self.assertTrue(os.path.exists(os.path.join(b.tempdir, 'base.sh')))
+        self.assertEqual(self.runner.installed, set())
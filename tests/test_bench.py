@@ -0,0 +1,30 @@
+import unittest
+
+from snapstack import bench
+
+
+class TestBench(unittest.TestCase):
+
+    def test_run(self):
+        results = bench.run(steps=6, files=3, width=2)
+
+        self.assertEqual(results['steps'], 12)
+        self.assertEqual(results['http_requests'], 18)
+        # One snap install and one watch per store step, a script per
+        # script step, plus a snap list each time more store steps become
+        # ready, and a batched remove.
+        self.assertLess(results['forks_per_step'], 2.5)
+        self.assertGreater(results['peak_memory'], 0)
+
+    def test_compare(self):
+        baseline = {'wall': 1.0, 'forks_per_step': 2.0, 'peak_memory': 100}
+
+        self.assertEqual(bench.compare(
+            {'wall': 1.1, 'forks_per_step': 2.0, 'peak_memory': 90},
+            baseline, 0.2), [])
+
+        regressions = bench.compare(
+            {'wall': 1.5, 'forks_per_step': 2.0, 'peak_memory': 90},
+            baseline, 0.2)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('wall'))
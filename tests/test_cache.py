@@ -0,0 +1,251 @@
+import fcntl
+import hashlib
+import json
+import mock
+import os
+import tempfile
+import unittest
+
+from snapstack.cache import BuildCache, FetchCache, fingerprint_tree
+from snapstack.errors import InfraFailure
+from snapstack.testing import FakeServer
+
+
+class TestFetchCache(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.server = FakeServer().start()
+        self.server.put('/a.sh', '#!/bin/bash\necho a\n')
+        self.server.put('/b.sh', '#!/bin/bash\necho b\n')
+
+    def tearDown(self):
+        self.server.stop()
+        self._dir.cleanup()
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_revalidate(self):
+        cache = FetchCache(path=self._dir.name)
+        url = self.server.url + '/a.sh'
+
+        first = cache.get(url)
+        second = cache.get(url)
+
+        self.assertEqual(first, second)
+        self.assertEqual(self._read(first), self.server.files['/a.sh'])
+        self.assertEqual(
+            self.server.requests[1][2].get('If-None-Match'),
+            cache._index[url]['etag'])
+
+        # A new cache in the same dir picks up where we left off, and
+        # notices when the file changes upstream.
+        self.server.put('/a.sh', 'changed')
+        cache = FetchCache(path=self._dir.name)
+        self.assertEqual(self._read(cache.get(url)), b'changed')
+
+    def test_last_modified(self):
+        self.server.etags = False
+        cache = FetchCache(path=self._dir.name)
+        url = self.server.url + '/a.sh'
+
+        cache.get(url)
+        cache.get(url)
+
+        headers = self.server.requests[1][2]
+        self.assertNotIn('If-None-Match', headers)
+        self.assertIn('If-Modified-Since', headers)
+
+    def test_evict(self):
+        size = len(self.server.files['/a.sh'])
+        cache = FetchCache(path=self._dir.name, max_size=size + 1)
+
+        a = cache.get(self.server.url + '/a.sh')
+        b = cache.get(self.server.url + '/b.sh')
+
+        self.assertFalse(os.path.exists(a))
+        self.assertTrue(os.path.exists(b))
+        self.assertEqual(list(cache._index), [self.server.url + '/b.sh'])
+
+    def test_offline(self):
+        url = self.server.url + '/a.sh'
+        FetchCache(path=self._dir.name).get(url)
+        requests = len(self.server.requests)
+
+        cache = FetchCache(path=self._dir.name, offline=True)
+        self.assertEqual(
+            self._read(cache.get(url)), self.server.files['/a.sh'])
+        self.assertEqual(len(self.server.requests), requests)
+
+        self.assertRaises(
+            InfraFailure, cache.get, self.server.url + '/b.sh')
+
+    def test_binary_checksum(self):
+        body = bytes(range(256)) * 4096
+        digest = hashlib.sha256(body).hexdigest()
+        self.server.put('/image.img', body)
+        url = self.server.url + '/image.img'
+        cache = FetchCache(path=self._dir.name)
+
+        self.assertRaises(InfraFailure, cache.get, url, sha256='0' * 64)
+        self.assertNotIn(url, cache._index)
+
+        self.assertEqual(self._read(cache.get(url, sha256=digest)), body)
+
+        # A cached file that matches its checksum isn't revalidated.
+        requests = len(self.server.requests)
+        cache.get(url, sha256=digest)
+        self.assertEqual(len(self.server.requests), requests)
+
+    def test_resume(self):
+        '''
+        _test_resume
+
+        An interrupted download should pick up where it left off, as long
+        as the file hasn't changed.
+
+        '''
+        body = b'x' * 1000 + b'y' * 1000
+        self.server.put('/big', body)
+        url = self.server.url + '/big'
+        cache = FetchCache(path=self._dir.name)
+
+        # Fake an interrupted download of the first half of the file.
+        cache.get(url)
+        etag = cache._index[url]['etag']
+        cache = FetchCache(path=self._dir.name + '/fresh')
+        partial = cache._partial_path(url)
+        os.makedirs(os.path.dirname(partial))
+        with open(partial, 'wb') as f:
+            f.write(body[:1000])
+        with open(partial + '.json', 'w') as f:
+            json.dump({'etag': etag}, f)
+
+        path = cache.get(url, sha256=hashlib.sha256(body).hexdigest())
+
+        self.assertEqual(self._read(path), body)
+        headers = self.server.requests[-1][2]
+        self.assertEqual(headers['Range'], 'bytes=1000-')
+        self.assertEqual(headers['Accept-Encoding'], 'identity')
+        self.assertFalse(os.path.exists(partial))
+
+        # If the file has changed, we start again.
+        with open(partial, 'wb') as f:
+            f.write(b'z' * 1000)
+        with open(partial + '.json', 'w') as f:
+            json.dump({'etag': '"stale"'}, f)
+        cache._index.clear()
+        self.assertEqual(self._read(cache.get(url)), body)
+
+    def test_partial_locked(self):
+        '''
+        _test_partial_locked
+
+        While another process is partway through downloading a url, we
+        should leave its partial download alone, and fetch our own.
+
+        '''
+        body = b'x' * 2000
+        self.server.put('/big', body)
+        url = self.server.url + '/big'
+        cache = FetchCache(path=self._dir.name)
+        partial = cache._partial_path(url)
+        os.makedirs(os.path.dirname(partial))
+        with open(partial, 'wb') as f:
+            f.write(b'x' * 1000)
+        with open(partial + '.json', 'w') as f:
+            json.dump({'etag': '"other"'}, f)
+
+        with open(partial + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            path = cache.get(url)
+
+        self.assertEqual(self._read(path), body)
+        self.assertNotIn('Range', self.server.requests[-1][2])
+        with open(partial, 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 1000)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(partial))),
+                         sorted([os.path.basename(partial) + suffix
+                                 for suffix in ['', '.json', '.lock']]))
+
+    def test_resume_encoded(self):
+        '''
+        _test_resume_encoded
+
+        If a server gzips the rest of a file despite our asking it not to,
+        we shouldn't splice its bytes onto ours.
+
+        '''
+        url = self.server.url + '/big'
+        cache = FetchCache(path=self._dir.name)
+        partial = cache._partial_path(url)
+        os.makedirs(os.path.dirname(partial))
+        with open(partial, 'wb') as f:
+            f.write(b'x' * 1000)
+        with open(partial + '.json', 'w') as f:
+            json.dump({'etag': '"1"'}, f)
+
+        encoded = mock.Mock(status_code=206,
+                            headers={'Content-Encoding': 'gzip'})
+        whole = mock.Mock(status_code=200, headers={'ETag': '"1"'})
+        whole.iter_content.return_value = [b'x' * 1000, b'y' * 1000]
+        session = mock.Mock()
+        session.get.side_effect = [encoded, whole]
+
+        path = cache.get(url, session=session)
+
+        self.assertEqual(self._read(path), b'x' * 1000 + b'y' * 1000)
+        headers = session.get.call_args[1]['headers']
+        self.assertNotIn('Range', headers)
+        self.assertEqual(headers['Accept-Encoding'], 'identity')
+
+
+class TestBuildCache(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+        self.source = os.path.join(self._dir.name, 'source')
+        self.cache_dir = os.path.join(self._dir.name, 'cache')
+        self._write('snap/snapcraft.yaml', 'name: foo\n')
+        self._write('wheelhouse/foo.whl', 'wheel')
+
+    def _write(self, rel_path, text):
+        path = os.path.join(self.source, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_fingerprint_tree(self):
+        first = fingerprint_tree(self.source)
+
+        # Build outputs don't count.
+        self._write('parts/foo/state', 'built')
+        self._write('foo_0.1_amd64.snap', 'snap')
+        self.assertEqual(fingerprint_tree(self.source), first)
+
+        self._write('wheelhouse/foo.whl', 'new wheel')
+        self.assertNotEqual(fingerprint_tree(self.source), first)
+
+    def test_get_put(self):
+        cache = BuildCache(path=self.cache_dir)
+        snap = self._write('foo_0.1_amd64.snap', 'snap')
+
+        self.assertIsNone(cache.get('abc'))
+        path = cache.put('abc', snap)
+        self.assertEqual(os.path.basename(path), 'foo_0.1_amd64.snap')
+        self.assertEqual(BuildCache(path=self.cache_dir).get('abc'), path)
+
+    def test_evict(self):
+        cache = BuildCache(path=self.cache_dir, max_size=5)
+        snap = self._write('foo.snap', 'snap')
+
+        old = cache.put('old', snap)
+        new = cache.put('new', snap)
+
+        self.assertIsNone(cache.get('old'))
+        self.assertFalse(os.path.exists(old))
+        self.assertEqual(cache.get('new'), new)
@@ -0,0 +1,58 @@
+import mock
+import unittest
+
+from snapstack.facts import HostFacts
+
+
+SNAP_LIST = '''\
+Name      Version    Rev   Tracking     Publisher   Notes
+core      16-2.30    3748  stable       canonical   core
+keystone  11.0.0     114   ocata/edge   openstack   -
+'''
+
+POLICY = '''\
+mysql-server:
+  Installed: (none)
+  Candidate: 5.7.20-0ubuntu0.16.04.1
+  Version table:
+'''
+
+
+class TestHostFacts(unittest.TestCase):
+
+    def _faux_run(self, stdout, returncode=0):
+        p = mock.Mock()
+        p.returncode = returncode
+        p.stdout = stdout.encode('utf-8')
+        return p
+
+    @mock.patch('snapstack.facts.subprocess')
+    def test_installed_snaps(self, mock_subprocess):
+        mock_subprocess.run.return_value = self._faux_run(SNAP_LIST)
+        facts = HostFacts()
+
+        snaps = facts.installed_snaps
+        self.assertEqual(sorted(snaps), ['core', 'keystone'])
+        self.assertEqual(snaps['keystone']['rev'], '114')
+        self.assertEqual(snaps['keystone']['tracking'], 'ocata/edge')
+        self.assertEqual(snaps['core']['notes'], 'core')
+
+        facts.installed_snaps
+        self.assertEqual(mock_subprocess.run.call_count, 1)
+
+        facts.invalidate('snaps')
+        facts.installed_snaps
+        self.assertEqual(mock_subprocess.run.call_count, 2)
+
+    @mock.patch('snapstack.facts.subprocess')
+    def test_package_version(self, mock_subprocess):
+        mock_subprocess.run.return_value = self._faux_run(POLICY)
+        facts = HostFacts()
+
+        self.assertEqual(
+            facts.package_version('mysql-server'), '5.7.20-0ubuntu0.16.04.1')
+        facts.package_version('mysql-server')
+        self.assertEqual(mock_subprocess.run.call_count, 1)
+
+        mock_subprocess.run.return_value = self._faux_run('')
+        self.assertIsNone(facts.package_version('nonesuch'))
@@ -0,0 +1,131 @@
+import io
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from snapstack import Plan, Step
+from snapstack.cache import FetchCache
+from snapstack.errors import InfraFailure
+from snapstack.fetch import Fetcher, split_archive
+from snapstack.testing import FakeServer
+
+
+def make_tarball(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for name, body in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(body)
+            tar.addfile(info, io.BytesIO(body))
+    return buf.getvalue()
+
+
+def make_zip(files):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as z:
+        for name, body in files.items():
+            z.writestr(name, body)
+    return buf.getvalue()
+
+
+class TestFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeServer().start()
+        for name in ['a.sh', 'b.sh', 'c.conf', 'a_cleanup.sh']:
+            self.server.put('/tests/' + name, name)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_get_once(self):
+        fetcher = Fetcher()
+        url = self.server.url + '/tests/a.sh'
+
+        path = fetcher.get(url)
+        self.assertEqual(fetcher.get(url), path)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'a.sh')
+
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_proxies(self):
+        fetcher = Fetcher(http_proxy='http://proxy:3128',
+                          https_proxy='http://sproxy:3128')
+        self.assertEqual(fetcher.session.proxies['http'], 'http://proxy:3128')
+        self.assertEqual(
+            fetcher.session.proxies['https'], 'http://sproxy:3128')
+
+    def test_plan_prefetch(self):
+        '''
+        _test_plan_prefetch
+
+        Prefetching should grab every remote file for every step in a
+        plan, over pooled connections, so that running the steps doesn't
+        touch the network again.
+
+        '''
+        loc = self.server.url + '/tests/'
+        with tempfile.TemporaryDirectory() as cache_dir:
+            plan = Plan(
+                tests=[Step(script_loc=loc, scripts=['a.sh', 'b.sh'],
+                            files=['c.conf'])],
+                test_cleanup=[Step(script_loc=loc, scripts=['a_cleanup.sh'])],
+                base_setup=[],
+                base_cleanup=[],
+                cache=FetchCache(path=cache_dir))
+
+            plan.prefetch()
+
+            paths = sorted(p for _, p, _ in self.server.requests)
+            self.assertEqual(paths, [
+                '/tests/a.sh', '/tests/a_cleanup.sh', '/tests/b.sh',
+                '/tests/c.conf'])
+            self.assertLessEqual(
+                len(self.server.clients), plan._fetcher.max_workers)
+
+            step = plan.step('test_0')
+            step._fetcher = plan._fetcher
+            path = step._fetch(loc, 'c.conf')
+            with open(path) as f:
+                self.assertEqual(f.read(), 'c.conf')
+            self.assertEqual(len(self.server.requests), 4)
+
+    def test_split_archive(self):
+        self.assertEqual(
+            split_archive('http://x/repo/archive/master.tar.gz#tests/a.sh'),
+            ('http://x/repo/archive/master.tar.gz', 'tests/a.sh'))
+        self.assertEqual(split_archive('http://x/tests/a.sh#frag'),
+                         (None, None))
+
+    def test_archive(self):
+        '''
+        _test_archive
+
+        Files in a tarball or zip should be extracted one at a time, from
+        a single download of the archive, which may or may not have a top
+        level dir.
+
+        '''
+        files = {'tests/a.sh': b'a', 'tests/etc/c.conf': b'c'}
+        self.server.put('/repo.tar.gz', make_tarball(
+            {'repo-master/' + name: body for name, body in files.items()}))
+        self.server.put('/repo.zip', make_zip(files))
+
+        for archive in ['/repo.tar.gz', '/repo.zip']:
+            fetcher = Fetcher()
+            loc = self.server.url + archive + '#tests/'
+            self.server.requests[:] = []
+
+            fetcher.prefetch([loc + 'a.sh', loc + 'etc/c.conf'])
+            for name, body in files.items():
+                path = fetcher.get(loc + name[len('tests/'):])
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(), body)
+            self.assertEqual(len(self.server.requests), 1)
+
+            with self.assertRaises(InfraFailure):
+                fetcher.get(loc + 'missing.sh')
+            with self.assertRaises(InfraFailure):
+                fetcher.get(loc + '../../escape.sh')
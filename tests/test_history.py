@@ -0,0 +1,85 @@
+import mock
+import os
+import tempfile
+import unittest
+
+from snapstack import Plan, Step
+from snapstack.errors import TestFailure
+from snapstack.history import History, percentile
+from snapstack.testing import fake_popen
+
+
+class TestHistory(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+        self.history = History(os.path.join(self._dir.name, 'history.db'))
+        self.addCleanup(self.history.close)
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(percentile([3.0, 1.0, 2.0], 50), 2.0)
+        self.assertEqual(percentile([1.0, 2.0], 50), 1.5)
+        self.assertEqual(percentile([1.0, 2.0, 3.0, 4.0, 5.0], 100), 5.0)
+
+    def test_record(self):
+        keystone = Step(snap='keystone', channel='pike/edge')
+        for n, seconds in enumerate([10.0, 12.0, 14.0, 16.0]):
+            self.history.record(keystone, seconds, 'passed', started=n)
+        self.history.record(keystone, 1.0, 'failed', started=5)
+        # The same step, from another channel, is filed separately.
+        self.history.record(Step(snap='keystone'), 100.0, 'passed')
+
+        self.assertEqual(
+            self.history.durations('keystone', channel='pike/edge'),
+            [10.0, 12.0, 14.0, 16.0])
+        self.assertEqual(
+            self.history.durations('keystone', channel='pike/edge',
+                                   outcome=None, last=2),
+            [16.0, 1.0])
+        self.assertEqual(
+            self.history.percentile('keystone', 50, channel='pike/edge'),
+            13.0)
+        self.assertAlmostEqual(
+            self.history.trend('keystone', channel='pike/edge'), 2.0)
+        self.assertEqual(self.history.expected([keystone]), {keystone: 13.0})
+        self.assertEqual(self.history.expected([Step(snap='nova')]), {})
+
+        row = self.history.summary()[('keystone', 'keystone', 'pike/edge')]
+        self.assertEqual(row['runs'], 5)
+        self.assertEqual(row['failures'], 1)
+
+        # A second History on the same file sees the same runs.
+        other = History(self.history.path)
+        self.addCleanup(other.close)
+        self.assertEqual(len(other.durations('keystone')), 5)
+
+    def test_plan(self):
+        scripts = os.path.join(self._dir.name, 'scripts') + '/'
+        os.makedirs(scripts)
+        for name in ['a.sh', 'b.sh']:
+            open(scripts + name, 'w').close()
+
+        with mock.patch('snapstack.output.subprocess') as mock_subprocess:
+            mock_subprocess.Popen.side_effect = fake_popen(
+                returncode=lambda cmd: int(cmd[0].endswith('b.sh')))
+            plan = Plan(
+                base_setup=[],
+                base_cleanup=[],
+                tests=[Step(name=n, script_loc=scripts, scripts=[n + '.sh'],
+                            requires=[]) for n in 'ab'],
+                history=self.history,
+                preflight=False,
+                resume=False,
+                warm_base=False)
+            self.assertEqual(plan.predict(), 0.0)
+            with self.assertRaises(TestFailure):
+                plan.deploy()
+
+        self.assertEqual(len(self.history.durations('a')), 1)
+        self.assertEqual(self.history.durations('b'), [])
+        self.assertEqual(len(self.history.durations('b', outcome='failed')),
+                         1)
+        # No history, no prediction.
+        self.assertIsNone(Plan(base_setup=[], base_cleanup=[]).predict())
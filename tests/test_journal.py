@@ -0,0 +1,110 @@
+import mock
+import os
+import tempfile
+import unittest
+
+from snapstack import Plan, Step
+from snapstack.errors import InfraFailure
+from snapstack.journal import Journal
+from snapstack.testing import FakeRunner, fake_popen
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+        self.scripts = os.path.join(self._dir.name, 'scripts') + '/'
+        os.makedirs(self.scripts)
+        for name in ['a.sh', 'b.sh', 'c.sh']:
+            self._write(name, name)
+
+        patcher = mock.patch('snapstack.output.subprocess')
+        self.mock_subprocess = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_subprocess.Popen.side_effect = fake_popen()
+
+        faux_p = mock.Mock()
+        faux_p.returncode = 0
+        faux_p.stdout = b''
+
+        patcher = mock.patch('snapstack.facts.subprocess')
+        patcher.start().run.return_value = faux_p
+        self.addCleanup(patcher.stop)
+
+    def _write(self, name, body):
+        with open(self.scripts + name, 'w') as f:
+            f.write(body)
+
+    def _plan(self, **kwargs):
+        plan = Plan(
+            base_setup=[Step(name=n, script_loc=self.scripts,
+                             scripts=[n + '.sh']) for n in 'abc'],
+            base_cleanup=[],
+            resume=True,
+            journal=Journal(os.path.join(self._dir.name, 'journal.json')),
+            **kwargs)
+        return plan
+
+    def _ran(self):
+        ran = [os.path.basename(c[0][0][0])
+               for c in self.mock_subprocess.Popen.call_args_list]
+        self.mock_subprocess.Popen.reset_mock()
+        return ran
+
+    def test_resume(self):
+        self._plan().deploy()
+        self.assertEqual(self._ran(), ['a.sh', 'b.sh', 'c.sh'])
+
+        plan = self._plan()
+        plan.deploy()
+        self.assertEqual(self._ran(), [])
+        # Skipped steps still stage their files.
+        self.assertTrue(os.path.exists(os.path.join(plan.tempdir, 'a.sh')))
+
+        # Changing a script reruns its step, and everything after it.
+        self._write('b.sh', 'changed')
+        self._plan().deploy()
+        self.assertEqual(self._ran(), ['b.sh', 'c.sh'])
+
+        self._plan(force=['a']).deploy()
+        self.assertEqual(self._ran(), ['a.sh', 'b.sh', 'c.sh'])
+
+    def test_destroy_forgets(self):
+        self._plan().deploy()
+        self._plan().destroy()
+        self._ran()
+
+        self._plan().deploy()
+        self.assertEqual(self._ran(), ['a.sh', 'b.sh', 'c.sh'])
+
+    def test_unnamed(self):
+        # Every step gets a name, and journal entry, of its own, even if
+        # the caller didn't name it, or named its snap twice.
+        journal = Journal(os.path.join(self._dir.name, 'journal.json'))
+
+        def plan():
+            return Plan(
+                base_setup=[Step(script_loc=self.scripts, scripts=[n])
+                            for n in ['a.sh', 'b.sh']],
+                tests=[Step(snap='foo', script_loc=self.scripts,
+                            scripts=[n]) for n in ['c.sh', 'a.sh']],
+                base_cleanup=[],
+                resume=True,
+                journal=journal)
+
+        self.assertEqual([s.name for s in plan()._all_steps()],
+                         ['setup_0', 'setup_1', 'foo', 'foo_2'])
+        with FakeRunner().patch():
+            plan().deploy()
+            self.assertEqual(self._ran(), ['a.sh', 'b.sh', 'c.sh', 'a.sh'])
+            self.assertEqual(
+                sorted(journal._entries),
+                ['setup:setup_0', 'setup:setup_1', 'test:foo', 'test:foo_2'])
+
+            plan().deploy()
+            self.assertEqual(self._ran(), [])
+
+        with self.assertRaises(InfraFailure):
+            Plan(base_setup=[Step(name='a'), Step(name='a')],
+                 base_cleanup=[])
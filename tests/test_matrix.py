@@ -0,0 +1,126 @@
+import os
+import tempfile
+import unittest
+
+import mock
+
+from snapstack import Matrix, Step
+from snapstack.cache import FetchCache
+from snapstack.errors import InfraFailure
+from snapstack.retry import Retry
+from snapstack.testing import FakeRunner, FakeServer, FakeTransport
+
+
+class TestMatrix(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = FakeRunner(
+            fail=lambda argv: 'keystone' in argv and '--classic' in argv)
+        patcher = self.runner.patch()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.server = FakeServer()
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        for name in ['keystone.sh', 'common.sh', 'base.sh']:
+            self.server.put('/tests/' + name, '#!/bin/sh\n')
+
+        self.d = tempfile.TemporaryDirectory()
+        self.addCleanup(self.d.cleanup)
+
+    def _matrix(self, **kwargs):
+        loc = self.server.url + '/tests/'
+        return Matrix(
+            tests=[
+                Step(snap='common', script_loc=loc, scripts=['common.sh']),
+                Step(snap='keystone', script_loc=loc,
+                     scripts=['keystone.sh'], requires=['common']),
+            ],
+            axes={'classic': [False, True],
+                  'channel': ['ocata/edge', 'stable']},
+            vary=['keystone'],
+            base_setup=[Step(name='base', snap='base', script_loc=loc,
+                             scripts=['base.sh'])],
+            base_cleanup=[],
+            cache=FetchCache(path=os.path.join(self.d.name, 'cache')),
+            resume=False,
+            warm_base=False,
+            retries={'install': Retry(0)},
+            **kwargs)
+
+    def _installs(self, snap, calls=None):
+        return [c for c in (self.runner.calls if calls is None else calls)
+                if 'install' in c and snap in c]
+
+    def test_run(self):
+        matrix = self._matrix()
+        cells = matrix.cells()
+        self.assertEqual(len(cells), 4)
+        # Axes vary in a fixed order, the last fastest.
+        self.assertEqual(list(cells[0]), ['channel', 'classic'])
+        self.assertEqual(Matrix.label(cells[1]),
+                         'channel=ocata/edge classic=True')
+
+        results = matrix.run()
+
+        self.assertEqual(list(results), [Matrix.label(c) for c in cells])
+        for cell in cells:
+            errors = results[Matrix.label(cell)]
+            self.assertEqual(bool(errors), cell['classic'], errors)
+
+        # The base deployed once, and the snap that doesn't vary was
+        # installed once, and kept between cells.
+        self.assertEqual(len(self._installs('base')), 1)
+        self.assertEqual(len(self._installs('common')), 1)
+        keystone = self._installs('keystone')
+        self.assertEqual(len(keystone), 4)
+        self.assertIn('--channel=stable', keystone[-1])
+        # Every file was fetched once, between all the cells.
+        gets = [path for method, path, _ in self.server.requests
+                if method == 'GET']
+        self.assertEqual(sorted(gets), ['/tests/base.sh', '/tests/common.sh',
+                                        '/tests/keystone.sh'])
+
+    def test_hosts(self):
+        hosts = [FakeTransport('a', self.runner),
+                 FakeTransport('b', self.runner)]
+        results = self._matrix(hosts=hosts).run()
+
+        self.assertEqual([bool(e) for e in results.values()],
+                         [False, True, False, True])
+        # Each host ran its own share of cells, against its own base, and
+        # its own snaps.
+        for host, channel in zip(hosts, ['ocata/edge', 'stable']):
+            scripts = [os.path.basename(c[0]) for c in host.commands
+                       if c[0].endswith('.sh')]
+            self.assertEqual(sorted(scripts),
+                             ['base.sh', 'common.sh', 'common.sh',
+                              'keystone.sh'])
+            calls = host.runner.calls
+            self.assertEqual(len(self._installs('base', calls)), 1)
+            self.assertEqual(len(self._installs('common', calls)), 1)
+            self.assertTrue(all('--channel=' + channel in c
+                                for c in self._installs('keystone', calls)))
+        self.assertFalse(self._installs('keystone'))
+
+    def test_proxy(self):
+        # The fetcher that cells share uses the same proxies as a Plan's,
+        # and times its downloads.
+        with mock.patch.dict(os.environ, {
+                'SNAPSTACK_HTTP_PROXY': 'http://proxy:3128',
+                'SNAPSTACK_HTTPS_PROXY': 'http://proxy:3129'}):
+            matrix = self._matrix()
+        self.assertEqual(matrix._fetcher.session.proxies['http'],
+                         'http://proxy:3128')
+        self.assertEqual(matrix._fetcher.session.proxies['https'],
+                         'http://proxy:3129')
+
+        matrix._fetcher.session.proxies.clear()
+        matrix._fetcher.prefetch([self.server.url + '/tests/common.sh'])
+        self.assertEqual([e['cat'] for e in matrix.tracer.events],
+                         ['download'])
+
+    def test_unknown_axis(self):
+        with self.assertRaises(InfraFailure):
+            Matrix(tests=[], axes={'flavor': ['small']})
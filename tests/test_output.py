@@ -0,0 +1,106 @@
+import asyncio
+import io
+import os
+import stat
+import subprocess
+import tempfile
+import time
+import unittest
+
+from snapstack import Step
+from snapstack.errors import TestFailure
+from snapstack.output import LogSink, RingBuffer, arun_script, run_script
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_keeps_tail(self):
+        buf = RingBuffer(max_bytes=10)
+        buf.write(b'0123456789')
+        buf.write(b'abcd')
+        self.assertEqual(buf.tail(), '456789abcd')
+
+        buf.write(b'x' * 20)
+        self.assertEqual(buf.tail(), 'x' * 10)
+
+
+class TestRunScript(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+
+    def _script(self, name, body):
+        path = os.path.join(self.tempdir.name, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n' + body)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        return path
+
+    def test_prefixes_lines(self):
+        stream = io.StringIO()
+        buf = RingBuffer()
+        script = self._script('ok.sh', 'echo one\necho two >&2\necho three\n')
+
+        returncode = run_script([script], 'ok', LogSink(stream), buf)
+
+        self.assertEqual(returncode, 0)
+        # stderr stays in order with stdout.
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(lines, ['[ok] one', '[ok] two', '[ok] three'])
+        self.assertIn('three', buf.tail())
+
+    def test_timeout(self):
+        script = self._script('hang.sh', 'echo started\nsleep 30 &\nwait\n')
+        buf = RingBuffer()
+
+        start = time.time()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            run_script([script], 'hang', LogSink(io.StringIO()), buf,
+                       timeout=0.5)
+        self.assertLess(time.time() - start, 5)
+        self.assertIn('started', buf.tail())
+
+    def test_arun_script(self):
+        stream = io.StringIO()
+        buf = RingBuffer()
+        script = self._script('ok.sh', 'echo one\necho two >&2\nexit 2\n')
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        returncode = loop.run_until_complete(
+            arun_script([script], 'ok', LogSink(stream), buf))
+
+        self.assertEqual(returncode, 2)
+        self.assertEqual(stream.getvalue().splitlines(),
+                         ['[ok] one', '[ok] two'])
+
+    def test_arun_script_timeout(self):
+        script = self._script('hang.sh', 'echo started\nsleep 30 &\nwait\n')
+        buf = RingBuffer()
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        start = time.time()
+        with self.assertRaises(asyncio.TimeoutError):
+            loop.run_until_complete(arun_script(
+                [script], 'hang', LogSink(io.StringIO()), buf, timeout=0.5))
+        self.assertLess(time.time() - start, 5)
+        self.assertIn('started', buf.tail())
+
+    def test_failure_includes_tail(self):
+        self._script('fail.sh', 'seq 1 1000\necho broken >&2\nexit 3\n')
+        step = Step(name='fail', script_loc=self.tempdir.name + '/',
+                    scripts=['fail.sh'], output_bytes=100)
+        step.configure(sink=LogSink(io.StringIO()))
+
+        base_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(base_dir.cleanup)
+
+        with self.assertRaises(TestFailure) as cm:
+            step.run(base_dir)
+
+        self.assertIn('broken', cm.exception.output)
+        self.assertNotIn('\n1\n', cm.exception.output)
+        self.assertLessEqual(len(cm.exception.output), 100)
+        self.assertIn('--- last output ---', str(cm.exception))
@@ -1,15 +1,24 @@
+import asyncio
 import os
 import mock
+import stat
+import tempfile
 import unittest
 
-from snapstack import Plan
+from snapstack import CleanupFailure, Plan, PreflightFailure, Step, config
+from snapstack.cache import FetchCache
+from snapstack.errors import TestFailure
+from snapstack.testing import FakeRunner, FakeServer, fake_popen
 
 
 class TestPlan(unittest.TestCase):
 
-    @mock.patch('snapstack.plan.subprocess')
-    @mock.patch('snapstack.step.subprocess')
-    def test_faux_run(self, mock_subprocess, mock_subprocess_plan):
+    @mock.patch('snapstack.ready.socket')
+    @mock.patch('snapstack.snaps.subprocess')
+    @mock.patch('snapstack.facts.subprocess')
+    @mock.patch('snapstack.output.subprocess')
+    def test_faux_run(self, mock_subprocess, mock_subprocess_facts,
+                      mock_subprocess_snaps, mock_socket):
         '''
         _test_faux_run
 
@@ -17,9 +26,22 @@ class TestPlan(unittest.TestCase):
         right scripts, without actually setting up a snapstack.
 
         '''
+        # Serve the snaps' tests from here, rather than from github.
+        server = FakeServer().start()
+        self.addCleanup(server.stop)
+        patcher = mock.patch.dict(config.LOCATION_VARS,
+                                  {'openstack': server.url})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
         # Pick something in the base to test, so we don't actually
         # need to fake out tests for it:
-        plan = Plan()
+        cache = tempfile.TemporaryDirectory()
+        self.addCleanup(cache.cleanup)
+        plan = Plan(cache=FetchCache(path=cache.name))
+        for step in plan._all_steps():
+            for url in step.remote_files():
+                server.put(url[len(server.url):], '#!/bin/sh\n')
 
         faux_p = mock.Mock()
         faux_p.returncode = 0
@@ -32,26 +54,224 @@ class TestPlan(unittest.TestCase):
         if plan._https_proxy is not None:
             env['SNAPSTACK_HTTPS_PROXY'] = plan._https_proxy
 
-        mock_subprocess.run.return_value = faux_p
-        mock_subprocess_plan.run.return_value = faux_p
+        mock_subprocess.Popen.side_effect = fake_popen()
+        mock_subprocess_facts.run.return_value = faux_p
+        faux_info = mock.Mock()
+        faux_info.returncode = 0
+        faux_info.stdout.decode.return_value = (
+            'channels:\n  {}: 1.0 1 1MB -\n'.format(config.CHANNEL))
+        mock_subprocess_snaps.run.side_effect = lambda cmd, **kw: (
+            faux_info if cmd[:2] == ['snap', 'info'] else faux_p)
 
         plan.run(cleanup=False)  # Tempdir will cleanup itself.
 
         self.assertTrue(
             os.path.exists(os.sep.join([plan.tempdir, 'admin-openrc'])))
 
-        mock_subprocess.run.assert_called_with(
+        pipe = mock_subprocess.PIPE
+        mock_subprocess.Popen.assert_called_with(
             [os.sep.join([plan.tempdir, 'neutron-ext-net.sh'])],
-            env=env)
+            env=env, stdout=pipe, stderr=mock_subprocess.STDOUT)
+
+        # The base waited for its services to come up.
+        mock_socket.create_connection.assert_any_call(
+            ('localhost', 5000), timeout=mock.ANY)
 
         plan.run()  # Run plan again with cleanup
         scripts = ['keystone_cleanup.sh', 'nova_cleanup.sh',
                    'neutron_cleanup.sh', 'glance_cleanup.sh',
                    'nova-hypervisor_cleanup.sh']
         for script in scripts:
-            mock_subprocess.run.assert_any_call(
+            mock_subprocess.Popen.assert_any_call(
                 [os.sep.join([plan.tempdir, script])],
-                env=env)
+                env=env, stdout=pipe, stderr=mock_subprocess.STDOUT)
+
+    @mock.patch('snapstack.snaps.subprocess')
+    @mock.patch('snapstack.output.subprocess')
+    def test_destroy(self, mock_subprocess, mock_subprocess_snaps):
+        '''
+        _test_destroy
+
+        Every cleanup step should run, even if some fail, and every snap
+        that is still installed should be removed in one go.
+
+        '''
+        mock_subprocess.Popen.side_effect = fake_popen(
+            lambda cmd: 1 if cmd[0].endswith('b_cleanup.py') else 0)
+
+        faux_p = mock.Mock()
+        faux_p.returncode = 0
+        mock_subprocess_snaps.run.return_value = faux_p
+
+        scripts = tempfile.TemporaryDirectory()
+        self.addCleanup(scripts.cleanup)
+        cleanup = []
+        for name in ['a_cleanup.py', 'b_cleanup.py', 'c_cleanup.py']:
+            open(os.path.join(scripts.name, name), 'w').close()
+            cleanup.append(Step(script_loc=scripts.name + '/',
+                                scripts=[name], requires=[]))
+
+        plan = Plan(
+            tests=[Step(snap='bar')],
+            base_setup=[Step(snap='foo'), Step(snap='baz')],
+            base_cleanup=cleanup)
+        plan._facts._facts['installed_snaps'] = {'foo': {}, 'bar': {}}
+
+        with mock.patch.object(plan._facts, 'invalidate'):
+            with self.assertRaises(CleanupFailure) as cm:
+                plan.destroy()
+
+        self.assertEqual(len(cm.exception.errors), 1)
+        self.assertEqual(mock_subprocess.Popen.call_count, 3)
+        mock_subprocess_snaps.run.assert_called_once_with(
+            ['sudo', 'snap', 'remove', 'foo', 'bar'])
+
+    def test_installs_wait_on_requires(self):
+        '''
+        _test_installs_wait_on_requires
+
+        A step's snap shouldn't start installing until the steps that it
+        requires have finished, and the snaps of steps that become ready
+        together should be queued together.
+
+        '''
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        open(os.path.join(d.name, 'setup.sh'), 'w').close()
+
+        runner = FakeRunner()
+        plan = Plan(
+            tests=[],
+            base_setup=[
+                Step(name='setup', script_loc=d.name + '/',
+                     scripts=['setup.sh'], requires=[]),
+                Step(snap='a', script_loc=d.name + '/', requires=['setup']),
+                Step(snap='b', script_loc=d.name + '/', requires=['setup']),
+            ],
+            base_cleanup=[],
+            cache=FetchCache(path=os.path.join(d.name, 'cache')),
+            resume=False,
+            warm_base=False)
+        with runner.patch():
+            plan.deploy()
+
+        setup = runner.calls.index([os.path.join(plan.tempdir, 'setup.sh')])
+        snaps = [c for c in runner.calls[setup + 1:]
+                 if 'install' in c or 'watch' in c]
+        self.assertEqual([c[-1] for c in snaps], ['a', 'b', '1', '1'])
+
+    def _async_plan(self, **kwargs):
+        for module in ['facts', 'snaps']:
+            patcher = mock.patch('snapstack.{}.subprocess'.format(module))
+            patcher.start().run.return_value = mock.Mock(
+                returncode=0, stdout=b'')
+            self.addCleanup(patcher.stop)
+
+        scripts = tempfile.TemporaryDirectory()
+        self.addCleanup(scripts.cleanup)
+        self.marker = os.path.join(scripts.name, 'cleaned')
+        for name, body in [('hang.sh', 'sleep 30\n'),
+                           ('cleanup.sh', 'touch {}\n'.format(self.marker))]:
+            path = os.path.join(scripts.name, name)
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\n' + body)
+            os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+        return Plan(
+            tests=[Step(script_loc=scripts.name + '/', scripts=['hang.sh'])],
+            test_cleanup=[Step(script_loc=scripts.name + '/',
+                               scripts=['cleanup.sh'])],
+            base_setup=[],
+            base_cleanup=[],
+            cache=FetchCache(path=os.path.join(scripts.name, 'cache')),
+            resume=False,
+            warm_base=False,
+            **kwargs)
+
+    def test_arun_script_timeout(self):
+        '''
+        _test_arun_script_timeout
+
+        A hung script should be killed, and fail its step, whether it hits
+        the script or the step timeout, and cleanup should still run.
+
+        '''
+        for kwargs in [{'script_timeout': 0.5}, {'step_timeout': 0.5}]:
+            plan = self._async_plan(**kwargs)
+            loop = asyncio.new_event_loop()
+            self.addCleanup(loop.close)
+
+            with self.assertRaises(TestFailure) as cm:
+                loop.run_until_complete(plan.arun())
+
+            self.assertIn('timed out', str(cm.exception))
+            self.assertTrue(os.path.exists(self.marker))
+
+    def test_arun_cancel(self):
+        '''
+        _test_arun_cancel
+
+        Cancelling a Plan should kill its scripts, and still clean up.
+
+        '''
+        plan = self._async_plan()
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def cancel_soon():
+            task = asyncio.ensure_future(plan.arun())
+            await asyncio.sleep(0.5)
+            task.cancel()
+            await task
+
+        with self.assertRaises(asyncio.CancelledError):
+            loop.run_until_complete(cancel_soon())
+        self.assertTrue(os.path.exists(self.marker))
+
+    def test_preflight(self):
+        '''
+        _test_preflight
+
+        Preflight should report every problem that it finds at once, and
+        stop the Plan before it deploys anything.
+
+        '''
+        runner = FakeRunner(
+            fail=lambda argv: argv[:3] == ['snap', 'info', 'nosuchsnap'])
+        scripts = tempfile.TemporaryDirectory()
+        self.addCleanup(scripts.cleanup)
+        open(os.path.join(scripts.name, 'there.sh'), 'w').close()
+
+        with FakeServer() as server, runner.patch():
+            server.put('/tests/found.sh', '#!/bin/sh\n')
+            local = scripts.name + '/'
+            remote = server.url + '/tests/'
+            plan = Plan(
+                tests=[
+                    Step(snap='nosuchsnap'),
+                    Step(snap='keystone', channel='pike/edge'),
+                    Step(script_loc=local, scripts=['there.sh', 'gone.sh']),
+                    Step(script_loc=remote, scripts=['found.sh',
+                                                     'lost.sh']),
+                    Step(script_loc='{nowhere}', scripts=['x.sh']),
+                ],
+                base_setup=[],
+                base_cleanup=[],
+                cache=FetchCache(path=os.path.join(scripts.name, 'cache')),
+                resume=False,
+                warm_base=False)
+
+            with self.assertRaises(PreflightFailure) as cm:
+                plan.run()
+
+        problems = cm.exception.problems
+        self.assertEqual(len(problems), 5, problems)
+        for expected in ['nosuchsnap', 'pike/edge', 'gone.sh', 'lost.sh',
+                         'nowhere']:
+            self.assertTrue(any(expected in p for p in problems), expected)
+        # Nothing was installed, or run.
+        self.assertFalse(any(argv[:2] == ['snap', 'install'] or
+                             argv[0].endswith('.sh') for argv in runner.calls))
 
     @unittest.skipUnless(
         os.environ.get('SNAPSTACK_TEST_INSTALL'),
@@ -0,0 +1,104 @@
+import asyncio
+import socket
+import tempfile
+import time
+import unittest
+
+from snapstack import Step
+from snapstack.errors import TestFailure
+from snapstack.ready import (
+    Command, Condition, Port, await_ready, wait_ready)
+from snapstack.testing import FakeTransport
+from snapstack.transport import SSHTransport
+
+
+class _After(Condition):
+    '''
+    Holds from the nth check on.
+
+    '''
+    def __init__(self, n, delay=0):
+        self.n = n
+        self.delay = delay
+        self.checks = 0
+
+    def check(self):
+        time.sleep(self.delay)
+        self.checks += 1
+        return self.checks >= self.n
+
+
+class TestReady(unittest.TestCase):
+
+    def test_port(self):
+        listener = socket.socket()
+        self.addCleanup(listener.close)
+        listener.bind(('localhost', 0))
+        listener.listen(1)
+        port = listener.getsockname()[1]
+
+        self.assertTrue(Port(port).check())
+        listener.close()
+        self.assertFalse(Port(port).check())
+
+    def test_command(self):
+        self.assertTrue(Command(['true']).check())
+        self.assertFalse(Command(['false']).check())
+        self.assertFalse(Command(['/no/such/command']).check())
+
+    def test_wait_ready(self):
+        # Conditions are polled concurrently, so two slow ones take about
+        # as long as one.
+        conditions = [_After(3, delay=0.2), _After(3, delay=0.2)]
+        start = time.time()
+        self.assertEqual(wait_ready(conditions, timeout=10), [])
+        self.assertLess(time.time() - start, 1.5)
+
+        never = _After(float('inf'))
+        self.assertEqual(wait_ready([_After(1), never], timeout=0.5),
+                         [never])
+        # Backing off, we only poll a handful of times.
+        self.assertLess(never.checks, 6)
+
+    def test_await_ready(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        never = _After(float('inf'))
+        waiting = loop.run_until_complete(
+            await_ready([_After(2), never], timeout=0.5))
+        self.assertEqual(waiting, [never])
+
+    def test_step_not_ready(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        step = Step(name='keystone', script_loc=tempdir.name + '/',
+                    ready=[Command(['false'])], ready_timeout=0.3)
+
+        with self.assertRaises(TestFailure) as cm:
+            step.run(tempdir=tempdir)
+        self.assertIn('command "false"', str(cm.exception))
+
+        step = Step(name='keystone', script_loc=tempdir.name + '/',
+                    ready=[Command(['true'])])
+        step.run(tempdir=tempdir)
+
+    def test_step_host(self):
+        # A Step placed on another host checks its conditions there.
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        host = FakeTransport('compute')
+        ready = Command(['true'])
+        step = Step(name='nova', script_loc=tempdir.name + '/',
+                    ready=[ready])
+        step.configure(transport=host)
+        step.run(tempdir=tempdir)
+
+        self.assertIn(['true'], host.commands)
+        # The Step's own condition is left as it was.
+        self.assertIsNone(ready.transport)
+
+        ssh = SSHTransport('10.0.0.2')
+        self.addCleanup(ssh.close)
+        self.assertEqual(str(Port(5000).on(ssh)), 'port 10.0.0.2:5000')
+        self.assertEqual(str(Port(5000, host='db').on(ssh)), 'port db:5000')
+        self.assertEqual(str(Port(5000)), 'port localhost:5000')
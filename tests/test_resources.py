@@ -0,0 +1,158 @@
+import os
+import tempfile
+import unittest
+
+import mock
+
+from snapstack import Plan, Step
+from snapstack.resources import Sampler
+from snapstack.testing import FakeRunner
+from snapstack.trace import Tracer
+
+
+MB = 1024 * 1024
+
+
+class FakeHost:
+    '''
+    A /proc, and a /sys/fs/cgroup, in a temp dir, with counters that we
+    can move along.
+
+    '''
+    def __init__(self, root, cgroup_v2=True):
+        self.proc = os.path.join(root, 'proc')
+        self.cgroup = os.path.join(root, 'cgroup')
+        self.cgroup_v2 = cgroup_v2
+        os.makedirs(os.path.join(self.proc, 'net'))
+
+    def _write(self, path, text):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def set(self, busy, idle, load, used_mb, disk_mb, net_mb, nova_cpu,
+            nova_mb):
+        '''
+        Set the counters. busy and idle are in jiffies; nova_cpu is the
+        CPU seconds used by snap.nova.compute so far.
+
+        '''
+        self._write(os.path.join(self.proc, 'stat'), (
+            'cpu  {0} 0 0 {1} 0 0 0 0 0 0\n'
+            'cpu0 {0} 0 0 {1} 0 0 0 0 0 0\n'
+            'cpu1 0 0 0 0 0 0 0 0 0 0\n'
+            'intr 1 2 3\n').format(busy, idle))
+        self._write(os.path.join(self.proc, 'loadavg'),
+                    '{} 0.5 0.5 1/100 1234\n'.format(load))
+        self._write(os.path.join(self.proc, 'meminfo'), (
+            'MemTotal:       {} kB\n'
+            'MemFree:        1 kB\n'
+            'MemAvailable:   {} kB\n').format(
+                4096 * 1024, (4096 - used_mb) * 1024))
+        sectors = disk_mb * MB // 512
+        self._write(os.path.join(self.proc, 'diskstats'), (
+            '   7       0 loop0 1 0 999999 0 1 0 999999 0 0 0 0\n'
+            '   8       0 sda 1 0 {0} 0 1 0 {0} 0 0 0 0\n'
+            '   8       1 sda1 1 0 {0} 0 1 0 {0} 0 0 0 0\n').format(
+                sectors // 2))
+        self._write(os.path.join(self.proc, 'net', 'dev'), (
+            'Inter-|   Receive\n'
+            ' face |bytes    packets errs drop fifo frame compressed multicast'
+            '|bytes\n'
+            '    lo: 999999 1 0 0 0 0 0 0 999999 1 0 0 0 0 0 0\n'
+            '  eth0: {0} 1 0 0 0 0 0 0 {0} 1 0 0 0 0 0 0\n').format(
+                net_mb * MB // 2))
+
+        if self.cgroup_v2:
+            service = os.path.join(self.cgroup, 'system.slice',
+                                   'snap.nova.compute.service')
+            self._write(os.path.join(service, 'cpu.stat'),
+                        'usage_usec {}\n'.format(int(nova_cpu * 1e6)))
+            self._write(os.path.join(service, 'memory.current'),
+                        '{}\n'.format(nova_mb * MB))
+        else:
+            self._write(os.path.join(
+                self.cgroup, 'cpuacct', 'system.slice',
+                'snap.nova.compute.service', 'cpuacct.usage'),
+                '{}\n'.format(int(nova_cpu * 1e9)))
+            self._write(os.path.join(
+                self.cgroup, 'memory', 'system.slice',
+                'snap.nova.compute.service', 'memory.usage_in_bytes'),
+                '{}\n'.format(nova_mb * MB))
+
+
+class TestSampler(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+
+    def _sample(self, host, sampler, clock):
+        for t, counters in clock:
+            host.set(**counters)
+            with mock.patch('snapstack.resources.time.monotonic',
+                            return_value=t):
+                sample = sampler.sample()
+        return sample
+
+    def test_sample(self):
+        for cgroup_v2 in [True, False]:
+            host = FakeHost(os.path.join(self._dir.name, str(cgroup_v2)),
+                            cgroup_v2=cgroup_v2)
+            tracer = Tracer()
+            sampler = Sampler(tracer, proc=host.proc, cgroup=host.cgroup)
+
+            with tracer.span('nova', 'step'):
+                with tracer.span('/tmp/x/nova.sh', 'script'):
+                    sample = self._sample(host, sampler, [
+                        (10.0, dict(busy=100, idle=100, load=1.0,
+                                    used_mb=1000, disk_mb=0, net_mb=0,
+                                    nova_cpu=0.0, nova_mb=100)),
+                        (12.0, dict(busy=250, idle=150, load=3.0,
+                                    used_mb=1500, disk_mb=20, net_mb=4,
+                                    nova_cpu=1.0, nova_mb=300)),
+                    ])
+
+            self.assertEqual(sample['cpu'], 75.0)
+            self.assertEqual(sample['load'], 3.0)
+            self.assertEqual(sample['mem'], 1500.0)
+            # Partitions and loop devices aren't counted.
+            self.assertEqual(sample['disk'], 10.0)
+            self.assertEqual(sample['net'], 2.0)
+            # 1s of CPU over 2s, on a 2 core host.
+            self.assertEqual(sample['services'],
+                             {'snap.nova.compute': {'cpu': 25.0,
+                                                    'mem': 300.0}})
+
+            stats = sampler.stats()
+            self.assertEqual(list(stats), ['nova', 'nova nova.sh'])
+            self.assertEqual(stats['nova']['samples'], 1)
+            self.assertEqual(stats['nova']['cpu'],
+                             {'peak': 75.0, 'mean': 75.0})
+            self.assertIn('snap.nova.compute 25%', sampler.summary())
+            counters = [e for e in tracer.events if e['ph'] == 'C']
+            self.assertEqual(counters[0]['args']['cpu'], 75.0)
+
+    def test_idle(self):
+        # Samples taken while no Step is running aren't attributed.
+        host = FakeHost(self._dir.name)
+        sampler = Sampler(Tracer(), proc=host.proc, cgroup=host.cgroup)
+        counters = dict(busy=1, idle=1, load=0.0, used_mb=1, disk_mb=0,
+                        net_mb=0, nova_cpu=0.0, nova_mb=1)
+        self._sample(host, sampler, [(1.0, counters), (2.0, counters)])
+        self.assertEqual(sampler.stats(), {})
+
+    def test_plan(self):
+        runner = FakeRunner()
+        with tempfile.TemporaryDirectory() as d, runner.patch():
+            with open(os.path.join(d, 'a.sh'), 'w') as f:
+                f.write('#!/bin/sh\n')
+            plan = Plan(
+                tests=[Step(name='a', script_loc=d + '/', scripts=['a.sh'])],
+                base_setup=[], base_cleanup=[], sample_interval=0.01)
+            plan.run()
+
+        self.assertEqual(plan.sampler.interval, 0.01)
+        self.assertIsNone(plan.sampler._thread)
+        self.assertIsNone(
+            Plan(base_setup=[], base_cleanup=[]).sampler)
@@ -0,0 +1,115 @@
+import os
+import tempfile
+import unittest
+
+import mock
+import requests
+
+from snapstack import Plan, Step
+from snapstack.cache import BuildCache, FetchCache
+from snapstack.errors import InfraFailure, TestFailure
+from snapstack.retry import RETRYABLE, Retry
+from snapstack.testing import FakeRunner
+
+
+class TestRetry(unittest.TestCase):
+
+    def test_call(self):
+        func = mock.Mock(side_effect=[ValueError('one'), ValueError('two'),
+                                      'done'])
+        on_retry = mock.Mock()
+
+        result = Retry(retries=2, delay=0.01).call(
+            func, 'arg', on_retry=on_retry)
+
+        self.assertEqual(result, 'done')
+        func.assert_called_with('arg')
+        self.assertEqual([c[0][0] for c in on_retry.call_args_list], [1, 2])
+        # Waits are jittered, but never more than the exponential cap.
+        delays = [c[0][1] for c in on_retry.call_args_list]
+        self.assertTrue(0 <= delays[0] <= 0.01)
+        self.assertTrue(0 <= delays[1] <= 0.02)
+
+    def test_give_up(self):
+        func = mock.Mock(side_effect=ValueError('always'))
+        with self.assertRaises(ValueError):
+            Retry(retries=2, delay=0.01).call(func)
+        self.assertEqual(func.call_count, 3)
+
+        func = mock.Mock(side_effect=ValueError('fatal'))
+        with self.assertRaises(ValueError):
+            Retry(retries=2, delay=0.01).call(
+                func, retryable=lambda e: False)
+        self.assertEqual(func.call_count, 1)
+
+    def test_retryable(self):
+        def http_error(status):
+            return requests.HTTPError(response=mock.Mock(status_code=status))
+
+        transient = RETRYABLE['fetch']
+        self.assertTrue(transient(requests.ConnectionError()))
+        self.assertTrue(transient(http_error(503)))
+        self.assertFalse(transient(http_error(404)))
+        self.assertTrue(RETRYABLE['script'](TestFailure('failed')))
+
+    def test_fetch_retry(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'a.conf')
+            open(path, 'w').close()
+            fetcher = mock.Mock()
+            fetcher.get.side_effect = [requests.ConnectionError('reset'),
+                                       path]
+            step = Step(name='a', script_loc='http://example.com/',
+                        files=['a.conf'],
+                        retries={'fetch': Retry(1, delay=0.01)})
+
+            step.run(tempdir=tempfile.TemporaryDirectory(), fetcher=fetcher)
+
+        self.assertEqual(fetcher.get.call_count, 2)
+        self.assertEqual(step.retry_log.totals()[('a', 'fetch')]['retries'],
+                         1)
+
+    def test_install_retry(self):
+        attempts = []
+
+        def conflict(argv):
+            # snapd refuses the first install, as another change is in
+            # progress.
+            if 'install' in argv:
+                attempts.append(argv)
+                return len(attempts) == 1
+            return False
+
+        runner = FakeRunner(fail=conflict)
+        with tempfile.TemporaryDirectory() as d, runner.patch():
+            plan = Plan(
+                tests=[Step(snap='keystone', script_loc=d + '/')],
+                base_setup=[],
+                base_cleanup=[],
+                cache=FetchCache(path=os.path.join(d, 'cache')),
+                resume=False,
+                warm_base=False,
+                retries={'install': Retry(2, delay=0.01)})
+            plan.deploy()
+
+        self.assertEqual(len(attempts), 2)
+        self.assertIn('keystone', runner.installed)
+        self.assertEqual(
+            plan.retry_log.totals()[('keystone', 'install')]['retries'], 1)
+        self.assertIn('keystone install: 1 retries',
+                      plan.retry_log.summary())
+
+    @mock.patch('snapstack.step.run_script')
+    def test_build_not_retried(self, mock_run_script):
+        # A snap that fails to build from local source would only fail
+        # again, so we don't retry it.
+        mock_run_script.return_value = 1
+        step = Step(snap='foo', snap_store=False,
+                    retries={'install': Retry(2, delay=0.01)})
+        with tempfile.TemporaryDirectory() as d:
+            step.configure(build_cache=BuildCache(path=d))
+            with self.assertRaises(InfraFailure):
+                step._install_snap()
+
+        self.assertEqual(mock_run_script.call_count, 1)
+        self.assertFalse(step.retry_log.retries)
@@ -0,0 +1,212 @@
+import asyncio
+import threading
+import unittest
+
+from snapstack import Cleanup, Setup, Step
+from snapstack.errors import InfraFailure, TestFailure
+from snapstack.scheduler import Scheduler, predict, resolve
+
+
+def run_until_complete(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_resolve_defaults_to_serial(self):
+        a, b, c = Step(name='a'), Step(name='b'), Step(name='c')
+        deps = resolve([a, b, c])
+
+        self.assertEqual(deps[a], [])
+        self.assertEqual(deps[b], [a])
+        self.assertEqual(deps[c], [b])
+
+    def test_resolve_base(self):
+        steps = {s.name: s for s in Setup().steps()}
+        deps = resolve(list(steps.values()))
+
+        for name in ['nova', 'neutron', 'glance']:
+            self.assertEqual(deps[steps[name]], [steps['keystone']])
+        self.assertEqual(deps[steps['snapstack_setup']], [])
+
+    def test_resolve_cleanup(self):
+        # snapstack_cleanup waits for every snap to clean up after itself.
+        steps = {s.name: s for s in Cleanup().steps()}
+        deps = resolve(list(steps.values()))
+
+        self.assertEqual(
+            sorted(s.name for s in deps[steps['snapstack_cleanup']]),
+            ['glance', 'keystone', 'neutron', 'nova', 'nova_hypervisor'])
+        self.assertEqual(deps[steps['keystone']], [])
+
+    def test_resolve_missing(self):
+        a = Step(name='a', requires=['gone'])
+        self.assertRaises(InfraFailure, resolve, [a])
+        self.assertEqual(resolve([a], done=['gone'])[a], [])
+
+    def test_remove_steps(self):
+        # Steps that required a removed step wait on what it required.
+        setup = Setup()
+        setup.remove_steps('keystone')
+        steps = {s.name: s for s in setup.steps()}
+        deps = resolve(list(steps.values()))
+
+        for name in ['nova', 'neutron', 'glance']:
+            self.assertEqual(deps[steps[name]], [steps['snapstack_setup']])
+
+    def test_resolve_cycle(self):
+        a = Step(name='a', requires=['b'])
+        b = Step(name='b', requires=['a'])
+        self.assertRaises(InfraFailure, resolve, [a, b])
+
+    def test_run_concurrently(self):
+        '''
+        _test_run_concurrently
+
+        Steps that only depend on a common root should all be in flight at
+        the same time, and the leaf should only start once they're done.
+
+        '''
+        root = Step(name='root', requires=[])
+        leaves = [Step(name=n, requires=['root']) for n in 'xyz']
+        last = Step(name='last', requires=['x', 'y', 'z'])
+
+        barrier = threading.Barrier(3, timeout=5)
+        finished = []
+
+        def func(step):
+            if step in leaves:
+                barrier.wait()  # Raises if the leaves aren't concurrent.
+            finished.append(step.name)
+
+        Scheduler(max_workers=3).run([root] + leaves + [last], func)
+
+        self.assertEqual(finished[0], 'root')
+        self.assertEqual(finished[-1], 'last')
+        self.assertEqual(len(finished), 5)
+
+    def test_fail_fast(self):
+        a = Step(name='a', requires=[])
+        b = Step(name='b', requires=['a'])
+        c = Step(name='c', requires=[])
+        started = []
+
+        def func(step):
+            started.append(step.name)
+            if step is a:
+                raise TestFailure('a failed')
+
+        with self.assertRaises(TestFailure):
+            Scheduler(max_workers=1).run([a, b, c], func)
+
+        self.assertEqual(started, ['a'])
+
+    def test_keep_going(self):
+        a = Step(name='a', requires=[])
+        b = Step(name='b', requires=['a'])
+        started = []
+
+        def func(step):
+            started.append(step.name)
+            raise TestFailure(step.name)
+
+        errors = Scheduler().run([a, b], func, fail_fast=False)
+
+        self.assertEqual(started, ['a', 'b'])
+        self.assertEqual([s for s, _ in errors], [a, b])
+
+    def test_longest_chain_first(self):
+        '''
+        _test_longest_chain_first
+
+        With one worker, and no durations, independent Steps start in Plan
+        order. Given durations, the Step that heads the longest chain goes
+        first, even though it comes last in the Plan.
+
+        '''
+        a = Step(name='a', requires=[])
+        b = Step(name='b', requires=[])
+        c = Step(name='c', requires=[])
+        d = Step(name='d', requires=['c'])
+        steps = [a, b, c, d]
+        durations = {a: 5.0, b: 1.0, c: 2.0, d: 10.0}
+
+        started = []
+        Scheduler(max_workers=1).run(steps, lambda s: started.append(s.name))
+        self.assertEqual(started, ['a', 'b', 'c', 'd'])
+
+        started = []
+        Scheduler(max_workers=1).run(steps, lambda s: started.append(s.name),
+                                     durations=durations)
+        self.assertEqual(started, ['c', 'd', 'a', 'b'])
+
+        # With two workers, a and b share one, while c and d run on the
+        # other, which plan order would only start once a was done.
+        self.assertEqual(predict(steps, durations, max_workers=2), 12.0)
+        self.assertEqual(predict(steps, durations, max_workers=1), 18.0)
+        # Steps that haven't run before count as a typical step.
+        self.assertEqual(predict([a, b], {a: 4.0}, max_workers=1), 8.0)
+
+    def test_arun_concurrently(self):
+        root = Step(name='root', requires=[])
+        leaves = [Step(name=n, requires=['root']) for n in 'xyz']
+        last = Step(name='last', requires=['x', 'y', 'z'])
+        running = set()
+        overlap = []
+        finished = []
+
+        async def func(step):
+            running.add(step.name)
+            overlap.append(len(running))
+            await asyncio.sleep(0.01)
+            running.discard(step.name)
+            finished.append(step.name)
+
+        run_until_complete(Scheduler(max_workers=3).arun(
+            [root] + leaves + [last], func))
+
+        self.assertEqual(finished[0], 'root')
+        self.assertEqual(finished[-1], 'last')
+        self.assertEqual(max(overlap), 3)
+
+    def test_arun_fail_fast(self):
+        a = Step(name='a', requires=[])
+        b = Step(name='b', requires=['a'])
+        started = []
+
+        async def func(step):
+            started.append(step.name)
+            raise TestFailure(step.name)
+
+        with self.assertRaises(TestFailure):
+            run_until_complete(Scheduler().arun([a, b], func))
+        self.assertEqual(started, ['a'])
+
+        errors = run_until_complete(
+            Scheduler().arun([a, b], func, fail_fast=False))
+        self.assertEqual([s for s, _ in errors], [a, b])
+
+    def test_arun_cancel(self):
+        steps = [Step(name=n, requires=[]) for n in 'ab']
+        cancelled = []
+
+        async def func(step):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(step.name)
+                raise
+
+        async def cancel_soon():
+            task = asyncio.ensure_future(Scheduler().arun(steps, func))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            await task
+
+        with self.assertRaises(asyncio.CancelledError):
+            run_until_complete(cancel_soon())
+        self.assertEqual(sorted(cancelled), ['a', 'b'])
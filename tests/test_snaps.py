@@ -0,0 +1,124 @@
+import mock
+import unittest
+
+from snapstack import Step
+from snapstack.facts import HostFacts
+from snapstack.snaps import (
+    SnapInstaller, channel_names, parse_channels, satisfies)
+
+
+class TestSnapInstaller(unittest.TestCase):
+
+    def setUp(self):
+        self.facts = HostFacts()
+        self.facts._facts['installed_snaps'] = {
+            'core': {'tracking': 'ocata/edge', 'notes': 'core'},
+            'old': {'tracking': 'newton/edge', 'notes': '-'},
+        }
+
+    def _faux_p(self, returncode=0, stdout=b'42'):
+        p = mock.Mock()
+        p.returncode = returncode
+        p.stdout = stdout
+        return p
+
+    @mock.patch('snapstack.snaps.subprocess')
+    def test_installed(self, mock_subprocess):
+        mock_subprocess.run.return_value = self._faux_p()
+        steps = [Step(snap='a'), Step(snap='core')]
+
+        installer = SnapInstaller(self.facts)
+        installer.install(steps)
+
+        calls = [c[0][0] for c in mock_subprocess.run.call_args_list]
+        self.assertEqual(calls, [
+            ['sudo', 'snap', 'install', '--no-wait',
+             '--channel=ocata/edge', 'a'],
+            ['snap', 'watch', '42'],
+        ])
+        for step in steps:
+            self.assertIsNone(installer.result(step))
+
+    @mock.patch('snapstack.snaps.subprocess')
+    def test_refresh(self, mock_subprocess):
+        # A snap installed from another channel is refreshed.
+        mock_subprocess.run.return_value = self._faux_p()
+        step = Step(snap='old')
+
+        installer = SnapInstaller(self.facts)
+        installer.install([step])
+
+        mock_subprocess.run.assert_any_call(
+            ['sudo', 'snap', 'refresh', '--no-wait', '--channel=ocata/edge',
+             'old'], stdout=mock_subprocess.PIPE)
+        self.assertIsNone(installer.result(step))
+
+    def test_satisfies(self):
+        flags = ['--channel=edge', '--classic']
+        self.assertTrue(satisfies(
+            {'tracking': 'latest/edge', 'notes': 'classic'}, flags))
+        self.assertFalse(satisfies(
+            {'tracking': 'latest/edge', 'notes': '-'}, flags))
+        self.assertFalse(satisfies(
+            {'tracking': 'ocata/edge', 'notes': 'classic'}, flags))
+        self.assertFalse(satisfies(None, flags))
+
+    @mock.patch('snapstack.snaps.subprocess')
+    def test_blames_failure(self, mock_subprocess):
+        def run(cmd, **kwargs):
+            return self._faux_p(returncode=1 if 'b' in cmd else 0)
+        mock_subprocess.run.side_effect = run
+        steps = [Step(snap='a'), Step(snap='b')]
+
+        installer = SnapInstaller(self.facts)
+        installer.install(steps)
+
+        self.assertIsNone(installer.result(steps[0]))
+        self.assertIn('b', installer.result(steps[1]))
+
+    @mock.patch('snapstack.snaps.subprocess')
+    def test_channels(self, mock_subprocess):
+        mock_subprocess.run.return_value = self._faux_p()
+        steps = [Step(snap='a'), Step(snap='b', classic=True)]
+
+        installer = SnapInstaller(self.facts)
+        installer.install(steps)
+
+        calls = [c[0][0] for c in mock_subprocess.run.call_args_list]
+        self.assertEqual(calls, [
+            ['sudo', 'snap', 'install', '--no-wait',
+             '--channel=ocata/edge', 'a'],
+            ['sudo', 'snap', 'install', '--no-wait',
+             '--channel=ocata/edge', '--classic', 'b'],
+            ['snap', 'watch', '42'],
+            ['snap', 'watch', '42'],
+        ])
+
+
+class TestChannels(unittest.TestCase):
+
+    INFO = (
+        'name:      keystone\n'
+        'summary:   OpenStack identity service\n'
+        'channels:\n'
+        '  stable:         –\n'
+        '  edge:           17.0.0 2019-04-10 (433) 120MB -\n'
+        '  ocata/stable:   –\n'
+        '  ocata/edge:     11.0.0 2017-05-10 (97) 98MB -\n'
+        'installed:  11.0.0 (97) 98MB -\n'
+    )
+
+    def test_parse_channels(self):
+        channels = parse_channels(self.INFO)
+        self.assertEqual(
+            sorted(channels),
+            ['edge', 'ocata/edge', 'ocata/stable', 'stable'])
+        self.assertEqual(channels['stable'], '–')
+
+    def test_channel_names(self):
+        self.assertEqual(channel_names('edge'), ['edge', 'latest/edge'])
+        self.assertEqual(channel_names('latest/edge'),
+                         ['latest/edge', 'edge'])
+        self.assertEqual(channel_names('ocata'), ['ocata/stable'])
+        self.assertEqual(channel_names('ocata/edge'), ['ocata/edge'])
+        self.assertEqual(channel_names('edge/fix'), ['edge', 'latest/edge'])
@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+
+from snapstack.stage import Stager
+
+
+class TestStager(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+        self.src = os.path.join(self._dir.name, 'src.conf')
+        self.dest = os.path.join(self._dir.name, 'base', 'dest.conf')
+        os.makedirs(os.path.dirname(self.dest))
+        self._write(self.src, b'one')
+
+    def _write(self, path, body):
+        with open(path, 'wb') as f:
+            f.write(body)
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_stage(self):
+        stager = Stager(hardlinks=False)
+
+        self.assertIn(stager.stage(self.src, self.dest), ['reflink', 'copy'])
+        self.assertEqual(self._read(self.dest), b'one')
+        self.assertFalse(os.path.samefile(self.src, self.dest))
+
+        # Staging the same file again, say from another step, is a noop.
+        self.assertEqual(stager.stage(self.src, self.dest), 'skip')
+
+        # So is staging it in a later run, once we've checked the hashes.
+        self.assertEqual(Stager().stage(self.src, self.dest), 'skip')
+
+        # But a changed source is staged again.
+        self._write(self.src, b'two')
+        self.assertNotEqual(stager.stage(self.src, self.dest), 'skip')
+        self.assertEqual(self._read(self.dest), b'two')
+
+        # As is a staged file that a script has edited.
+        self._write(self.dest, b'edited')
+        self.assertNotEqual(stager.stage(self.src, self.dest), 'skip')
+        self.assertEqual(self._read(self.dest), b'two')
+        self.assertEqual(
+            sorted(os.listdir(os.path.dirname(self.dest))), ['dest.conf'])
+
+    def test_hardlinks(self):
+        stager = Stager(hardlinks=True)
+        how = stager.stage(self.src, self.dest)
+
+        self.assertIn(how, ['reflink', 'hardlink'])
+        if how == 'hardlink':
+            self.assertTrue(os.path.samefile(self.src, self.dest))
+        self.assertEqual(stager.stage(self.src, self.dest), 'skip')
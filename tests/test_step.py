@@ -1,12 +1,15 @@
 import mock
+import os
+import tempfile
 import unittest
 
+from snapstack.cache import BuildCache
 from snapstack.step import Step
 
 
 class TestStep(unittest.TestCase):
 
-    @mock.patch('snapstack.step.subprocess')
+    @mock.patch('snapstack.facts.subprocess')
     def test_make_env(self, mock_subprocess):
         step = Step()
 
@@ -22,5 +25,71 @@ class TestStep(unittest.TestCase):
 
         faux_p.stdout.decode.return_value = 'foo.openstack.com\nbar'
 
+        # Facts about the host are remembered until invalidated.
+        ret = step._make_env()
+        self.assertTrue(ret.get('ALLOW_UNAUTHENTICATED'))
+        self.assertEqual(mock_subprocess.run.call_count, 1)
+
+        step.facts.invalidate('apt')
         ret = step._make_env()
         self.assertFalse(ret.get('ALLOW_UNAUTHENTICATED'))
+
+    @mock.patch('snapstack.step.run_script')
+    @mock.patch('snapstack.facts.subprocess')
+    def test_build_cache(self, mock_subprocess, mock_run_script):
+        '''
+        _test_build_cache
+
+        A snap built from local source should only be rebuilt when its
+        source changes, and the exact snap we built should be installed.
+
+        '''
+        mock_subprocess.run.return_value = mock.Mock(returncode=0, stdout=b'')
+        source = tempfile.TemporaryDirectory()
+        self.addCleanup(source.cleanup)
+        cwd = os.getcwd()
+        os.chdir(source.name)
+        self.addCleanup(os.chdir, cwd)
+        os.makedirs('snap')
+        with open('snap/snapcraft.yaml', 'w') as f:
+            f.write('name: foo\n')
+
+        def run_script(cmd, *args, **kwargs):
+            if cmd == ['snapcraft']:
+                open('foo_0.1_amd64.snap', 'w').close()
+            return 0
+        mock_run_script.side_effect = run_script
+
+        step = Step(snap='foo', snap_store=False)
+        cache = tempfile.TemporaryDirectory()
+        self.addCleanup(cache.cleanup)
+        step.configure(build_cache=BuildCache(path=cache.name))
+
+        def commands():
+            cmds = [c[0][0] for c in mock_run_script.call_args_list]
+            mock_run_script.reset_mock()
+            return cmds
+
+        step._install_snap()
+        cmds = commands()
+        self.assertEqual(cmds[:2], [['snapcraft', 'clean'], ['snapcraft']])
+        installed = cmds[2][-1]
+        self.assertTrue(installed.endswith('foo_0.1_amd64.snap'))
+        self.assertEqual(
+            cmds[2], ['sudo', 'snap', 'install', '--dangerous', installed])
+
+        step._install_snap()
+        self.assertEqual(commands(), [
+            ['sudo', 'snap', 'install', '--dangerous', installed]])
+
+        with open('snap/snapcraft.yaml', 'a') as f:
+            f.write('version: 0.2\n')
+        step._install_snap()
+        self.assertEqual(commands()[1], ['snapcraft'])
+
+    def test_run_channel(self):
+        # A channel passed to run overrides the Step's own.
+        step = Step(channel='ocata/edge')
+        step._prepare(None, None, None, 'pike/edge')
+        self.assertEqual(step.channel, 'pike/edge')
+        self.assertEqual(step.install_flags(), ['--channel=pike/edge'])
@@ -0,0 +1,59 @@
+import json
+import os
+import tempfile
+import unittest
+
+from snapstack import Plan, Step
+from snapstack.testing import FakeRunner
+from snapstack.trace import Tracer
+
+
+class TestTracer(unittest.TestCase):
+
+    def test_span(self):
+        tracer = Tracer()
+        with tracer.span('keystone', 'step'):
+            with tracer.span('env', 'env'):
+                pass
+            with tracer.span('keystone.sh', 'script', rc=0):
+                pass
+
+        events = {e['name']: e for e in tracer.events}
+        self.assertEqual(events['env']['args'], {'step': 'keystone'})
+        self.assertEqual(events['keystone.sh']['args'],
+                         {'step': 'keystone', 'rc': 0})
+        self.assertGreaterEqual(
+            events['keystone']['dur'], events['keystone.sh']['dur'])
+
+        durations = tracer.durations()
+        self.assertEqual(list(durations), ['keystone'])
+        self.assertEqual(
+            sorted(durations['keystone']),
+            ['env', 'fetch', 'install', 'ready', 'script', 'total'])
+
+    def test_plan_trace(self):
+        runner = FakeRunner()
+        patcher = runner.patch()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, 'a.sh'), 'w') as f:
+                f.write('#!/bin/sh\n')
+            trace = os.path.join(d, 'trace.json')
+
+            plan = Plan(
+                tests=[Step(name='a', script_loc=d + '/', scripts=['a.sh'])],
+                base_setup=[], base_cleanup=[], trace=trace)
+            plan.run()
+
+            with open(trace) as f:
+                events = json.load(f)['traceEvents']
+
+        cats = set(e.get('cat') for e in events)
+        self.assertTrue({'plan', 'step', 'env', 'fetch', 'script'} <= cats)
+        summary = plan.tracer.summary().splitlines()
+        self.assertEqual(summary[0].split(),
+                         ['step', 'total', 'env', 'install', 'fetch',
+                          'script', 'ready'])
+        self.assertEqual(summary[1].split()[0], 'a')
@@ -0,0 +1,135 @@
+import os
+import tempfile
+import unittest
+
+from snapstack import Plan, PreflightFailure, Step
+from snapstack.cache import FetchCache
+from snapstack.plan import _place
+from snapstack.testing import FakeRunner, FakeTransport
+from snapstack.transport import SSHTransport
+
+
+class TestSSHTransport(unittest.TestCase):
+
+    def test_command(self):
+        transport = SSHTransport('hv1.example.com', name='hv1', user='ubuntu')
+        cmd, env = transport.command(
+            ['/tmp/base/nova.sh'], env={'BASE_DIR': '/tmp/base dir'})
+
+        self.assertIsNone(env)
+        self.assertEqual(cmd[0], 'ssh')
+        self.assertIn('ControlMaster=auto', cmd)
+        self.assertEqual(cmd[-2], 'hv1.example.com')
+        self.assertEqual(cmd[-1], "env 'BASE_DIR=/tmp/base dir' "
+                                  "/tmp/base/nova.sh")
+        self.assertEqual(str(transport), 'hv1')
+
+
+class TestPlacement(unittest.TestCase):
+
+    def test_place(self):
+        steps = [
+            Step(name='keystone', requires=[]),
+            Step(name='nova_hypervisor', requires=['keystone']),
+            Step(name='after'),
+            Step(name='ext_net', requires=['nova_hypervisor']),
+        ]
+        placed = {s.name: s for s in _place(steps, {
+            'keystone': 'control',
+            'nova_hypervisor': ['hv1', 'hv2'],
+        })}
+
+        self.assertEqual(
+            sorted(placed),
+            ['after', 'ext_net', 'keystone', 'nova_hypervisor@hv1',
+             'nova_hypervisor@hv2'])
+        self.assertEqual(placed['keystone'].host, 'control')
+        self.assertEqual(placed['nova_hypervisor@hv2'].host, 'hv2')
+        self.assertEqual(placed['nova_hypervisor@hv1'].requires,
+                         ['keystone'])
+        for name in ['after', 'ext_net']:
+            self.assertEqual(placed[name].requires,
+                             ['nova_hypervisor@hv1', 'nova_hypervisor@hv2'])
+
+    def test_plan_copies_steps(self):
+        step = Step(name='hv', requires=[])
+        plan = Plan(tests=[step], base_setup=[], base_cleanup=[],
+                    hosts=[FakeTransport('hv1')], placement={'hv': 'hv1'})
+        self.assertEqual(plan.step('hv').host, 'hv1')
+        self.assertIsNone(step.host)
+        with self.assertRaises(KeyError):
+            plan.step('nova')
+
+    def test_fan_out(self):
+        runner = FakeRunner()
+        patcher = runner.patch()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        for name in ['setup.sh', 'hv.sh', 'hv.conf', 'after.sh']:
+            open(os.path.join(d.name, name), 'w').close()
+
+        def step(name, **kwargs):
+            return Step(name=name, script_loc=d.name + '/', **kwargs)
+
+        hosts = [FakeTransport('hv1'), FakeTransport('hv2')]
+        plan = Plan(
+            tests=[
+                step('setup', scripts=['setup.sh'], snap='keystone',
+                     host='hv1'),
+                step('hv', scripts=['hv.sh'], files=['hv.conf'],
+                     requires=['setup']),
+                step('after', scripts=['after.sh'], requires=['hv']),
+            ],
+            base_setup=[],
+            base_cleanup=[],
+            cache=FetchCache(path=os.path.join(d.name, 'cache')),
+            resume=False,
+            warm_base=False,
+            hosts=hosts,
+            placement={'hv': ['hv1', 'hv2']})
+        plan.run()
+
+        hv_script = os.path.join(plan.tempdir, 'hv.sh')
+        for host in hosts:
+            self.assertEqual(host.connects, 1)
+            self.assertIn([hv_script], host.commands)
+            self.assertIn((plan.tempdir, ['hv.conf', 'hv.sh']), host.puts)
+            env = host.envs[host.commands.index([hv_script])]
+            # Remote hosts only get the variables that we add.
+            self.assertEqual(env['BASE_DIR'], plan.tempdir)
+            self.assertNotIn('PATH', env)
+
+        # setup, and its snap, were on hv1 only; after ran here.
+        installs = [c for c in hosts[0].commands if 'install' in c]
+        self.assertTrue(installs and 'keystone' in installs[0])
+        self.assertFalse([c for c in hosts[1].commands if 'install' in c])
+        after = [os.path.join(plan.tempdir, 'after.sh')]
+        self.assertFalse(any(after in h.commands for h in hosts))
+        self.assertIn(after, runner.calls)
+
+    def test_local_build_remote(self):
+        # We can only build a snap from local source on this host, and
+        # should say so before deploying anything.
+        runner = FakeRunner()
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        host = FakeTransport('hv1')
+        with runner.patch():
+            plan = Plan(
+                tests=[Step(snap='keystone', snap_store=False,
+                            script_loc=d.name + '/', host='hv1')],
+                base_setup=[],
+                base_cleanup=[],
+                cache=FetchCache(path=os.path.join(d.name, 'cache')),
+                resume=False,
+                warm_base=False,
+                hosts=[host])
+            with self.assertRaises(PreflightFailure) as cm:
+                plan.run()
+
+        self.assertIn('cannot build keystone from local source on hv1',
+                      str(cm.exception))
+        self.assertFalse([c for c in host.commands if 'install' in c])
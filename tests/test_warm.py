@@ -0,0 +1,114 @@
+import mock
+import os
+import tempfile
+import unittest
+
+from snapstack import Plan, Step
+from snapstack.testing import fake_popen
+from snapstack.warm import WarmBase
+
+
+SNAP_LIST = b'''\
+Name  Version  Rev  Tracking    Publisher  Notes
+base  1.0      10   ocata/edge  openstack  -
+'''
+
+
+class TestWarmBase(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+        self.scripts = os.path.join(self._dir.name, 'scripts') + '/'
+        os.makedirs(self.scripts)
+        for name in ['base.sh', 'base_cleanup.sh', 'test.sh']:
+            open(self.scripts + name, 'w').close()
+
+        self.calls = []
+        for module in ['output', 'facts', 'snaps', 'warm']:
+            patcher = mock.patch('snapstack.{}.subprocess'.format(module))
+            mock_subprocess = patcher.start()
+            mock_subprocess.run.side_effect = self._run
+            mock_subprocess.Popen.side_effect = self._popen
+            self.addCleanup(patcher.stop)
+
+    def _run(self, cmd, **kwargs):
+        self.calls.append(cmd)
+        p = mock.Mock()
+        p.returncode = 0
+        p.stdout = b''
+        if cmd[:2] == ['snap', 'list']:
+            p.stdout = SNAP_LIST
+        if cmd[:3] == ['sudo', 'snap', 'save']:
+            p.stdout = b'Set  Snap  Age\n7    base  1s\n'
+        if cmd[:2] == ['snap', 'info']:
+            p.stdout = b'channels:\n  ocata/edge: 1 1 1MB -\n' \
+                b'  pike/edge: 1 1 1MB -\n'
+        if cmd[-1] == 'list_users':
+            p.stdout = b'guest\t[administrator]\nopenstack\t[]\n'
+        if cmd[-1] == 'list_permissions':
+            p.stdout = b'openstack\t.*\t.*\t.*\n'
+        return p
+
+    def _popen(self, cmd, **kwargs):
+        self.calls.append(cmd)
+        return fake_popen()(cmd)
+
+    def _plan(self, channel=None):
+        return Plan(
+            base_setup=[Step(name='base', snap='base', channel=channel,
+                             script_loc=self.scripts, scripts=['base.sh'])],
+            base_cleanup=[Step(script_loc=self.scripts,
+                               scripts=['base_cleanup.sh'])],
+            tests=[Step(script_loc=self.scripts, scripts=['test.sh'])],
+            warm_base=WarmBase(os.path.join(self._dir.name, 'warm')))
+
+    def _scripts(self):
+        return [os.path.basename(c[0]) for c in self.calls
+                if c[0].endswith('.sh')]
+
+    def test_warm_base(self):
+        plan = self._plan()
+        plan.run()
+
+        self.assertEqual(self._scripts(), ['base.sh', 'test.sh'])
+        self.assertIn(['sudo', 'snap', 'save', 'base'], self.calls)
+        self.assertNotIn(['sudo', 'snap', 'remove', 'base'], self.calls)
+
+        self.calls = []
+        self._plan().run()
+
+        self.assertEqual(self._scripts(), ['test.sh'])
+        self.assertIn(['sudo', 'snap', 'restore', '7'], self.calls)
+
+        # A full teardown cleans up the base, and forgets the snapshot.
+        self.calls = []
+        self._plan().destroy(keep_base=False)
+
+        self.assertEqual(self._scripts(), ['base_cleanup.sh'])
+        self.assertIn(['sudo', 'snap', 'forget', '7'], self.calls)
+        self.assertIn(['sudo', 'snap', 'remove', 'base'], self.calls)
+
+    def test_stale_base(self):
+        # A base that differs from the warm one replaces it, rather than
+        # being deployed on top of it.
+        self._plan().run()
+        self.calls = []
+        self._plan(channel='pike/edge').run()
+
+        self.assertEqual(self._scripts(),
+                         ['base_cleanup.sh', 'base.sh', 'test.sh'])
+        self.assertIn(['sudo', 'snap', 'remove', 'base'], self.calls)
+        self.assertIn(['sudo', 'snap', 'forget', '7'], self.calls)
+        self.assertIn(['sudo', 'snap', 'refresh', '--no-wait',
+                       '--channel=pike/edge', 'base'], self.calls)
+
+    def test_rabbitmq(self):
+        warm = WarmBase(os.path.join(self._dir.name, 'warm'))
+        warm.capture('x', [])
+        self.calls = []
+        warm.restore()
+
+        self.assertIn(['sudo', 'rabbitmqctl', 'set_permissions',
+                       'openstack', '.*', '.*', '.*'], self.calls)
+        self.assertFalse([c for c in self.calls if 'add_user' in c])